@@ -1,8 +1,12 @@
 import asyncio
+import datetime
 
 import click
 
 from .bot import create_bot
+from .backup_store import BackupStore
+from .db import init_db
+from .migrate import MIGRATIONS, MigrationError, applied_versions, run_migrations
 from .settings import settings
 
 
@@ -20,8 +24,73 @@ async def _run_main(token: str) -> None:
 def run() -> None:
     if not settings.FILMSWAP_TOKEN:
         raise click.ClickException("FILMSWAP_TOKEN is not set")
+    engine = init_db()
+    if settings.AUTO_MIGRATE:
+        try:
+            run_migrations(engine)
+        except MigrationError as e:
+            raise click.ClickException(str(e))
     asyncio.run(_run_main(token=settings.FILMSWAP_TOKEN))
 
 
+@main.command(short_help="apply pending schema migrations")
+@click.option(
+    "--batch-size",
+    default=1000,
+    show_default=True,
+    help="rows copied per transaction when rebuilding a table",
+)
+@click.option("--list", "list_", is_flag=True, help="list migrations and exit")
+def migrate(batch_size: int, list_: bool) -> None:
+    """
+    Apply any migrations which haven't been applied to the database yet
+
+    This is safe to run while the bot is running, large tables are copied
+    in small batches so the bot can keep using the database
+    """
+    if list_:
+        applied = applied_versions(init_db())
+        for m in MIGRATIONS:
+            status = "applied" if m.version in applied else "pending"
+            click.echo(f"{m.version}\t{status}\t{m.description}")
+        return
+    try:
+        results = run_migrations(init_db(), batch_size=batch_size)
+    except MigrationError as e:
+        raise click.ClickException(str(e))
+    if not results:
+        click.echo("No pending migrations")
+    for r in results:
+        status = "applied" if r.applied else "already in schema"
+        click.echo(f"{r.version}\t{status}\t{r.seconds:.2f}s\t{r.description}")
+
+
+@main.command(short_help="list database backups")
+def list_backups() -> None:
+    store = BackupStore(settings.BACKUP_DIR)
+    store.import_legacy()
+    for snapshot_id, info in store.snapshots().items():
+        created_at = datetime.datetime.fromtimestamp(info["created_at"])
+        click.echo(
+            f"{snapshot_id}\t{created_at}\t{info['size']} bytes\t{info['export']}"
+        )
+
+
+@main.command(short_help="restore a database backup to a sqlite file")
+@click.argument("SNAPSHOT_ID")
+@click.argument("OUTPUT", type=click.Path(dir_okay=False))
+def restore_backup(snapshot_id: str, output: str) -> None:
+    """
+    Write SNAPSHOT_ID (or 'latest') from the backup store to OUTPUT, as a plain sqlite database
+    """
+    try:
+        store = BackupStore(settings.BACKUP_DIR)
+        store.import_legacy()
+        store.restore(snapshot_id, output)
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+    click.echo(f"Restored backup {snapshot_id} to {output}")
+
+
 if __name__ == "__main__":
     main(prog_name="filmswap")
@@ -0,0 +1,104 @@
+"""
+Awaitable wrappers for the functions in db.py
+
+Every call is run on a single dedicated thread, so no SQL (or sqlite fsync)
+ever runs on the discord.py event loop, and writes to the database are
+serialized the same way they would be with one connection
+"""
+
+from __future__ import annotations
+import asyncio
+import functools
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, ParamSpec, TypeVar
+
+from . import db
+
+P = ParamSpec("P")
+T = TypeVar("T")
+
+executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="filmswap-db")
+
+
+async def run_sync(func: Callable[P, T], *args: P.args, **kwargs: P.kwargs) -> T:
+    """
+    Run a blocking database function on the database thread, and wait for the result
+    """
+    loop = asyncio.get_running_loop()
+    # run_in_executor doesn't copy contextvars (unlike asyncio.to_thread), so
+    # queries wouldn't know which command they're for, see metrics.py
+    ctx = contextvars.copy_context()
+    return await loop.run_in_executor(
+        executor, functools.partial(ctx.run, func, *args, **kwargs)
+    )
+
+
+def _awaitable(func: Callable[P, T]) -> Callable[P, Awaitable[T]]:
+    @functools.wraps(func)
+    async def wrapper(*args: P.args, **kwargs: P.kwargs) -> T:
+        return await run_sync(func, *args, **kwargs)
+
+    return wrapper
+
+
+# swap
+get_swap = _awaitable(db.Swap.get_swap)
+create_swap = _awaitable(db.Swap.create_swap)
+get_swap_period = _awaitable(db.Swap.get_swap_period)
+set_swap_channel = _awaitable(db.Swap.set_swap_channel)
+match_users = _awaitable(db.Swap.match_users)
+unmatch_users = _awaitable(db.Swap.unmatch_users)
+save_join_button_message_id = _awaitable(db.Swap.save_join_button_message_id)
+get_join_button_message_id = _awaitable(db.Swap.get_join_button_message_id)
+
+# users
+load_user_context = _awaitable(db.load_user_context)
+check_active_user = _awaitable(db.check_active_user)
+join_swap = _awaitable(db.join_swap)
+leave_swap = _awaitable(db.leave_swap)
+restore_letter = _awaitable(db.restore_letter)
+user_has_letter = _awaitable(db.user_has_letter)
+has_giftee = _awaitable(db.has_giftee)
+has_set_gift = _awaitable(db.has_set_gift)
+get_santa = _awaitable(db.get_santa)
+get_giftee = _awaitable(db.get_giftee)
+set_letter = _awaitable(db.set_letter)
+set_gift = _awaitable(db.set_gift)
+set_gift_done = _awaitable(db.set_gift_done)
+set_letterboxd = _awaitable(db.set_letterboxd)
+backup_all_letters = _awaitable(db.backup_all_letters)
+
+# bans
+ban_user = _awaitable(db.ban_user)
+unban_user = _awaitable(db.unban_user)
+list_banned = _awaitable(db.Banned.list_banned)
+block_pair = _awaitable(db.block_pair)
+unblock_pair = _awaitable(db.unblock_pair)
+
+# outbox
+outbox_status = _awaitable(db.outbox_status)
+period_outbox_status = _awaitable(db.period_outbox_status)
+reset_outbox = _awaitable(db.reset_outbox)
+enqueue_dm = _awaitable(db.enqueue_dm)
+
+# embeds
+review_my_letter_embed = _awaitable(db.review_my_letter_embed)
+review_my_gift_embed = _awaitable(db.review_my_gift_embed)
+receive_gift_embed = _awaitable(db.receive_gift_embed)
+read_giftee_letter = _awaitable(db.read_giftee_letter)
+
+
+async def set_swap_period(period: db.SwapPeriod) -> str | None:
+    if period == db.SwapPeriod.JOIN:
+        # back up the swap before its pairs and gifts are cleared. this runs on
+        # its own thread (not in set_swap_period's transaction), so other
+        # database calls aren't held up while it writes the backup
+        await snapshot_database()
+    return await run_sync(db.Swap.set_swap_period, period)
+
+
+async def snapshot_database() -> db.SnapshotFiles:
+    # this can take a while for a large swap, so it runs on its own thread,
+    # instead of holding up every other database call while it reads
+    return await asyncio.to_thread(db.snapshot_database)
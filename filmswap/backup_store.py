@@ -0,0 +1,254 @@
+"""
+A deduplicating store for database backups
+
+Each backup of the sqlite database is split into fixed size chunks, which are
+compressed and saved under objects/ by their sha256 hash. Sqlite changes pages
+in place, so most chunks are the same from one backup to the next, and are
+only stored once. A manifest in snapshots/ lists the chunks for each backup,
+and index.json keeps a summary of every snapshot (and which is the latest),
+so finding the latest backup doesn't require reading every file
+
+Old snapshots are pruned with a grandfather-father-son policy (see prune),
+and chunks no longer used by any snapshot are deleted
+
+Restoring a snapshot writes the chunks back out as a plain sqlite file
+
+Backups made before this store existed (BACKUP_DIR/<timestamp>.sqlite) are
+added to it by import_legacy, and then pruned like any other snapshot
+"""
+
+from __future__ import annotations
+import os
+import re
+import json
+import time
+import zlib
+import hashlib
+import datetime
+import threading
+from typing import Any, Iterator
+
+from logzero import logger  # type: ignore[import]
+
+# a multiple of the sqlite page size, so pages line up with chunks
+CHUNK_SIZE = 64 * 1024
+
+_lock = threading.Lock()
+
+# backups from before the store, e.g. 1700000000.sqlite
+LEGACY_BACKUP = re.compile(r"^(\d+)\.sqlite$")
+
+
+class BackupStore:
+    def __init__(self, root: str) -> None:
+        self.root = root
+        self.objects_dir = os.path.join(root, "objects")
+        self.snapshots_dir = os.path.join(root, "snapshots")
+        self.index_path = os.path.join(root, "index.json")
+
+    def _object_path(self, digest: str) -> str:
+        return os.path.join(self.objects_dir, digest[:2], digest)
+
+    def _manifest_path(self, snapshot_id: str) -> str:
+        return os.path.join(self.snapshots_dir, f"{snapshot_id}.json")
+
+    @staticmethod
+    def _write_json(path: str, data: Any) -> None:
+        # write to a temporary file and rename, so a crash never leaves a half written file
+        tmp = f"{path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+
+    def _read_index(self) -> dict[str, Any]:
+        if not os.path.exists(self.index_path):
+            return {"latest": None, "snapshots": {}}
+        with open(self.index_path) as f:
+            return json.load(f)  # type: ignore[no-any-return]
+
+    def add(
+        self,
+        database_path: str,
+        export: str | None = None,
+        created_at: int | None = None,
+    ) -> str:
+        """
+        Add a copy of a sqlite database file to the store, returns the snapshot ID
+
+        export is the filename of the JSON export made alongside this backup, if any,
+        created_at defaults to now
+        """
+        with _lock:
+            os.makedirs(self.snapshots_dir, exist_ok=True)
+            if created_at is None:
+                created_at = int(time.time())
+            snapshot_id = str(created_at)
+            index = self._read_index()
+            # if two backups are made in the same second
+            suffix = 1
+            while snapshot_id in index["snapshots"]:
+                snapshot_id = f"{created_at}-{suffix}"
+                suffix += 1
+
+            chunks: list[str] = []
+            size = 0
+            new_chunks = 0
+            with open(database_path, "rb") as f:
+                while chunk := f.read(CHUNK_SIZE):
+                    size += len(chunk)
+                    digest = hashlib.sha256(chunk).hexdigest()
+                    chunks.append(digest)
+                    path = self._object_path(digest)
+                    if os.path.exists(path):
+                        continue
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    with open(f"{path}.tmp", "wb") as obj:
+                        obj.write(zlib.compress(chunk))
+                    os.replace(f"{path}.tmp", path)
+                    new_chunks += 1
+
+            summary = {"created_at": created_at, "size": size, "export": export}
+            self._write_json(
+                self._manifest_path(snapshot_id),
+                {"id": snapshot_id, "chunk_size": CHUNK_SIZE, "chunks": chunks}
+                | summary,
+            )
+            index["snapshots"][snapshot_id] = summary
+            latest = index["latest"]
+            if latest is None or created_at >= index["snapshots"][latest]["created_at"]:
+                index["latest"] = snapshot_id
+            self._write_json(self.index_path, index)
+
+        logger.info(
+            f"Saved backup {snapshot_id}, {size} bytes in {len(chunks)} chunks, {new_chunks} of them new"
+        )
+        return snapshot_id
+
+    def import_legacy(self) -> list[str]:
+        """
+        Add any <timestamp>.sqlite backups from before the store, and delete the
+        originals, returns the new snapshot IDs
+        """
+        if not os.path.isdir(self.root):
+            return []
+        imported: list[str] = []
+        for name in sorted(os.listdir(self.root)):
+            if (m := LEGACY_BACKUP.match(name)) is None:
+                continue
+            timestamp = m.group(1)
+            export: str | None = f"{timestamp}.json"
+            if not os.path.exists(os.path.join(self.root, f"{timestamp}.json")):
+                export = None
+            path = os.path.join(self.root, name)
+            imported.append(self.add(path, export=export, created_at=int(timestamp)))
+            os.remove(path)
+        if imported:
+            logger.info(
+                f"Imported {len(imported)} backups from before the backup store"
+            )
+        return imported
+
+    def latest(self) -> str | None:
+        latest: str | None = self._read_index()["latest"]
+        return latest
+
+    def snapshots(self) -> dict[str, dict[str, Any]]:
+        """
+        Returns the summary for each snapshot, oldest first
+        """
+        snapshots: dict[str, dict[str, Any]] = self._read_index()["snapshots"]
+        return dict(sorted(snapshots.items(), key=lambda kv: kv[1]["created_at"]))
+
+    def _chunks(self, snapshot_id: str) -> Iterator[bytes]:
+        with open(self._manifest_path(snapshot_id)) as f:
+            manifest = json.load(f)
+        for digest in manifest["chunks"]:
+            with open(self._object_path(digest), "rb") as obj:
+                chunk = zlib.decompress(obj.read())
+            if hashlib.sha256(chunk).hexdigest() != digest:
+                raise RuntimeError(f"Backup chunk {digest} is corrupted")
+            yield chunk
+
+    def restore(self, snapshot_id: str, output_path: str) -> None:
+        """
+        Write a snapshot back out as a plain sqlite database file
+        """
+        if snapshot_id == "latest":
+            latest = self.latest()
+            if latest is None:
+                raise RuntimeError("There are no backups to restore")
+            snapshot_id = latest
+        if not os.path.exists(self._manifest_path(snapshot_id)):
+            raise RuntimeError(f"No backup with ID {snapshot_id}")
+        if os.path.exists(output_path):
+            raise RuntimeError(f"{output_path} already exists, not overwriting it")
+        tmp = f"{output_path}.tmp"
+        with open(tmp, "wb") as f:
+            for chunk in self._chunks(snapshot_id):
+                f.write(chunk)
+        os.replace(tmp, output_path)
+        logger.info(f"Restored backup {snapshot_id} to {output_path}")
+
+    def prune(
+        self, keep_last: int, keep_daily: int, keep_weekly: int, keep_monthly: int
+    ) -> list[str]:
+        """
+        Delete snapshots using a grandfather-father-son policy, returns the deleted IDs
+
+        Keeps the newest keep_last snapshots, and the newest snapshot in each of the
+        last keep_daily days, keep_weekly weeks, and keep_monthly months that have one
+        """
+        with _lock:
+            index = self._read_index()
+            newest_first = sorted(
+                index["snapshots"],
+                key=lambda s: index["snapshots"][s]["created_at"],
+                reverse=True,
+            )
+
+            keep = set(newest_first[:keep_last])
+            for count, fmt in (
+                (keep_daily, "%Y-%m-%d"),
+                (keep_weekly, "%G-%V"),
+                (keep_monthly, "%Y-%m"),
+            ):
+                periods: set[str] = set()
+                for snapshot_id in newest_first:
+                    if len(periods) >= count:
+                        break
+                    created_at = index["snapshots"][snapshot_id]["created_at"]
+                    period = datetime.datetime.fromtimestamp(created_at).strftime(fmt)
+                    if period not in periods:
+                        periods.add(period)
+                        keep.add(snapshot_id)
+
+            deleted = [s for s in newest_first if s not in keep]
+            if not deleted:
+                return deleted
+
+            for snapshot_id in deleted:
+                export = index["snapshots"].pop(snapshot_id).get("export")
+                if export and os.path.exists(os.path.join(self.root, export)):
+                    os.remove(os.path.join(self.root, export))
+                os.remove(self._manifest_path(snapshot_id))
+            self._write_json(self.index_path, index)
+
+            removed = self._collect_garbage(keep)
+
+        logger.info(
+            f"Pruned {len(deleted)} backups ({removed} unused chunks), kept {len(keep)}"
+        )
+        return deleted
+
+    def _collect_garbage(self, snapshot_ids: set[str]) -> int:
+        used: set[str] = set()
+        for snapshot_id in snapshot_ids:
+            with open(self._manifest_path(snapshot_id)) as f:
+                used.update(json.load(f)["chunks"])
+        removed = 0
+        for prefix in os.listdir(self.objects_dir):
+            for digest in os.listdir(os.path.join(self.objects_dir, prefix)):
+                if digest not in used:
+                    os.remove(os.path.join(self.objects_dir, prefix, digest))
+                    removed += 1
+        return removed
@@ -2,37 +2,56 @@ from __future__ import annotations
 from logzero import logger  # type: ignore[import]
 
 import os
+import math
 import asyncio
 import discord
 import discord.abc
 from discord.ext import commands
 from gettext import gettext as _
 
-from .db import (
-    Swap,
-    SwapPeriod,
-    check_active_user,
+from .db import SwapPeriod, UserContext
+from .async_db import (
+    get_join_button_message_id,
+    load_user_context,
     set_letterboxd,
-    review_my_gift_embed,
-    review_my_letter_embed,
-    receive_gift_embed,
-    get_santa,
-    get_giftee,
-    read_giftee_letter,
     set_gift,
-    user_has_letter,
-    has_set_gift,
     set_gift_done,
     backup_all_letters,
     set_letter,
     leave_swap,
-    has_giftee,
+    run_sync,
+    enqueue_dm,
 )
 from .settings import settings, Environment
-from .manage import Manage, JoinSwapButton, update_usernames
+from .manage import Manage, JoinSwapButton, save_usernames, update_usernames
+from .outbox import embed_payload, get_sender, start_sender
+from .governor import Priority, api_priority, install_governor
+from .throttle import Throttle
+from .metrics import (
+    MetricsCommandTree,
+    discord_trace,
+    on_command_completion,
+    start_exporters,
+    track_command,
+)
 from ._types import ClientT
 
 MSG_DESCRIPTION_LIMIT = 4000
+# the > commands users can send in DMs, in the order handle_dm_command checks them
+DM_COMMANDS = ("letter", "submit", "write-santa", "write-giftee")
+
+
+def dm_command_name(content: str) -> str:
+    """
+    The > command handle_dm_command will run for a message, or 'unknown'
+
+    Matched by prefix like the handler, so '>letter2' is throttled and
+    counted as 'letter' instead of getting its own bucket
+    """
+    for command in DM_COMMANDS:
+        if content.startswith(f">{command}"):
+            return command
+    return "unknown"
 
 
 def help_embed() -> discord.Embed:
@@ -112,7 +131,12 @@ async def background_tasks(bot: discord.Client) -> None:
                 f"Cannot fetch guild with ID {settings.GUILD_ID}, cannot update usernames",
             )
             return
-        await update_usernames(gld)
+        try:
+            with api_priority(Priority.MAINTENANCE):
+                await update_usernames(gld)
+        except Exception as e:
+            # try again tomorrow, instead of stopping the loop
+            logger.exception(e, exc_info=True)
         await asyncio.sleep(60 * 60 * 24)
 
 
@@ -132,8 +156,13 @@ def create_bot() -> discord.Client:
 
         activity = discord.Activity(type=act_type, name=settings.PRESENCE_STATUS)
     bot = commands.Bot(
-        command_prefix=commands.when_mentioned, intents=intents, activity=activity
+        command_prefix=commands.when_mentioned,
+        intents=intents,
+        activity=activity,
+        tree_cls=MetricsCommandTree,
+        http_trace=discord_trace(),
     )
+    install_governor(bot)
 
     async def error_if_not_in_dm(ctx: discord.Interaction[ClientT] | commands.Context) -> bool:  # type: ignore[type-arg]
         if isinstance(ctx, commands.Context):
@@ -158,20 +187,22 @@ def create_bot() -> discord.Client:
                 return True
         return False
 
-    async def not_active_user(ctx: discord.Interaction[ClientT] | commands.Context) -> bool:  # type: ignore[type-arg]
+    async def active_user_context(ctx: discord.Interaction[ClientT] | commands.Context) -> UserContext | None:  # type: ignore[type-arg]
         """
-        returns True if user is not active, False if user is active
+        returns None if user is not active (after telling them why), otherwise the users context
         """
         if isinstance(ctx, commands.Context):
-            if error := check_active_user(ctx.author.id):
+            user_context = await load_user_context(ctx.author.id)
+            if error := user_context.active_error():
                 await ctx.reply(error)
-                return True
+                return None
         else:
             assert isinstance(ctx, discord.Interaction)
-            if error := check_active_user(ctx.user.id):
+            user_context = await load_user_context(ctx.user.id)
+            if error := user_context.active_error():
                 await ctx.response.send_message(error, ephemeral=True)
-                return True
-        return False
+                return None
+        return user_context
 
     @bot.tree.command(name="review-letter", description="Review your letter")  # type: ignore[arg-type]
     async def review_letter(interaction: discord.Interaction[ClientT]) -> None:
@@ -182,10 +213,10 @@ def create_bot() -> discord.Client:
         if await error_if_not_in_dm(interaction):
             return
 
-        if await not_active_user(interaction):
+        if (user_context := await active_user_context(interaction)) is None:
             return
 
-        embed = review_my_letter_embed(interaction.user.id)
+        embed = user_context.review_my_letter_embed()
         await interaction.response.send_message(embed=embed, ephemeral=True)
 
     @bot.tree.command(  # type: ignore[arg-type]
@@ -200,7 +231,7 @@ def create_bot() -> discord.Client:
         if await error_if_not_in_dm(interaction):
             return
 
-        if await not_active_user(interaction):
+        if await active_user_context(interaction) is None:
             return
 
         await interaction.response.send_message(
@@ -222,7 +253,7 @@ def create_bot() -> discord.Client:
         if await error_if_not_in_dm(interaction):
             return
 
-        if await not_active_user(interaction):
+        if await active_user_context(interaction) is None:
             return
 
         await interaction.response.send_message(
@@ -242,7 +273,7 @@ def create_bot() -> discord.Client:
         if await error_if_not_in_dm(interaction):
             return
 
-        if await not_active_user(interaction):
+        if await active_user_context(interaction) is None:
             return
 
         await interaction.response.send_message(
@@ -259,10 +290,10 @@ def create_bot() -> discord.Client:
         if await error_if_not_in_dm(interaction):
             return
 
-        if await not_active_user(interaction):
+        if (user_context := await active_user_context(interaction)) is None:
             return
 
-        embed = review_my_gift_embed(interaction.user.id)
+        embed = user_context.review_my_gift_embed()
         await interaction.response.send_message(embed=embed, ephemeral=True)
 
     @bot.tree.command(  # type: ignore[arg-type]
@@ -277,7 +308,7 @@ def create_bot() -> discord.Client:
         if await error_if_not_in_dm(interaction):
             return
 
-        if await not_active_user(interaction):
+        if await active_user_context(interaction) is None:
             return
 
         # prompt the user to set their gift
@@ -296,10 +327,10 @@ def create_bot() -> discord.Client:
         if await error_if_not_in_dm(interaction):
             return
 
-        if await not_active_user(interaction):
+        if (user_context := await active_user_context(interaction)) is None:
             return
 
-        gift = receive_gift_embed(interaction.user.id)
+        gift = user_context.receive_gift_embed()
         await interaction.response.send_message(embed=gift, ephemeral=True)
 
     @bot.tree.command(name="read", description="Read the letter from your giftee")  # type: ignore[arg-type]
@@ -311,10 +342,10 @@ def create_bot() -> discord.Client:
         if await error_if_not_in_dm(interaction):
             return
 
-        if await not_active_user(interaction):
+        if (user_context := await active_user_context(interaction)) is None:
             return
 
-        letter = read_giftee_letter(interaction.user.id)
+        letter = user_context.read_giftee_letter()
         await interaction.response.send_message(embed=letter, ephemeral=True)
 
     @bot.tree.command(name="leave", description=_("Leave the film swap"))  # type: ignore[arg-type]
@@ -333,10 +364,10 @@ def create_bot() -> discord.Client:
             )
             return
 
-        if await not_active_user(interaction):
+        if (user_context := await active_user_context(interaction)) is None:
             return
 
-        if Swap.get_swap_period() != SwapPeriod.JOIN:
+        if user_context.period != SwapPeriod.JOIN:
             logger.info(
                 f"User {interaction.user.id} {interaction.user.display_name} tried to leave the swap but it's not the JOIN period"
             )
@@ -347,7 +378,7 @@ def create_bot() -> discord.Client:
             return
 
         try:
-            leave_swap(interaction.user.id)
+            await leave_swap(interaction.user.id)
         except RuntimeError as e:
             return await interaction.response.send_message(
                 f"Error: {e}", ephemeral=True
@@ -367,10 +398,10 @@ def create_bot() -> discord.Client:
         if await error_if_not_in_dm(interaction):
             return
 
-        if await not_active_user(interaction):
+        if (user_context := await active_user_context(interaction)) is None:
             return
 
-        if Swap.get_swap_period() == SwapPeriod.JOIN:
+        if user_context.period == SwapPeriod.JOIN:
             logger.info(
                 f"User {interaction.user.id} {interaction.user.display_name} tried to mark their gift as watched during the JOIN period"
             )
@@ -383,7 +414,7 @@ def create_bot() -> discord.Client:
             return
 
         try:
-            set_gift_done(interaction.user.id)
+            await set_gift_done(interaction.user.id)
         except RuntimeError as e:
             return await interaction.response.send_message(
                 f"Error: {e}", ephemeral=True
@@ -404,11 +435,11 @@ def create_bot() -> discord.Client:
         if await error_if_not_in_dm(interaction):
             return
 
-        if await not_active_user(interaction):
+        if await active_user_context(interaction) is None:
             return
 
         try:
-            set_letterboxd(interaction.user.id, username)
+            await set_letterboxd(interaction.user.id, username)
         except RuntimeError as e:
             return await interaction.response.send_message(
                 f"Error: {e}", ephemeral=True
@@ -421,10 +452,19 @@ def create_bot() -> discord.Client:
             ephemeral=True,
         )
 
+    @bot.event
+    async def on_app_command_completion(
+        interaction: discord.Interaction[ClientT],
+        command: discord.app_commands.Command | discord.app_commands.ContextMenu,  # type: ignore[type-arg]
+    ) -> None:
+        on_command_completion(interaction)
+
     @bot.event
     async def on_command_error(ctx: commands.Context, error: Exception) -> None:  # type: ignore[type-arg]
         logger.exception(f"Error: {error}", exc_info=True)
 
+    throttle = Throttle()
+
     @bot.event
     async def on_message(message: discord.Message) -> None:
         # bot is using tree commands, not the discord commands extension, so I dont think this is needed
@@ -439,19 +479,36 @@ def create_bot() -> discord.Client:
             return
 
         content = message.content.strip()
+        if content.startswith(">"):
+            command = dm_command_name(content)
+            throttled = throttle.check(message.author.id, command)
+            if not throttled.allowed:
+                logger.info(
+                    f"User {message.author.id} throttled using >{command}, can use it again in {throttled.retry_after:.0f}s"
+                )
+                if throttled.warn:
+                    await message.author.send(
+                        f"Slow down! You can use >{command} again in {math.ceil(throttled.retry_after)} seconds"
+                    )
+                return
+            with track_command(f">{command}"):
+                await handle_dm_command(message, content)
+
+    async def handle_dm_command(message: discord.Message, content: str) -> None:
         if content.startswith(">letter"):
             logger.info(f"User {message.author.id} setting letter")
 
-            if error := check_active_user(message.author.id):
+            user_context = await load_user_context(message.author.id)
+            if error := user_context.active_error():
                 await message.author.send(error)
                 return
 
-            if Swap.get_swap_period() != SwapPeriod.JOIN:
+            if user_context.period != SwapPeriod.JOIN:
                 logger.info(
                     f"User {message.author.id} tried to set letter but it's not the JOIN period"
                 )
 
-                if user_has_letter(message.author.id):
+                if user_context.swap_user.letter is not None:
                     # already has letter, check if they are allowed to change it right now
                     await message.author.send(
                         "Sorry, you can't change your letter right now. Wait till the beginning of the next swap to change it.\nIf you want to review your letter, you can use `/review-letter`",
@@ -474,22 +531,25 @@ def create_bot() -> discord.Client:
             logger.info(f"User {message.author.id} setting letter to {letter_contents}")
 
             try:
-                set_letter(message.author.id, letter_contents)
+                await set_letter(message.author.id, letter_contents)
             except AssertionError:
                 await message.author.send(
                     f"Sorry, your letter is too long. It must be less than {MSG_DESCRIPTION_LIMIT} characters (it is currently {len(letter_contents)} characters)"
                 )
                 return
+            # keep the loaded row in sync, instead of querying for it again
+            user_context.swap_user.letter = letter_contents
             await message.reply("Your letter has been set, your santa will see:")
-            await message.reply(embed=review_my_letter_embed(message.author.id))
+            await message.reply(embed=user_context.review_my_letter_embed())
         elif content.startswith(">submit"):
             logger.info(f"User {message.author.id} setting gift")
 
-            if error := check_active_user(message.author.id):
+            user_context = await load_user_context(message.author.id)
+            if error := user_context.active_error():
                 await message.author.send(error)
                 return
 
-            if not has_giftee(message.author.id):
+            if user_context.swap_user.giftee_id is None:
                 logger.info(
                     f"User {message.author.id} tried to set gift but they don't have a giftee"
                 )
@@ -498,7 +558,7 @@ def create_bot() -> discord.Client:
                 )
                 return
 
-            current_period = Swap.get_swap_period()
+            current_period = user_context.period
             if current_period == SwapPeriod.JOIN:
                 logger.info(
                     f"User {message.author.id} tried to set gift but its currently JOIN period"
@@ -515,7 +575,7 @@ def create_bot() -> discord.Client:
             # check if they've already submitted a gift this swap
             # we should not allow people who have already submitted to change during the swap period,
             # but if they haven't submitted yet, they can submit at any time (to allow latecomers to join later)
-            if current_period == SwapPeriod.WATCH and has_set_gift(message.author.id):
+            if current_period == SwapPeriod.WATCH and user_context.has_set_gift():
                 logger.info(
                     f"User {message.author.id} tried to set gift but the WATCH period has already started, and they've already set a gift"
                 )
@@ -543,16 +603,17 @@ def create_bot() -> discord.Client:
             logger.info(f"User {message.author.id} setting gift to {gift_contents}")
 
             try:
-                set_gift(message.author.id, gift_contents)
+                await set_gift(message.author.id, gift_contents)
             except AssertionError:
                 await message.author.send(
                     f"Sorry, your gift is too long. It must be less than {MSG_DESCRIPTION_LIMIT} characters (it is currently {len(gift_contents)} characters)"
                 )
                 return
+            user_context.swap_user.gift = gift_contents
             await message.reply(
                 "Your gift has been set, when the watch period starts your giftee will see:"
             )
-            await message.reply(embed=review_my_gift_embed(message.author.id))
+            await message.reply(embed=user_context.review_my_gift_embed())
             await message.reply(
                 "Since you can change your gift by running /submit again before the SWAP period ends, your giftee does not receive their gift immediately.\nIf you're confident in your gift or want to send it early, you can also use >write-giftee to send it to your giftee early"
             )
@@ -560,11 +621,12 @@ def create_bot() -> discord.Client:
         elif content.startswith(">write-santa"):
             logger.info(f"User {message.author.id} sending message to santa")
 
-            if error := check_active_user(message.author.id):
+            user_context = await load_user_context(message.author.id)
+            if error := user_context.active_error():
                 await message.author.send(error)
                 return
 
-            santa = get_santa(message.author.id)
+            santa = user_context.santa
 
             if santa is None:
                 logger.info(
@@ -596,37 +658,39 @@ def create_bot() -> discord.Client:
                 return
 
             assert santa is not None
-
-            try:
-                santa_user = await bot.fetch_user(santa.user_id)
-            except Exception:
+            logger.info(
+                f"User {message.author.id} {message.author.display_name} sending message to santa {santa.user_id} {santa.name} {message_contents}"
+            )
+            embed = discord.Embed(
+                title="Your giftee sent you a message", description=message_contents
+            )
+            embed.set_footer(text="To reply, use >write-giftee [text]")
+            # the discord message ID makes sure the same message is only relayed once
+            outbox_id = await enqueue_dm(
+                f"relay:{message.id}", santa.user_id, "relay", embed_payload(embed)
+            )
+            result = await get_sender().send_now(outbox_id)
+            if result is None:
+                await message.author.send("Your message will be sent shortly")
+            elif result.status == "sent":
+                await message.author.send("Your message has been sent")
+            else:
                 logger.info(
-                    f"User {message.author.id} tried to send message to santa but their santa's ID {santa.user_id} is invalid"
+                    f"User {message.author.id} tried to send message to santa but sending to their santa's ID {santa.user_id} failed: {result.error}"
                 )
                 await message.author.send(
                     "There was an error messaging your santa, could not associate their ID with a discord account."
                 )
-                return
-            else:
-                logger.info(
-                    f"User {message.author.id} {message.author.display_name} sending message to santa {santa.user_id} {santa.name} {message_contents}"
-                )
-                embed = discord.Embed(
-                    title="Your giftee sent you a message", description=message_contents
-                )
-                embed.set_footer(text="To reply, use >write-giftee [text]")
-                await santa_user.send(embed=embed)
-
-                await message.author.send("Your message has been sent")
 
         elif content.startswith(">write-giftee"):
             logger.info(f"User {message.author.id} sending message to giftee")
 
-            if error := check_active_user(message.author.id):
+            user_context = await load_user_context(message.author.id)
+            if error := user_context.active_error():
                 await message.author.send(error)
                 return
 
-            giftee = get_giftee(message.author.id)
+            giftee = user_context.giftee
 
             if giftee is None:
                 logger.info(
@@ -658,26 +722,29 @@ def create_bot() -> discord.Client:
                 return
 
             assert giftee is not None
-            try:
-                giftee_user = await bot.fetch_user(giftee.user_id)
-            except Exception:
+            logger.info(
+                f"User {message.author.id} {message.author.display_name} sending message to giftee {giftee.user_id} {giftee.name} {message_contents}"
+            )
+            embed = discord.Embed(
+                title="Your santa sent you a message", description=message_contents
+            )
+            embed.set_footer(text="To reply, use >write-santa [text]")
+            # the discord message ID makes sure the same message is only relayed once
+            outbox_id = await enqueue_dm(
+                f"relay:{message.id}", giftee.user_id, "relay", embed_payload(embed)
+            )
+            result = await get_sender().send_now(outbox_id)
+            if result is None:
+                await message.author.send("Your message will be sent shortly")
+            elif result.status == "sent":
+                await message.author.send("Your message has been sent")
+            else:
                 logger.info(
-                    f"User {message.author.id} tried to send message to giftee but their giftee's ID {giftee.user_id} is invalid"
+                    f"User {message.author.id} tried to send message to giftee but sending to their giftee's ID {giftee.user_id} failed: {result.error}"
                 )
                 await message.author.send(
                     "There was an error messaging your giftee, could not associate their ID with a discord account."
                 )
-                return
-            else:
-                logger.info(
-                    f"User {message.author.id} {message.author.display_name} sending message to giftee {giftee.user_id} {giftee.name} {message_contents}"
-                )
-                embed = discord.Embed(
-                    title="Your santa sent you a message", description=message_contents
-                )
-                embed.set_footer(text="To reply, use >write-santa [text]")
-                await giftee_user.send(embed=embed)
-                await message.author.send("Your message has been sent")
         elif content.startswith(">"):
             logger.info(
                 f"User {message.author.id} {message.author.display_name} sent unknown command {content}"
@@ -693,10 +760,42 @@ def create_bot() -> discord.Client:
         )
         await interaction.response.send_message(embed=help_embed(), ephemeral=True)
 
+    # keep the names in the database up to date as they change, instead
+    # of checking every member. update_usernames catches anything missed
+    # while the bot was offline
+
+    @bot.event
+    async def on_member_update(before: discord.Member, after: discord.Member) -> None:
+        if after.guild.id != settings.GUILD_ID:
+            return
+        if before.display_name != after.display_name:
+            logger.info(f"Member {after.id} renamed to {after.display_name}")
+            await run_sync(save_usernames, {after.id: after.display_name}, [])
+
+    @bot.event
+    async def on_user_update(before: discord.User, after: discord.User) -> None:
+        # changing your global name changes your display name, if you don't have a nickname
+        guild = bot.get_guild(settings.GUILD_ID)
+        member = guild.get_member(after.id) if guild is not None else None
+        if (
+            member is not None
+            and member.nick is None
+            and before.display_name != after.display_name
+        ):
+            logger.info(f"User {after.id} renamed to {member.display_name}")
+            await run_sync(save_usernames, {after.id: member.display_name}, [])
+
+    @bot.event
+    async def on_member_remove(member: discord.Member) -> None:
+        if member.guild.id != settings.GUILD_ID:
+            return
+        logger.info(f"Member {member.id} left the server, setting letter to None")
+        await run_sync(save_usernames, {}, [member.id])
+
     @bot.event
     async def setup_hook() -> None:
         logger.info("Setting up persistent join button")
-        latest_swap_msg_id = Swap.get_join_button_message_id()
+        latest_swap_msg_id = await get_join_button_message_id()
         if latest_swap_msg_id is None:
             logger.info("No join button message ID found")
         else:
@@ -705,6 +804,11 @@ def create_bot() -> discord.Client:
         join_view._bot = bot  # type: ignore
         bot.add_view(join_view, message_id=latest_swap_msg_id)
 
+        # sends any DMs which were queued before the bot (re)started
+        logger.info("Starting outbox sender")
+        start_sender(bot)
+        await start_exporters()
+
     @bot.event
     async def on_ready() -> None:
         logger.info(f"Logged in as {bot.user}")
@@ -738,7 +842,7 @@ def create_bot() -> discord.Client:
 
         await bot.tree.sync()
 
-        backup_all_letters()
+        await backup_all_letters()
         logger.info("Starting background tasks...")
         bot.loop.create_task(background_tasks(bot))
 
@@ -1,25 +1,37 @@
 from __future__ import annotations
+import io
+import gzip
 import json
-import random
+import hashlib
 import os
 import enum
 import time
-from typing import Any
+import threading
+from dataclasses import dataclass
+from typing import Any, Callable, NamedTuple
 
 import discord
 
 from sqlalchemy import (
     create_engine,
+    insert,
+    update,
+    bindparam,
+    event,
+    literal,
     Column,
     Integer,
     String,
     Boolean,
     Enum,
+    JSON,
 )
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlite_backup.core import sqlite_backup
 from sqlalchemy.sql import func
 from sqlalchemy import DateTime
-from sqlalchemy.orm import Session
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session, aliased
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.schema import MetaData
@@ -30,6 +42,8 @@ metadata = MetaData()
 Base = declarative_base(metadata=metadata)
 
 from .settings import settings
+from . import matching, metrics
+from .backup_store import BackupStore
 
 
 class SwapPeriod(enum.Enum):
@@ -38,6 +52,43 @@ class SwapPeriod(enum.Enum):
     WATCH = "WATCH"
 
 
+@dataclass(frozen=True)
+class SwapSnapshot:
+    """
+    An in-memory copy of the swap row. The row only changes through the writer
+    methods on Swap, which replace this after they commit, so readers never
+    have to query for it
+
+    If the database is edited by hand while the bot is running, restart the bot
+    (or call invalidate_swap_cache) so this is reloaded
+    """
+
+    id: int
+    swap_channel_discord_id: int | None
+    period: SwapPeriod
+    join_button_message_id: int | None
+
+
+_swap_snapshot: SwapSnapshot | None = None
+
+
+def _cache_swap(swap: Swap) -> SwapSnapshot:
+    global _swap_snapshot
+    assert isinstance(swap.period, SwapPeriod)
+    _swap_snapshot = SwapSnapshot(
+        id=swap.id,
+        swap_channel_discord_id=swap.swap_channel_discord_id,
+        period=swap.period,
+        join_button_message_id=swap.join_button_message_id,
+    )
+    return _swap_snapshot
+
+
+def invalidate_swap_cache() -> None:
+    global _swap_snapshot
+    _swap_snapshot = None
+
+
 # probably just gonna be a singleton, run multiple instances of the bot for additional swaps
 class Swap(Base):
     __tablename__ = "swaps"
@@ -50,38 +101,44 @@ class Swap(Base):
 
     @staticmethod
     def list_swaps() -> list[Swap]:
-        with Session(engine) as session:  # type: ignore[attr-defined]
+        with Session(get_engine()) as session:  # type: ignore[attr-defined]
             return session.query(Swap).all()  # type: ignore[no-any-return]
 
     @staticmethod
-    def get_swap() -> Swap:
-        with Session(engine) as session:  # type: ignore[attr-defined]
-            try:
-                return session.query(Swap).filter_by().limit(1).one()  # type: ignore[no-any-return]
-            except NoResultFound as e:
-                raise RuntimeError("No swap configured") from e
+    def _swap_row(session: Session) -> Swap:
+        try:
+            return session.query(Swap).filter_by().limit(1).one()  # type: ignore[no-any-return]
+        except NoResultFound as e:
+            raise RuntimeError("No swap configured") from e
 
     @staticmethod
-    def create_swap() -> Swap:
-        with Session(engine) as session:  # type: ignore[attr-defined]
+    def get_swap() -> SwapSnapshot:
+        if _swap_snapshot is not None:
+            return _swap_snapshot
+        with Session(get_engine()) as session:  # type: ignore[attr-defined]
+            return _cache_swap(Swap._swap_row(session))
+
+    @staticmethod
+    def create_swap() -> SwapSnapshot:
+        with Session(get_engine(), expire_on_commit=False) as session:  # type: ignore[attr-defined]
             try:
                 swap = session.query(Swap).filter_by().limit(1).one()
                 raise RuntimeError("Swap is already configured")
             except NoResultFound:
                 pass
-            swap = Swap()
+            swap = Swap(period=SwapPeriod.JOIN)  # type: ignore[misc]
             session.add(swap)
             session.commit()
-        return swap  # type: ignore[no-any-return]
+            return _cache_swap(swap)
 
     @staticmethod
     def save_join_button_message_id(message_id: int) -> None:
         logger.info(f"Saving join button message id {message_id}")
-        with Session(engine) as session:  # type: ignore[attr-defined]
-            swap = Swap.get_swap()
+        with Session(get_engine(), expire_on_commit=False) as session:  # type: ignore[attr-defined]
+            swap = Swap._swap_row(session)
             swap.join_button_message_id = message_id
-            session.add(swap)
             session.commit()
+            _cache_swap(swap)
 
     @staticmethod
     def get_join_button_message_id() -> int | None:
@@ -98,56 +155,87 @@ class Swap(Base):
         return swap.join_button_message_id
 
     @staticmethod
-    def match_users() -> None:
-        with Session(engine) as session:  # type: ignore[attr-defined]
-            # find users where they have letters, and have no matched user
-            users = session.query(SwapUser).filter_by(santa_id=None).all()
-            logger.info(f"Found {len(users)} users with no santa")
-            users = [u for u in users if u.letter is not None]
-            logger.info(f"Found {len(users)} users with letters, with no santa")
-            if len(users) < 2:
-                raise RuntimeError(
-                    f"Cannot match users without at least 2 unmatched users, currently have {len(users)} who have letters, but have no santa"
-                )
-
-            random.shuffle(users)
+    def match_users() -> str:
+        with Session(get_engine()) as session:  # type: ignore[attr-defined]
+            msg = Swap._match_users(session)
+            session.commit()
+        return msg
 
-            logger.info(
-                f"Shuffled users, random order: {[f'{u.user_id} {u.name}' for u in users]}"
+    @staticmethod
+    def _match_users(session: Session) -> str:
+        """
+        Returns a message for the admin, which lists any pairs repeated from a previous
+        swap, if there were too few users to avoid them
+        """
+        # find users where they have letters, and have no matched user
+        users = (
+            session.query(SwapUser.user_id, SwapUser.name)
+            .filter_by(santa_id=None)
+            .filter(SwapUser.letter.is_not(None))  # type: ignore[attr-defined]
+            .all()
+        )
+        logger.info(f"Found {len(users)} users with letters, with no santa")
+        if len(users) < 2:
+            raise RuntimeError(
+                f"Cannot match users without at least 2 unmatched users, currently have {len(users)} who have letters, but have no santa"
             )
 
-            # after shuffling the list, each person gets assigned the person in front of them as their giftee, and behind them as their santa
-            for i, user in enumerate(users):
-                user_before = users[i - 1]
-                user_after = users[(i + 1) % len(users)]
-
-                logger.info(
-                    f"For user {user.user_id}, santa is {user_before.user_id}, giftee is {user_after.user_id}"
-                )
-
-                user.santa_id = user_before.user_id
-                user.giftee_id = user_after.user_id
-                session.add(user)
+        forbidden = forbidden_pairs(session)
+        user_ids = matching.match(
+            [u.user_id for u in users],
+            forbidden,
+            engine=settings.MATCH_ENGINE,
+        )
 
-            session.commit()
+        names = {u.user_id: u.name for u in users}
+        logger.info(
+            f"Matched users, order: {[f'{user_id} {names[user_id]}' for user_id in user_ids]}"
+        )
+        msg = "Matched all users with their giftee/santas"
+        # blocked pairs are never used, these are from previous swaps
+        if repeated := matching.validate_cycle(user_ids, set().union(*forbidden)):
+            logger.warning(f"Repeated pairs from previous swaps: {repeated}")
+            listed = ", ".join(
+                f"{names[santa_id]} -> {names[giftee_id]}"
+                for santa_id, giftee_id in repeated[:10]
+            )
+            msg += f"\nWarning: {len(repeated)} pairs are repeated from a previous swap, there weren't enough users to avoid them: {listed}"
+
+        # each person gets assigned the person in front of them as their giftee, and behind them as their santa
+        pairs = [
+            {
+                "b_user_id": user_id,
+                "b_santa_id": user_ids[i - 1],
+                "b_giftee_id": user_ids[(i + 1) % len(user_ids)],
+            }
+            for i, user_id in enumerate(user_ids)
+        ]
+        # one executemany, instead of loading and flushing each row
+        session.execute(
+            update(SwapUser.__table__)
+            .where(SwapUser.user_id == bindparam("b_user_id"))
+            .values(
+                santa_id=bindparam("b_santa_id"), giftee_id=bindparam("b_giftee_id")
+            ),
+            pairs,
+        )
+        return msg
 
     @staticmethod
     def unmatch_users() -> None:
-        with Session(engine) as session:  # type: ignore[attr-defined]
+        with Session(get_engine()) as session:  # type: ignore[attr-defined]
             # set all users santa_id and giftee_id to None
-            users = session.query(SwapUser).all()
-            for user in users:
-                logger.info(f"Unmatching user {user.user_id}")
-                user.santa_id = None
-                user.giftee_id = None
-                session.add(user)
+            count = session.query(SwapUser).update(
+                {"santa_id": None, "giftee_id": None}, synchronize_session=False
+            )
+            logger.info(f"Unmatched {count} users")
             session.commit()
 
     @staticmethod
     def set_swap_period(period: SwapPeriod) -> str | None:
         msg: str | None = None
-        with Session(engine) as session:  # type: ignore[attr-defined]
-            swap = Swap.get_swap()
+        with Session(get_engine(), expire_on_commit=False) as session:  # type: ignore[attr-defined]
+            swap = Swap._swap_row(session)
             if period == SwapPeriod.SWAP:
                 logger.info("Running db logic for SWAP period")
                 if swap.swap_channel_discord_id is None:
@@ -155,32 +243,31 @@ class Swap(Base):
                         "Cannot set swap period to swap without a swap channel, run the 'set-channel' command"
                     )
                 try:
-                    Swap.match_users()
-                    msg = "Matched all users with their giftee/santas"
+                    msg = Swap._match_users(session)
                 except RuntimeError as e:
                     msg = f"Warning: couldn't match users -- {e}"
 
                 # set done_watching to False for all users
-                users = session.query(SwapUser).all()
-                logger.info(f"Setting done_watching to False for {len(users)} users")
-                for user in users:
-                    user.done_watching = False
-                    session.add(user)
+                count = session.query(SwapUser).update(
+                    {"done_watching": False}, synchronize_session=False
+                )
+                logger.info(f"Set done_watching to False for {count} users")
             elif period == SwapPeriod.JOIN:
-                snapshot_database()
+                # the backup of the swap is made before this, by async_db.set_swap_period
                 logger.info("Running db logic for JOIN period")
+                record_pair_history(session)
                 # need to remove all santa_id/giftee_id's back to null, and remove gifts from users
-                users = session.query(SwapUser).all()
-                for user in users:
-                    logger.info(f"Unmatching user {user.user_id}")
-                    user.santa_id = None
-                    user.giftee_id = None
-                    user.gift = None
-                    session.add(user)
+                count = session.query(SwapUser).update(
+                    {"santa_id": None, "giftee_id": None, "gift": None},
+                    synchronize_session=False,
+                )
+                logger.info(f"Unmatched {count} users")
 
             swap.period = period  # type: ignore[assignment]
-            session.add(swap)
+            if settings.PERIOD_POST_HOOK:
+                _enqueue_period_dms(session, period)
             session.commit()
+            _cache_swap(swap)
 
             logger.info(f"Done setting swap period to {period}")
 
@@ -188,17 +275,15 @@ class Swap(Base):
 
     @staticmethod
     def set_swap_channel(channel_id: int) -> None:
-        with Session(engine) as session:  # type: ignore[attr-defined]
-            swap = Swap.get_swap()
+        with Session(get_engine(), expire_on_commit=False) as session:  # type: ignore[attr-defined]
+            swap = Swap._swap_row(session)
             swap.swap_channel_discord_id = channel_id
-            session.add(swap)
             session.commit()
+            _cache_swap(swap)
 
     @staticmethod
     def get_swap_period() -> SwapPeriod:
-        swap = Swap.get_swap()
-        assert isinstance(swap.period, SwapPeriod)
-        return swap.period
+        return Swap.get_swap().period
 
 
 class SwapUser(Base):
@@ -218,9 +303,12 @@ class SwapUser(Base):
     done_watching = Column(Boolean, nullable=False, default=False)
 
     # santa is the user who is gifting to this user (i.e. santa)
-    santa_id = Column(Integer, nullable=True, default=None)
+    #
+    # the pairings form a permutation, so both of these are unique. SQLite allows
+    # any number of NULLs in a unique index, so unmatched users are fine
+    santa_id = Column(Integer, nullable=True, default=None, index=True, unique=True)
     # giftee is the user who this user is gifting to (i.e. giftee)
-    giftee_id = Column(Integer, nullable=True, default=None)
+    giftee_id = Column(Integer, nullable=True, default=None, index=True, unique=True)
 
     letterboxd_username = Column(String(64), nullable=True, default=None)
 
@@ -236,6 +324,17 @@ class LetterBackup(Base):
     )
 
 
+def _upsert_backup_letter(session: Session, user_id: int, letter: str) -> None:
+    stmt = sqlite_insert(LetterBackup.__table__).values(user_id=user_id, letter=letter)
+    session.execute(
+        stmt.on_conflict_do_update(
+            index_elements=[LetterBackup.user_id],
+            set_={"letter": stmt.excluded.letter, "updated_at": func.now()},
+            where=stmt.excluded.letter.is_distinct_from(LetterBackup.letter),
+        )
+    )
+
+
 def set_backup_letter(user_id: int, letter: str) -> None:
     if not isinstance(letter, str):
         logger.warning(
@@ -243,31 +342,182 @@ def set_backup_letter(user_id: int, letter: str) -> None:
         )
         return
     logger.info(f"Adding backup letter for {user_id}")
-    with Session(engine) as session:  # type: ignore[attr-defined]
-        # just delete and re-add
-        session.query(LetterBackup).filter_by(user_id=user_id).delete()
-        session.add(LetterBackup(user_id=user_id, letter=letter))
+    with Session(get_engine()) as session:  # type: ignore[attr-defined]
+        _upsert_backup_letter(session, user_id, letter)
         session.commit()
 
 
 def backup_all_letters() -> None:
+    """
+    Copy every user's letter to the backup table, in a single statement
+
+    Backups which already match the user's letter are left alone, so
+    updated_at is only changed for letters which have changed
+    """
     logger.info("Backing up letters...")
-    with Session(engine) as session:  # type: ignore[attr-defined]
-        users = [u for u in session.query(SwapUser) if u.letter is not None]
-        backups = {ltr.user_id: ltr.letter for ltr in session.query(LetterBackup).all()}
-        for u in users:
-            if not u.letter:
-                continue
-            if u.user_id in backups:
-                if u.letter == backups[u.user_id]:
-                    continue
-                logger.info(f"Updating backup letter for {u.user_id}")
-                session.query(LetterBackup).filter_by(user_id=u.user_id).update(
-                    {"letter": u.letter}
-                )
-            else:
-                logger.info(f"Adding backup letter for {u.user_id}")
-                session.add(LetterBackup(user_id=u.user_id, letter=u.letter))
+    with Session(get_engine()) as session:  # type: ignore[attr-defined]
+        letters = session.query(SwapUser.user_id, SwapUser.letter).filter(
+            SwapUser.letter.is_not(None), SwapUser.letter != ""  # type: ignore[attr-defined]
+        )
+        stmt = sqlite_insert(LetterBackup.__table__).from_select(
+            ["user_id", "letter"], letters.statement
+        )
+        result = session.execute(
+            stmt.on_conflict_do_update(
+                index_elements=[LetterBackup.user_id],
+                set_={"letter": stmt.excluded.letter, "updated_at": func.now()},
+                where=stmt.excluded.letter.is_distinct_from(LetterBackup.letter),
+            )
+        )
+        session.commit()
+    logger.info(f"Backed up {result.rowcount} new or changed letters")
+
+
+class PairHistory(Base):
+    """
+    The santa/giftee pairs from previous swaps, saved when the swap ends
+    """
+
+    __tablename__ = "pair_history"
+
+    id = Column(Integer, primary_key=True)
+    # increments each time a swap ends
+    round = Column(Integer, nullable=False, index=True)
+    santa_id = Column(Integer, nullable=False)
+    giftee_id = Column(Integer, nullable=False)
+
+
+class BlockedPair(Base):
+    """
+    Pairs of users who mods have asked to never be matched with each other
+    """
+
+    __tablename__ = "blocked_pairs"
+
+    # stored with user_a < user_b
+    user_a = Column(Integer, primary_key=True)
+    user_b = Column(Integer, primary_key=True)
+
+
+class SchemaMigration(Base):
+    """
+    Migrations which have been applied to this database, see migrate.py
+    """
+
+    __tablename__ = "schema_migrations"
+
+    version = Column(String(32), primary_key=True)
+    description = Column(String(256), nullable=False)
+    applied_at = Column(DateTime(timezone=True), server_default=func.now())
+    duration_ms = Column(Integer, nullable=False)
+
+
+class OutboxStatus(enum.Enum):
+    PENDING = "PENDING"
+    # claimed by the sender, reset to PENDING if the bot restarts before it finishes
+    SENDING = "SENDING"
+    SENT = "SENT"
+    # e.g. a gift which the santa never set
+    SKIPPED = "SKIPPED"
+    FAILED = "FAILED"
+
+
+class OutboxMessage(Base):
+    """
+    A DM the bot has to send, see outbox.py
+
+    These are added in the same transaction as the change which causes them,
+    so if the bot restarts before they're sent, they're still sent after
+    """
+
+    __tablename__ = "outbox"
+
+    id = Column(Integer, primary_key=True)
+    # adding a message with a key which is already in the outbox does nothing,
+    # so the same letter/notification is never queued twice
+    idempotency_key = Column(String(128), nullable=False, unique=True)
+    user_id = Column(Integer, nullable=False)
+    # e.g. 'letter', 'gift', 'relay'
+    kind = Column(String(32), nullable=False)
+    # kwargs for Messageable.send, with the embed as a dict
+    payload = Column(JSON, nullable=False)
+    status = Column(
+        Enum(OutboxStatus), nullable=False, default=OutboxStatus.PENDING, index=True
+    )
+    attempts = Column(Integer, nullable=False, default=0)
+    error = Column(String(512), nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    sent_at = Column(DateTime(timezone=True), nullable=True)
+
+
+def _last_pair_history_round(session: Session) -> int:
+    return session.query(func.max(PairHistory.round)).scalar() or 0  # type: ignore[no-untyped-call,no-any-return]
+
+
+def record_pair_history(session: Session) -> None:
+    last_round = _last_pair_history_round(session)
+    count = (
+        session.query(SwapUser).filter(SwapUser.santa_id.is_not(None)).count()  # type: ignore[attr-defined]
+    )
+    logger.info(f"Saving {count} pairs as round {last_round + 1} of pair history")
+    session.execute(
+        insert(PairHistory.__table__).from_select(
+            ["round", "santa_id", "giftee_id"],
+            session.query(literal(last_round + 1), SwapUser.santa_id, SwapUser.user_id)
+            .filter(SwapUser.santa_id.is_not(None))  # type: ignore[attr-defined]
+            .statement,
+        )
+    )
+
+
+def forbidden_pairs(session: Session) -> list[set[matching.Pair]]:
+    """
+    The (santa, giftee) pairs to avoid when matching, most important first:
+
+    the pairs mods have blocked, then the pairs from each of the last
+    MATCH_AVOID_PREVIOUS_SWAPS swaps, newest first. Every pair is forbidden in both
+    directions, so people don't get matched with their old santa as a giftee either
+    """
+    blocked: set[matching.Pair] = set()
+    for a, b in session.query(BlockedPair.user_a, BlockedPair.user_b):
+        blocked.update(((a, b), (b, a)))
+
+    last_round = _last_pair_history_round(session)
+    history: dict[int, set[matching.Pair]] = {}
+    for round, santa_id, giftee_id in session.query(
+        PairHistory.round, PairHistory.santa_id, PairHistory.giftee_id
+    ).filter(PairHistory.round > last_round - settings.MATCH_AVOID_PREVIOUS_SWAPS):
+        history.setdefault(round, set()).update(
+            ((santa_id, giftee_id), (giftee_id, santa_id))
+        )
+
+    return [blocked] + [history[r] for r in sorted(history, reverse=True)]
+
+
+def _ordered_pair(user_id: int, other_user_id: int) -> tuple[int, int]:
+    if user_id == other_user_id:
+        raise RuntimeError("Cannot block a user from being matched with themselves")
+    return min(user_id, other_user_id), max(user_id, other_user_id)
+
+
+def block_pair(user_id: int, other_user_id: int) -> None:
+    user_a, user_b = _ordered_pair(user_id, other_user_id)
+    with Session(get_engine()) as session:  # type: ignore[attr-defined]
+        if session.get(BlockedPair, (user_a, user_b)) is not None:
+            raise RuntimeError("Those users are already blocked from being matched")
+        logger.info(f"Blocking {user_a} and {user_b} from being matched")
+        session.add(BlockedPair(user_a=user_a, user_b=user_b))
+        session.commit()
+
+
+def unblock_pair(user_id: int, other_user_id: int) -> None:
+    user_a, user_b = _ordered_pair(user_id, other_user_id)
+    with Session(get_engine()) as session:  # type: ignore[attr-defined]
+        blocked = session.get(BlockedPair, (user_a, user_b))
+        if blocked is None:
+            raise RuntimeError("Those users are not blocked from being matched")
+        logger.info(f"Unblocking {user_a} and {user_b} from being matched")
+        session.delete(blocked)
         session.commit()
 
 
@@ -278,15 +528,21 @@ class Banned(Base):
 
     @staticmethod
     def list_banned() -> list[Banned]:
-        with Session(engine) as session:  # type: ignore[attr-defined]
+        with Session(get_engine()) as session:  # type: ignore[attr-defined]
             return session.query(Banned).all()  # type: ignore[no-any-return]
 
 
+def is_banned(session: Session, user_id: int) -> bool:
+    # EXISTS on the primary key, instead of counting every match
+    exists = session.query(Banned).filter_by(user_id=user_id).exists()  # type: ignore[no-untyped-call]
+    return bool(session.query(exists).scalar())  # type: ignore[no-untyped-call]
+
+
 def ban_user(user_id: int) -> None:
     logger.info(f"Banning user {user_id}")
-    with Session(engine) as session:  # type: ignore[attr-defined]
+    with Session(get_engine()) as session:  # type: ignore[attr-defined]
         # check if already banned
-        if session.query(Banned).filter_by(user_id=user_id).count() > 0:
+        if is_banned(session, user_id):
             logger.info(f"User {user_id} is already banned")
             raise RuntimeError("User is already banned")
 
@@ -301,8 +557,8 @@ def ban_user(user_id: int) -> None:
 
 
 def unban_user(user_id: int) -> None:
-    with Session(engine) as session:  # type: ignore[attr-defined]
-        if session.query(Banned).filter_by(user_id=user_id).count() == 0:
+    with Session(get_engine()) as session:  # type: ignore[attr-defined]
+        if not is_banned(session, user_id):
             logger.info(f"User {user_id} is not banned")
             raise RuntimeError("User is not banned")
 
@@ -311,26 +567,504 @@ def unban_user(user_id: int) -> None:
         session.commit()
 
 
-def check_active_user(user_id: int) -> str | None:
+def current_round(session: Session) -> int:
     """
-    returns an error message if the user is banned or not in the swap, otherwise None if active
+    The number of the current swap, pair history for it is saved when it ends
+    """
+    return _last_pair_history_round(session) + 1
+
+
+def enqueue_dms(session: Session, messages: list[dict[str, Any]]) -> int:
+    """
+    Add messages to the outbox, as part of the sessions transaction
+
+    Each dict has the idempotency_key, user_id, kind and payload
+    """
+    if not messages:
+        return 0
+    stmt = sqlite_insert(OutboxMessage.__table__).on_conflict_do_nothing(
+        index_elements=[OutboxMessage.idempotency_key]
+    )
+    result = session.execute(
+        stmt,
+        [
+            {"status": OutboxStatus.PENDING, "attempts": 0} | message
+            for message in messages
+        ],
+    )
+    return result.rowcount  # type: ignore[no-any-return]
+
+
+def period_dm_payloads(
+    session: Session, period: SwapPeriod
+) -> list[tuple[int, int | None, dict[str, Any]]]:
+    """
+    The DM for each matched user when the period changes, as (user ID, giftee
+    ID on SWAP or santa ID on WATCH, outbox payload)
+
+    On SWAP this is their giftees letter, on WATCH it's the gift from their santa
+    (users whose santa hasn't set a gift are left out). This is one query, joining
+    each user to their santa and giftee, instead of loading each users context
+    """
+    santa = aliased(SwapUser)
+    giftee = aliased(SwapUser)
+    rows = (
+        session.query(  # type: ignore[no-untyped-call]
+            SwapUser.user_id,
+            SwapUser.name,
+            giftee.user_id,
+            giftee.name,
+            giftee.letter,
+            santa.user_id,
+            santa.gift,
+        )
+        .outerjoin(giftee, giftee.santa_id == SwapUser.user_id)
+        .outerjoin(santa, santa.giftee_id == SwapUser.user_id)
+        .filter(SwapUser.giftee_id.is_not(None))  # type: ignore[attr-defined]
+        .order_by(SwapUser.id)
+    )
+    payloads: list[tuple[int, int | None, dict[str, Any]]] = []
+    for user_id, name, giftee_id, giftee_name, letter, santa_id, santa_gift in rows:
+        if period == SwapPeriod.SWAP:
+            embed = giftee_letter_embed(giftee_name, letter)
+            payloads.append((user_id, giftee_id, {"embed": embed.to_dict()}))
+        elif santa_gift is not None:
+            embed = gift_embed(name, santa_gift)
+            payloads.append((user_id, santa_id, {"embed": embed.to_dict()}))
+        else:
+            logger.info(f"Not sending gift to {user_id}, their santa hasn't set it")
+    return payloads
+
+
+def _payload_hash(payload: dict[str, Any]) -> str:
+    data = json.dumps(payload, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()[:16]
+
+
+def _enqueue_period_dms(session: Session, period: SwapPeriod) -> int:
+    """
+    Queue everyone's giftees letter when the swap starts, and their gift when watching starts
+
+    The key includes who the letter/gift is from and a hash of the message, so
+    setting the period again (e.g. after matching users who joined late, or
+    after someone was banned and their santa rerouted) sends anything that
+    changed, but doesn't send the same message to someone twice
+    """
+    kind = {SwapPeriod.SWAP: "letter", SwapPeriod.WATCH: "gift"}.get(period)
+    if kind is None:
+        return 0
+    round = current_round(session)
+    count = enqueue_dms(
+        session,
+        [
+            {
+                "idempotency_key": f"{kind}:{round}:{user_id}:{partner_id}:{_payload_hash(payload)}",
+                "user_id": user_id,
+                "kind": kind,
+                "payload": payload,
+            }
+            for user_id, partner_id, payload in period_dm_payloads(session, period)
+        ],
+    )
+    logger.info(f"Queued {count} {kind}s to send")
+    return count
+
+
+def enqueue_dm(
+    idempotency_key: str, user_id: int, kind: str, payload: dict[str, Any]
+) -> int:
+    """
+    Add a single message to the outbox, returns its ID
+    """
+    with Session(get_engine()) as session:  # type: ignore[attr-defined]
+        enqueue_dms(
+            session,
+            [
+                {
+                    "idempotency_key": idempotency_key,
+                    "user_id": user_id,
+                    "kind": kind,
+                    "payload": payload,
+                }
+            ],
+        )
+        session.commit()
+        return session.query(OutboxMessage.id).filter_by(idempotency_key=idempotency_key).scalar()  # type: ignore[no-untyped-call,no-any-return]
+
+
+def claim_outbox(ids: list[int] | None = None) -> list[OutboxMessage]:
+    """
+    Mark pending messages (all of them, or just these IDs) as being sent, and return them
+    """
+    with Session(get_engine(), expire_on_commit=False) as session:  # type: ignore[attr-defined]
+        query = session.query(OutboxMessage).filter_by(status=OutboxStatus.PENDING)
+        if ids is not None:
+            query = query.filter(OutboxMessage.id.in_(ids))
+        messages = query.order_by(OutboxMessage.id).all()
+        if messages:
+            session.query(OutboxMessage).filter(
+                OutboxMessage.id.in_([m.id for m in messages])
+            ).update(
+                {
+                    "status": OutboxStatus.SENDING,
+                    "attempts": OutboxMessage.attempts + 1,
+                },
+                synchronize_session=False,
+            )
+            session.commit()
+        return messages  # type: ignore[no-any-return]
+
+
+def finish_outbox(message_id: int, status: OutboxStatus, error: str | None) -> None:
+    with Session(get_engine()) as session:  # type: ignore[attr-defined]
+        session.query(OutboxMessage).filter_by(id=message_id).update(
+            {
+                "status": status,
+                "error": error[:512] if error else None,
+                "sent_at": func.now() if status == OutboxStatus.SENT else None,
+            },
+            synchronize_session=False,
+        )
+        session.commit()
+
+
+def reset_outbox(from_status: OutboxStatus) -> int:
+    """
+    Set messages back to pending, e.g. ones which were being sent when the bot stopped
+    """
+    with Session(get_engine()) as session:  # type: ignore[attr-defined]
+        count = (
+            session.query(OutboxMessage)
+            .filter_by(status=from_status)
+            .update({"status": OutboxStatus.PENDING}, synchronize_session=False)
+        )
+        session.commit()
+    if count:
+        logger.info(f"Reset {count} {from_status.value} outbox messages to PENDING")
+    return count  # type: ignore[no-any-return]
+
+
+def outbox_status(
+    limit: int = 20,
+) -> tuple[dict[OutboxStatus, int], list[OutboxMessage]]:
+    """
+    The number of messages with each status, and the most recent failures
+    """
+    with Session(get_engine()) as session:  # type: ignore[attr-defined]
+        counts = {
+            status: count
+            for status, count in session.query(
+                OutboxMessage.status, func.count(OutboxMessage.id)
+            ).group_by(OutboxMessage.status)
+        }
+        failed = (
+            session.query(OutboxMessage)
+            .filter_by(status=OutboxStatus.FAILED)
+            .order_by(OutboxMessage.id.desc())
+            .limit(limit)
+            .all()
+        )
+        return counts, failed
+
+
+def period_outbox_status(kind: str) -> tuple[dict[OutboxStatus, int], list[int]]:
     """
-    with Session(engine) as session:  # type: ignore[attr-defined]
-        banned = session.query(Banned).filter_by(user_id=user_id).count() > 0
-        if banned:
-            logger.info(f"User {user_id} is banned")
+    The number of this rounds letter/gift messages with each status, and the
+    user IDs of the ones which failed
+
+    If the period was set more than once, only each users latest message is counted
+    """
+    with Session(get_engine()) as session:  # type: ignore[attr-defined]
+        # keys start with f"{kind}:{round}:", and ';' sorts right after ':',
+        # so this is a range on the unique index instead of a LIKE
+        prefix = f"{kind}:{current_round(session)}:"
+        latest = (
+            session.query(func.max(OutboxMessage.id))
+            .filter(
+                OutboxMessage.idempotency_key >= prefix,
+                OutboxMessage.idempotency_key < prefix[:-1] + ";",
+            )
+            .group_by(OutboxMessage.user_id)
+        )
+        in_round = (OutboxMessage.id.in_(latest),)
+        counts = {
+            status: count
+            for status, count in session.query(
+                OutboxMessage.status, func.count(OutboxMessage.id)
+            )
+            .filter(*in_round)
+            .group_by(OutboxMessage.status)
+        }
+        failed = [
+            user_id
+            for (user_id,) in session.query(OutboxMessage.user_id)
+            .filter(*in_round, OutboxMessage.status == OutboxStatus.FAILED)
+            .order_by(OutboxMessage.user_id)
+        ]
+        return counts, failed
+
+
+@dataclass
+class UserContext:
+    """
+    Everything a command needs to know about a user, loaded in a single query
+    with load_user_context, so handlers don't have to make a round trip for each check
+    """
+
+    user_id: int
+    user: SwapUser | None
+    banned: bool
+    swap_period: SwapPeriod | None
+    # the user who is gifting to this user
+    santa: SwapUser | None
+    # the user this user is gifting to
+    giftee: SwapUser | None
+
+    @property
+    def period(self) -> SwapPeriod:
+        if self.swap_period is None:
+            raise RuntimeError("No swap configured")
+        return self.swap_period
+
+    @property
+    def swap_user(self) -> SwapUser:
+        if self.user is None:
+            raise NoResultFound(f"User {self.user_id} is not in the swap")
+        return self.user
+
+    def active_error(self) -> str | None:
+        """
+        returns an error message if the user is banned or not in the swap, otherwise None if active
+        """
+        if self.banned:
+            logger.info(f"User {self.user_id} is banned")
             return "You are banned from the swap, If you've finished your gift, please post your thoughts in the swap thread and ask a mod to unban you"
 
-        user = session.query(SwapUser).filter_by(user_id=user_id).count() > 0
-        if user:
+        if self.user is not None:
             return None
         else:
-            logger.info(f"User {user_id} is not in the swap")
+            logger.info(f"User {self.user_id} is not in the swap")
             return "You are not in the swap, click the 'join button' in the swap channel to join"
 
+    def has_set_gift(self) -> bool:
+        gift = self.swap_user.gift
+        if gift is None:
+            return False
+        if gift.strip() == "":
+            return False
+        return True
+
+    def review_my_letter_embed(self) -> discord.Embed:
+        """
+        Read your own letter, to review
+        """
+        swapuser = self.swap_user
+        if swapuser.letter is None:
+            logger.info(
+                f"User {self.user_id} tried to review their letter, but they haven't set it yet"
+            )
+            return discord.Embed(
+                title="You haven't set your letter yet!",
+                description="Use the `>letter` command to send your letter",
+            )
+
+        let = f"""Dear Santa,\n\n{swapuser.letter}\n\nLove, {swapuser.name}"""
+        embed = discord.Embed(title="You received a letter!", description=let)
+        return embed
+
+    def review_my_gift_embed(self) -> discord.Embed:
+        # read your own gift (what you sent as a recommendation), to review
+        swapuser = self.swap_user
+        if swapuser.gift is None:
+            logger.info(
+                f"User {self.user_id} tried to review their gift, but they haven't set it yet"
+            )
+            return discord.Embed(
+                title="You haven't set your gift yet!",
+                description="Use the `>submit` command to set your gift",
+            )
+
+        # the user who has this user as their santa
+        given_to = self.giftee
+
+        if given_to is None:
+            logger.info(
+                f"User {self.user_id} tried to review their gift, but they haven't been assigned a giftee yet"
+            )
+            return discord.Embed(
+                title="You haven't been assigned a giftee yet!",
+                description="You'll have to wait for the swap to start",
+            )
+
+        gift = f"""Dear {given_to.name},\n\n{swapuser.gift}\n\nLove, Santa"""
+        embed = discord.Embed(title="You received a gift!", description=gift)
+        return embed
+
+    def receive_gift_embed(self, raise_if_missing: bool = False) -> discord.Embed:
+        """
+        This is how a user receives their gift, to see what their santa recommended them
+        """
+        user_id = self.user_id
+        # to receive gift, find the user whose giftee is this user
+        santa_user = self.santa
+        if santa_user is None:
+            logger.info(
+                f"User {user_id} tried to receive their gift, but they haven't been assigned a santa yet"
+            )
+            if raise_if_missing:
+                raise RuntimeError(
+                    "User tried to receive their gift, but they haven't been assigned a santa yet"
+                )
+            return discord.Embed(
+                title="You don't have a santa yet!",
+                description="If you joined late, you may get assigned one soon, or you'll have to wait for the next swap to start",
+            )
+
+        match self.period:
+            case SwapPeriod.JOIN:
+                logger.info(
+                    f"User {user_id} tried to receive their gift, but the swap hasn't started yet (currently in JOIN period)"
+                )
+                return discord.Embed(
+                    title="The swap hasn't started yet!",
+                    description="Once the 'swap' period has started, you can check again for your gift. If you haven't set your >letter yet, do so now!",
+                )
+            case SwapPeriod.SWAP:
+                logger.info(
+                    f"User {user_id} tried to receive their gift, but the swap hasn't started yet (currently in SWAP period)"
+                )
+                return discord.Embed(
+                    title="The swap hasn't started yet!",
+                    description="Once the 'watch' period starts, you can re-run this command to see your gift",
+                )
+            case _:
+                pass
+
+        if santa_user.gift is None:
+            logger.info(
+                f"User {user_id} tried to receive their gift, but their santa {santa_user.user_id} {santa_user.name} hasn't set it yet"
+            )
+            if raise_if_missing:
+                raise RuntimeError(
+                    "User tried to receive their gift, but their santa hasn't set it yet"
+                )
+            return discord.Embed(
+                title="You haven't received a gift yet!",
+                description="Please wait for your santa to send their gift. If the 'watch' period has already started, you can ask the mods to make sure your santa sent their gift",
+            )
+
+        my_swapuser = self.swap_user
+
+        return gift_embed(my_swapuser.name, santa_user.gift)
+
+    def read_giftee_letter(self) -> discord.Embed:
+        # read your giftee's letter, this is how you find out what they want
+        #
+        # 'their santa_id is my user id', so we read their letter
+        user_id = self.user_id
+        giftee_user = self.giftee
+        if giftee_user is None:
+            logger.info(
+                f"User {user_id} tried to read their giftee's letter, but they haven't been assigned a giftee yet"
+            )
+            return giftee_letter_embed(None, None)
+
+        if giftee_user.letter is None:
+            logger.info(
+                f"User {user_id} tried to read their giftee's letter, but their giftee {giftee_user.user_id} {giftee_user.name} hasn't set it yet"
+            )
+            return giftee_letter_embed(giftee_user.name, None)
+
+        match self.period:
+            case SwapPeriod.JOIN:
+                logger.info(
+                    f"User {user_id} tried to read their giftee's letter, but the swap hasn't started yet (currently in JOIN period)"
+                )
+                return discord.Embed(
+                    title="The swap hasn't started yet!",
+                    description="Once the 'swap' period has started, you can check again for your giftee's letter",
+                )
+            case _:
+                pass
+
+        return giftee_letter_embed(giftee_user.name, giftee_user.letter)
+
+
+def giftee_letter_embed(giftee_name: str | None, letter: str | None) -> discord.Embed:
+    """
+    The letter a santa reads, giftee_name is None if they don't have a giftee yet
+    """
+    if giftee_name is None:
+        return discord.Embed(
+            title="You haven't been assigned a giftee yet!",
+            description="You'll have to wait for the swap to start. If you think this is a mistake, ask a mod to check",
+        )
+    if letter is None:
+        return discord.Embed(
+            title="Your giftee hasn't set their letter yet!",
+            description="Wait for your giftee to set their letter",
+        )
+    let = f"""Dear Santa,\n\n{letter}\n\nLove, {giftee_name}"""
+    return discord.Embed(title="Your giftee sent a letter!", description=let)
+
+
+def gift_embed(name: str, gift: str) -> discord.Embed:
+    """
+    The gift a giftee receives from their santa
+    """
+    gift = f"""Dear {name},\n\n{gift}\n\nLove, Santa"""
+    return discord.Embed(title="You received a gift!", description=gift)
+
+
+def load_user_context(user_id: int) -> UserContext:
+    """
+    Load the users row, their banned status and their santa/giftee in one query
+
+    The swap period is read from the in-memory swap snapshot
+    """
+    santa = aliased(SwapUser)
+    giftee = aliased(SwapUser)
+    with Session(get_engine()) as session:  # type: ignore[attr-defined]
+        # select from a single constant row, so this still returns a row
+        # if the user isn't in the swap, or there is no swap configured
+        anchor = session.query(literal(user_id).label("user_id")).subquery()
+        banned = (
+            session.query(Banned.user_id)
+            .filter(Banned.user_id == anchor.c.user_id)
+            .exists()
+        )
+        row = (
+            session.query(banned.label("banned"), SwapUser, santa, giftee)
+            .select_from(anchor)
+            .outerjoin(SwapUser, SwapUser.user_id == anchor.c.user_id)
+            .outerjoin(santa, santa.giftee_id == anchor.c.user_id)
+            .outerjoin(giftee, giftee.santa_id == anchor.c.user_id)
+            .limit(1)
+            .one()
+        )
+    try:
+        swap_period: SwapPeriod | None = Swap.get_swap_period()
+    except RuntimeError:
+        swap_period = None
+    return UserContext(
+        user_id=user_id,
+        user=row[1],
+        banned=bool(row[0]),
+        swap_period=swap_period,
+        santa=row[2],
+        giftee=row[3],
+    )
+
+
+def check_active_user(user_id: int) -> str | None:
+    """
+    returns an error message if the user is banned or not in the swap, otherwise None if active
+    """
+    return load_user_context(user_id).active_error()
+
 
 def set_gift_done(user_id: int) -> None:
-    with Session(engine) as session:  # type: ignore[attr-defined]
+    with Session(get_engine()) as session:  # type: ignore[attr-defined]
         user = session.query(SwapUser).filter_by(user_id=user_id).one_or_none()
         if user is None:
             logger.info(f"User {user_id} is not in the swap")
@@ -348,16 +1082,14 @@ def set_gift_done(user_id: int) -> None:
 
 
 def user_has_letter(user_id: int) -> bool:
-    with Session(engine) as session:  # type: ignore[attr-defined]
+    with Session(get_engine()) as session:  # type: ignore[attr-defined]
         user = session.query(SwapUser).filter_by(user_id=user_id).one()
         return user.letter is not None
 
 
 def join_swap(user_id: int, name: str) -> None:
-    with Session(engine) as session:  # type: ignore[attr-defined]
-        is_banned = session.query(Banned).filter_by(user_id=user_id).count() > 0
-
-        if is_banned:
+    with Session(get_engine()) as session:  # type: ignore[attr-defined]
+        if is_banned(session, user_id):
             logger.info(f"User {user_id} banned while trying to join swap")
             raise RuntimeError(
                 "You are banned from the swap, if you have finished your previous gift, please post your thoughts in the swap thread and ask a mod to unban you"
@@ -389,7 +1121,7 @@ def join_swap(user_id: int, name: str) -> None:
 
 
 def restore_letter(user_id: int) -> bool:
-    with Session(engine) as session:  # type: ignore[attr-defined]
+    with Session(get_engine()) as session:  # type: ignore[attr-defined]
         user = session.query(SwapUser).filter_by(user_id=user_id).one()
         if user.letter is not None:
             logger.info(
@@ -411,7 +1143,7 @@ def restore_letter(user_id: int) -> bool:
 
 
 def leave_swap(user_id: int) -> None:
-    with Session(engine) as session:  # type: ignore[attr-defined]
+    with Session(get_engine()) as session:  # type: ignore[attr-defined]
         swap_user = session.query(SwapUser).filter_by(user_id=user_id).one_or_none()
         if swap_user is None:
             logger.info(f"User {user_id} tried to leave swap but was not in swap")
@@ -427,41 +1159,42 @@ def set_letter(user_id: int, letter: str) -> None:
     """
     This is how a user sets their letter, to tell their santa what they want
     """
-    with Session(engine) as session:  # type: ignore[attr-defined]
+    with Session(get_engine()) as session:  # type: ignore[attr-defined]
         swap_user = session.query(SwapUser).filter_by(user_id=user_id).one()
         assert len(letter) <= 4000, "Letter too long, must be less than 4000 characters"
         logger.info(f"User {user_id} set their letter to {letter}")
         swap_user.letter = letter
         session.add(swap_user)
+        # save the backup in the same transaction
+        _upsert_backup_letter(session, user_id, letter)
         session.commit()
-    set_backup_letter(user_id, letter)
 
 
 def has_giftee(user_id: int) -> bool:
-    with Session(engine) as session:  # type: ignore[attr-defined]
+    with Session(get_engine()) as session:  # type: ignore[attr-defined]
         swap_user = session.query(SwapUser).filter_by(user_id=user_id).one()
         return swap_user.giftee_id is not None
 
 
 def has_santa(user_id: int) -> bool:
-    with Session(engine) as session:  # type: ignore[attr-defined]
+    with Session(get_engine()) as session:  # type: ignore[attr-defined]
         swap_user = session.query(SwapUser).filter_by(user_id=user_id).one()
         return swap_user.santa_id is not None
 
 
 def get_santa(user_id: int) -> SwapUser | None:
-    with Session(engine) as session:  # type: ignore[attr-defined]
+    with Session(get_engine()) as session:  # type: ignore[attr-defined]
         return session.query(SwapUser).filter_by(giftee_id=user_id).one_or_none()  # type: ignore[no-any-return]
 
 
 def get_giftee(user_id: int) -> SwapUser | None:
-    with Session(engine) as session:  # type: ignore[attr-defined]
+    with Session(get_engine()) as session:  # type: ignore[attr-defined]
         # yes, this is how these work -- to get users giftee, we get the user who has this user as their santa
         return session.query(SwapUser).filter_by(santa_id=user_id).one_or_none()  # type: ignore[no-any-return]
 
 
 def has_set_gift(user_id: int) -> bool:
-    with Session(engine) as session:  # type: ignore[attr-defined]
+    with Session(get_engine()) as session:  # type: ignore[attr-defined]
         swap_user = session.query(SwapUser).filter_by(user_id=user_id).one()
         if swap_user.gift is None:
             return False
@@ -474,7 +1207,7 @@ def set_gift(user_id: int, gift: str) -> None:
     """
     This is how a user sets their gift, to tell their giftee what they're giving them
     """
-    with Session(engine) as session:  # type: ignore[attr-defined]
+    with Session(get_engine()) as session:  # type: ignore[attr-defined]
         swap_user = session.query(SwapUser).filter_by(user_id=user_id).one()
         assert len(gift) <= 4000, "Gift too long, must be less than 4000 characters"
         logger.info(f"User {user_id} set their gift for {swap_user.giftee_id}: {gift}")
@@ -484,7 +1217,7 @@ def set_gift(user_id: int, gift: str) -> None:
 
 
 def set_letterboxd(user_id: int, letterboxd: str) -> None:
-    with Session(engine) as session:  # type: ignore[attr-defined]
+    with Session(get_engine()) as session:  # type: ignore[attr-defined]
         swap_user = session.query(SwapUser).filter_by(user_id=user_id).one()
         assert (
             len(letterboxd) <= 64
@@ -496,13 +1229,13 @@ def set_letterboxd(user_id: int, letterboxd: str) -> None:
 
 
 def has_letter(user_id: int) -> bool:
-    with Session(engine) as session:  # type: ignore[attr-defined]
+    with Session(get_engine()) as session:  # type: ignore[attr-defined]
         swap_user = session.query(SwapUser).filter_by(user_id=user_id).one()
         return swap_user.letter is not None
 
 
 def has_gift(user_id: int) -> bool:
-    with Session(engine) as session:  # type: ignore[attr-defined]
+    with Session(get_engine()) as session:  # type: ignore[attr-defined]
         swap_user = session.query(SwapUser).filter_by(user_id=user_id).one()
         return swap_user.gift is not None
 
@@ -511,225 +1244,221 @@ def review_my_letter_embed(user_id: int) -> discord.Embed:
     """
     Read your own letter, to review
     """
-
-    with Session(engine) as session:  # type: ignore[attr-defined]
-        swapuser = session.query(SwapUser).filter_by(user_id=user_id).one()
-        if swapuser.letter is None:
-            logger.info(
-                f"User {user_id} tried to review their letter, but they haven't set it yet"
-            )
-            return discord.Embed(
-                title="You haven't set your letter yet!",
-                description="Use the `>letter` command to send your letter",
-            )
-
-    let = f"""Dear Santa,\n\n{swapuser.letter}\n\nLove, {swapuser.name}"""
-    embed = discord.Embed(title="You received a letter!", description=let)
-    return embed
+    return load_user_context(user_id).review_my_letter_embed()
 
 
 def review_my_gift_embed(user_id: int) -> discord.Embed:
-    with Session(engine) as session:  # type: ignore[attr-defined]
-        # read your own gift (what you sent as a recommendation), to review
-        swapuser = session.query(SwapUser).filter_by(user_id=user_id).one()
-        if swapuser.gift is None:
-            logger.info(
-                f"User {user_id} tried to review their gift, but they haven't set it yet"
-            )
-            return discord.Embed(
-                title="You haven't set your gift yet!",
-                description="Use the `>submit` command to set your gift",
-            )
-
-        # find the user who has this user as their santa
-        given_to = session.query(SwapUser).filter_by(santa_id=user_id).one_or_none()
-
-        if given_to is None:
-            logger.info(
-                f"User {user_id} tried to review their gift, but they haven't been assigned a giftee yet"
-            )
-            return discord.Embed(
-                title="You haven't been assigned a giftee yet!",
-                description="You'll have to wait for the swap to start",
-            )
-
-        gift = f"""Dear {given_to.name},\n\n{swapuser.gift}\n\nLove, Santa"""
-        embed = discord.Embed(title="You received a gift!", description=gift)
-        return embed
+    return load_user_context(user_id).review_my_gift_embed()
 
 
 def receive_gift_embed(user_id: int, raise_if_missing: bool = False) -> discord.Embed:
     """
     This is how a user receives their gift, to see what their santa recommended them
     """
-    with Session(engine) as session:  # type: ignore[attr-defined]
-        # to receive gift, find the user whose giftee is this user
-        santa_user = session.query(SwapUser).filter_by(giftee_id=user_id).one_or_none()
-        if santa_user is None:
-            logger.info(
-                f"User {user_id} tried to receive their gift, but they haven't been assigned a santa yet"
-            )
-            if raise_if_missing:
-                raise RuntimeError(
-                    "User tried to receive their gift, but they haven't been assigned a santa yet"
-                )
-            return discord.Embed(
-                title="You don't have a santa yet!",
-                description="If you joined late, you may get assigned one soon, or you'll have to wait for the next swap to start",
-            )
+    return load_user_context(user_id).receive_gift_embed(
+        raise_if_missing=raise_if_missing
+    )
 
-        match Swap.get_swap_period():
-            case SwapPeriod.JOIN:
-                logger.info(
-                    f"User {user_id} tried to receive their gift, but the swap hasn't started yet (currently in JOIN period)"
-                )
-                return discord.Embed(
-                    title="The swap hasn't started yet!",
-                    description="Once the 'swap' period has started, you can check again for your gift. If you haven't set your >letter yet, do so now!",
-                )
-            case SwapPeriod.SWAP:
-                logger.info(
-                    f"User {user_id} tried to receive their gift, but the swap hasn't started yet (currently in SWAP period)"
-                )
-                return discord.Embed(
-                    title="The swap hasn't started yet!",
-                    description="Once the 'watch' period starts, you can re-run this command to see your gift",
-                )
-            case _:
-                pass
 
-        if santa_user.gift is None:
-            logger.info(
-                f"User {user_id} tried to receive their gift, but their santa {santa_user.user_id} {santa_user.name} hasn't set it yet"
-            )
-            if raise_if_missing:
-                raise RuntimeError(
-                    "User tried to receive their gift, but their santa hasn't set it yet"
-                )
-            return discord.Embed(
-                title="You haven't received a gift yet!",
-                description="Please wait for your santa to send their gift. If the 'watch' period has already started, you can ask the mods to make sure your santa sent their gift",
-            )
+def read_giftee_letter(user_id: int) -> discord.Embed:
+    return load_user_context(user_id).read_giftee_letter()
 
-        my_swapuser = session.query(SwapUser).filter_by(user_id=user_id).one()
 
-        gift = f"""Dear {my_swapuser.name},\n\n{santa_user.gift}\n\nLove, Santa"""
+class SnapshotFiles(NamedTuple):
+    snapshot_id: str
+    export: str
 
-        embed = discord.Embed(title="You received a gift!", description=gift)
-        return embed
 
+def _stdlib_json_dumps(obj: Any) -> bytes:
+    return json.dumps(obj).encode("utf-8")
 
-def read_giftee_letter(user_id: int) -> discord.Embed:
-    with Session(engine) as session:  # type: ignore[attr-defined]
-        # read your giftee's letter, this is how you find out what they want
-        #
-        # 'their santa_id is my user id', so we read their letter
-        giftee_user = session.query(SwapUser).filter_by(santa_id=user_id).one_or_none()
-        if giftee_user is None:
-            logger.info(
-                f"User {user_id} tried to read their giftee's letter, but they haven't been assigned a giftee yet"
-            )
-            return discord.Embed(
-                title="You haven't been assigned a giftee yet!",
-                description="You'll have to wait for the swap to start. If you think this is a mistake, ask a mod to check",
-            )
 
-        if giftee_user.letter is None:
-            logger.info(
-                f"User {user_id} tried to read their giftee's letter, but their giftee {giftee_user.user_id} {giftee_user.name} hasn't set it yet"
-            )
-            return discord.Embed(
-                title="Your giftee hasn't set their letter yet!",
-                description="Wait for your giftee to set their letter",
-            )
+# use orjson if its installed, its a lot faster for large exports
+try:
+    import orjson
 
-        swap = Swap.get_swap()
+    _json_dumps: Callable[[Any], bytes] = orjson.dumps
+except ImportError:
+    _json_dumps = _stdlib_json_dumps
 
-        assert isinstance(swap.period, SwapPeriod)
-        match swap.period:
-            case SwapPeriod.JOIN:
-                logger.info(
-                    f"User {user_id} tried to read their giftee's letter, but the swap hasn't started yet (currently in JOIN period)"
-                )
-                return discord.Embed(
-                    title="The swap hasn't started yet!",
-                    description="Once the 'swap' period has started, you can check again for your giftee's letter",
-                )
-            case _:
-                pass
 
-        let = f"""Dear Santa,\n\n{giftee_user.letter}\n\nLove, {giftee_user.name}"""
-        embed = discord.Embed(title="Your giftee sent a letter!", description=let)
-        return embed
+def _open_export(path: str) -> tuple[str, io.BufferedIOBase]:
+    """
+    Open the JSON export for writing, compressed if BACKUP_COMPRESSION is set
+    """
+    compression = settings.BACKUP_COMPRESSION.lower()
+    if compression == "zstd":
+        try:
+            import zstandard  # type: ignore[import]
+        except ImportError:
+            logger.warning("zstandard is not installed, using gzip instead")
+            compression = "gzip"
+        else:
+            path += ".zst"
+            return path, zstandard.ZstdCompressor().stream_writer(open(path, "wb"))  # type: ignore[no-any-return]
+    if compression == "gzip":
+        path += ".gz"
+        return path, gzip.open(path, "wb")
+    if compression:
+        raise RuntimeError(f"Unknown BACKUP_COMPRESSION {compression}")
+    return path, open(path, "wb")
 
 
-def snapshot_database() -> None:
+def snapshot_database() -> SnapshotFiles:
+    """
+    Make a backup of the database, and a JSON export of the swap users
+
+    The backup is added to the deduplicating store in BACKUP_DIR (see backup_store.py),
+    and old backups are pruned with the BACKUP_KEEP_* settings.
+    The export is written one user at a time as rows are read, so memory use
+    doesn't grow with the size of the swap. This can take a while for large swaps,
+    so async code should run this on a separate thread (see async_db.snapshot_database)
+    """
     logger.info("Making backup of database...")
 
-    sqlite_backup(
-        settings.SQLITEDB_PATH,
-        os.path.join(settings.BACKUP_DIR, f"{int(time.time())}.sqlite"),
-    )
+    timestamp = int(time.time())
+    # a consistent copy of the database, which is then split into chunks by the store
+    database_path = os.path.join(settings.BACKUP_DIR, f".{timestamp}.sqlite.tmp")
+    sqlite_backup(settings.SQLITEDB_PATH, database_path)
 
     # make JSON export of swapuser data
 
-    with Session(engine) as session:  # type: ignore[attr-defined]
-        swapusers = session.query(SwapUser).all()
-
-        user_map = {}
-        for swapuser in swapusers:
-            user_map[swapuser.user_id] = swapuser
-
-        swapusers_json: dict[str, Any] = {
-            "exported_at": int(time.time()),
-            "banned": [u.user_id for u in session.query(Banned).all()],
-        }
-        swapuser_lst = []
-        for swapuser in swapusers:
-            if (
-                swapuser.santa_id is None
-                or swapuser.giftee_id is None
-                or swapuser.letter is None
-            ):
-                logger.info(
-                    f"User {swapuser.user_id} {swapuser.name} has not been assigned a santa or giftee yet, skipping"
+    santa = aliased(SwapUser)
+    giftee = aliased(SwapUser)
+    export_path, f = _open_export(
+        os.path.join(settings.BACKUP_DIR, f"{timestamp}.json")
+    )
+    with Session(get_engine()) as session, f:  # type: ignore[attr-defined]
+        banned = [user_id for (user_id,) in session.query(Banned.user_id)]
+        f.write(b'{"exported_at": ' + _json_dumps(timestamp))
+        f.write(b', "banned": ' + _json_dumps(banned))
+        f.write(b', "swapusers": [')
+
+        # users who haven't been assigned a santa or giftee yet, or who don't
+        # have a letter are skipped. the santa/giftee are outer joins, so a user
+        # whose santa/giftee row is missing is still exported, with a null name
+        rows = (
+            session.query(  # type: ignore[no-untyped-call]
+                SwapUser.id,
+                SwapUser.user_id,
+                SwapUser.name,
+                SwapUser.santa_id,
+                SwapUser.giftee_id,
+                santa.name,
+                giftee.name,
+                SwapUser.letter,
+                SwapUser.gift,
+                SwapUser.letterboxd_username,
+                santa.gift,
+                SwapUser.done_watching,
+            )
+            .outerjoin(santa, santa.user_id == SwapUser.santa_id)
+            .outerjoin(giftee, giftee.user_id == SwapUser.giftee_id)
+            .filter(
+                SwapUser.letter.is_not(None),  # type: ignore[attr-defined]
+                SwapUser.santa_id.is_not(None),  # type: ignore[attr-defined]
+                SwapUser.giftee_id.is_not(None),  # type: ignore[attr-defined]
+            )
+            .order_by(SwapUser.id)
+            .yield_per(500)
+        )
+        exported = 0
+        for row in rows:
+            if exported > 0:
+                f.write(b",")
+            f.write(b"\n")
+            f.write(
+                _json_dumps(
+                    {
+                        "id": row[0],  # internal id
+                        "user_id": row[1],  # discord user id
+                        "name": row[2],
+                        "santa_id": row[3],
+                        "giftee_id": row[4],
+                        "santa_name": row[5],
+                        "giftee_name": row[6],
+                        "letter": row[7],
+                        "gave_gift": row[8],
+                        "letterboxd": row[9],
+                        "received_gift": row[10],
+                        "done": row[11],
+                    }
                 )
-                continue
-            swapuser_lst.append(
-                {
-                    "id": swapuser.id,  # internal id
-                    "user_id": swapuser.user_id,  # discord user id
-                    "name": swapuser.name,
-                    "santa_id": swapuser.santa_id,
-                    "giftee_id": swapuser.giftee_id,
-                    "santa_name": (
-                        user_map[swapuser.santa_id].name
-                        if swapuser.santa_id is not None
-                        else None
-                    ),
-                    "giftee_name": (
-                        user_map[swapuser.giftee_id].name
-                        if swapuser.giftee_id is not None
-                        else None
-                    ),
-                    "letter": swapuser.letter,
-                    "gave_gift": swapuser.gift,
-                    "letterboxd": swapuser.letterboxd_username,
-                    "received_gift": user_map[swapuser.santa_id].gift,
-                    "done": swapuser.done_watching,
-                }
             )
+            exported += 1
+        f.write(b"\n]}\n")
+
+    logger.info(f"Exported {exported} matched users to {export_path}")
+
+    store = BackupStore(settings.BACKUP_DIR)
+    store.import_legacy()
+    try:
+        snapshot_id = store.add(database_path, export=os.path.basename(export_path))
+    finally:
+        os.remove(database_path)
+    store.prune(
+        keep_last=settings.BACKUP_KEEP_LAST,
+        keep_daily=settings.BACKUP_KEEP_DAILY,
+        keep_weekly=settings.BACKUP_KEEP_WEEKLY,
+        keep_monthly=settings.BACKUP_KEEP_MONTHLY,
+    )
+    return SnapshotFiles(snapshot_id=snapshot_id, export=export_path)
+
+
+def sqlite_pragmas() -> dict[str, str | int]:
+    """
+    The PRAGMAs set on each connection, from the SQLITE_* settings
+    """
+    pragmas: dict[str, str | int] = {
+        "journal_mode": settings.SQLITE_JOURNAL_MODE,
+        "synchronous": settings.SQLITE_SYNCHRONOUS,
+        "cache_size": settings.SQLITE_CACHE_SIZE,
+        "mmap_size": settings.SQLITE_MMAP_SIZE,
+        "busy_timeout": settings.SQLITE_BUSY_TIMEOUT,
+        "temp_store": settings.SQLITE_TEMP_STORE,
+    }
+    return {name: value for name, value in pragmas.items() if value != ""}
+
+
+def create_sqlite_engine(path: str, pragmas: dict[str, str | int]) -> Engine:
+    eng = create_engine(
+        f"sqlite:///{path}",
+        echo=settings.SQL_ECHO,
+        pool_size=settings.SQLITE_POOL_SIZE,
+    )
 
-        swapusers_json["swapusers"] = swapuser_lst
+    def _set_pragmas(dbapi_connection: Any, connection_record: Any) -> None:
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
 
-    with open(os.path.join(settings.BACKUP_DIR, f"{int(time.time())}.json"), "w") as f:
-        json.dump(swapusers_json, f, indent=4)
+    event.listen(eng, "connect", _set_pragmas)  # type: ignore[no-untyped-call]
+    return eng
 
 
-# sqlite database which stores data
-engine = create_engine(
-    f"sqlite:///{settings.SQLITEDB_PATH}",
-    echo=settings.SQL_ECHO,
-)
+# sqlite database which stores data, created by init_db
+_engine: Engine | None = None
+_engine_lock = threading.Lock()
+
 
-metadata.create_all(engine)
+def init_db() -> Engine:
+    """
+    Create the engine for the sqlite database, and any tables which don't exist yet
+
+    This is called once at startup, so importing this module doesn't touch the database
+    """
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            engine = create_sqlite_engine(settings.SQLITEDB_PATH, sqlite_pragmas())
+            metrics.instrument_engine(engine, Session)
+            metadata.create_all(engine)
+            _engine = engine
+    return _engine
+
+
+def get_engine() -> Engine:
+    if _engine is None:
+        return init_db()
+    return _engine
@@ -0,0 +1,227 @@
+"""
+Sends DMs to many users at once, e.g. everyone's letters when the swap starts
+
+Up to DM_CONCURRENCY DMs are in flight at a time. discord.py already waits
+out each route's rate limit bucket (from the X-RateLimit-* headers) before
+sending, so this just keeps enough requests queued to use the whole budget.
+Requests which still fail with a 429 or a server error are retried, waiting
+for the Retry-After/X-RateLimit-Reset-After headers if the response had them,
+or an exponential backoff if not. Users who can't be sent a DM (they left,
+or have DMs disabled) are not retried
+
+DM channels are looked up through the shared user cache (see user_cache.py)
+"""
+
+from __future__ import annotations
+import time
+import random
+import asyncio
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, NamedTuple
+
+import aiohttp
+import discord
+from logzero import logger  # type: ignore[import]
+
+from .settings import settings
+from . import metrics
+from .user_cache import get_user_cache
+
+# returns the kwargs for Messageable.send, or None to skip this user
+Payload = Callable[[], Awaitable[dict[str, Any] | None]]
+
+
+class DMResult(NamedTuple):
+    # 'sent', 'skipped' or 'failed'
+    status: str
+    error: str | None = None
+
+
+@dataclass(frozen=True)
+class DM:
+    user_id: int
+    payload: Payload
+    # for logs, e.g. 'letter'
+    description: str = "message"
+    # called once this DM has been sent, skipped or has failed
+    on_result: Callable[[DMResult], Awaitable[None]] | None = None
+
+
+@dataclass
+class DispatchStats:
+    total: int
+    sent: int = 0
+    skipped: int = 0
+    retries: int = 0
+    failed: list[int] = field(default_factory=list)
+    started_at: float = field(default_factory=time.monotonic)
+
+    @property
+    def done(self) -> int:
+        return self.sent + self.skipped + len(self.failed)
+
+    def summary(self) -> str:
+        elapsed = time.monotonic() - self.started_at
+        text = f"{self.done}/{self.total} done in {elapsed:.0f}s: {self.sent} sent, {self.skipped} skipped, {len(self.failed)} failed"
+        if self.retries:
+            text += f" ({self.retries} retries)"
+        return text
+
+
+Progress = Callable[[DispatchStats], Awaitable[None]]
+
+
+def _retry_after(e: discord.HTTPException) -> float | None:
+    headers = getattr(e.response, "headers", None)
+    if not headers:
+        return None
+    for header in ("Retry-After", "X-RateLimit-Reset-After"):
+        value = headers.get(header)
+        if value is not None:
+            try:
+                return float(value)
+            except ValueError:
+                pass
+    return None
+
+
+def _backoff(attempt: int) -> float:
+    # 1, 2, 4, 8... seconds, with jitter so retries don't all land at once
+    return float(min(2**attempt, 60)) * (0.5 + random.random())
+
+
+class DMDispatcher:
+    def __init__(
+        self,
+        bot: discord.Client,
+        concurrency: int | None = None,
+        max_retries: int | None = None,
+    ) -> None:
+        self.users = get_user_cache(bot)
+        self.concurrency = concurrency or settings.DM_CONCURRENCY
+        self.max_retries = (
+            settings.DM_MAX_RETRIES if max_retries is None else max_retries
+        )
+
+    async def _send(self, dm: DM, stats: DispatchStats) -> DMResult:
+        kwargs = await dm.payload()
+        if kwargs is None:
+            return DMResult("skipped")
+        error = ""
+        for attempt in range(self.max_retries + 1):
+            try:
+                channel = await self.users.dm_channel(dm.user_id)
+                await channel.send(**kwargs)
+                return DMResult("sent")
+            except (discord.Forbidden, discord.NotFound) as e:
+                self.users.invalidate(dm.user_id)
+                logger.info(f"Cannot send {dm.description} to {dm.user_id}: {e}")
+                return DMResult("failed", str(e))
+            except discord.RateLimited as e:
+                error = str(e)
+                delay = e.retry_after
+            except discord.HTTPException as e:
+                error = str(e)
+                if e.status != 429 and e.status < 500:
+                    logger.warning(
+                        f"Error sending {dm.description} to {dm.user_id}: {e}"
+                    )
+                    return DMResult("failed", error)
+                delay = _retry_after(e) or _backoff(attempt)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = str(e) or type(e).__name__
+                logger.warning(f"Error sending {dm.description} to {dm.user_id}: {e}")
+                delay = _backoff(attempt)
+            if attempt == self.max_retries:
+                break
+            stats.retries += 1
+            metrics.dm_retries.inc()
+            logger.info(
+                f"Retrying {dm.description} to {dm.user_id} in {delay:.1f}s (attempt {attempt + 1})"
+            )
+            await asyncio.sleep(delay)
+        logger.warning(
+            f"Giving up sending {dm.description} to {dm.user_id} after {self.max_retries + 1} attempts"
+        )
+        return DMResult("failed", error)
+
+    async def run(
+        self, dms: list[DM], progress: Progress | None = None
+    ) -> DispatchStats:
+        stats = DispatchStats(total=len(dms))
+        metrics.dms_pending.inc(len(dms))
+        queue: asyncio.Queue[DM] = asyncio.Queue()
+        for dm in dms:
+            queue.put_nowait(dm)
+
+        async def worker() -> None:
+            while not queue.empty():
+                dm = queue.get_nowait()
+                try:
+                    result = await self._send(dm, stats)
+                except Exception as e:
+                    # e.g. building the payload failed
+                    logger.exception(
+                        f"Error sending {dm.description} to {dm.user_id}: {e}",
+                        exc_info=True,
+                    )
+                    result = DMResult("failed", str(e))
+                metrics.dms_pending.dec()
+                metrics.dms.inc(kind=dm.description, status=result.status)
+                if result.status == "sent":
+                    stats.sent += 1
+                elif result.status == "skipped":
+                    stats.skipped += 1
+                else:
+                    stats.failed.append(dm.user_id)
+                if dm.on_result is not None:
+                    await dm.on_result(result)
+                if progress is not None:
+                    await progress(stats)
+
+        await asyncio.gather(
+            *(worker() for _ in range(min(self.concurrency, len(dms))))
+        )
+        logger.info(f"Finished sending DMs, {stats.summary()}")
+        return stats
+
+
+class ProgressMessage:
+    """
+    A DM to an admin, edited with the progress of a dispatch every few seconds
+    """
+
+    def __init__(
+        self, user: discord.abc.Messageable, label: str, interval: float = 5.0
+    ) -> None:
+        self.user = user
+        self.label = label
+        self.interval = interval
+        self.message: discord.Message | None = None
+        self.last_update = 0.0
+
+    def _text(self, stats: DispatchStats) -> str:
+        return f"{self.label}: {stats.summary()}"
+
+    async def __call__(self, stats: DispatchStats) -> None:
+        now = time.monotonic()
+        if self.message is not None and now - self.last_update < self.interval:
+            return
+        self.last_update = now
+        await self._show(self._text(stats))
+
+    async def finish(self, stats: DispatchStats) -> None:
+        text = self._text(stats)
+        if stats.failed:
+            text += "\nCould not send to: " + ", ".join(map(str, stats.failed))
+        await self._show(text[:2000])
+
+    async def _show(self, text: str) -> None:
+        try:
+            if self.message is None:
+                self.message = await self.user.send(text)
+            else:
+                await self.message.edit(content=text)
+        except discord.HTTPException as e:
+            # progress is just informational, don't stop sending because of it
+            logger.warning(f"Could not update progress message: {e}")
@@ -0,0 +1,287 @@
+"""
+Schedules every request the bot makes to the discord REST API
+
+Requests have a priority, from the context they're made in (see api_priority):
+
+  INTERACTION - anything done while handling a command, the default
+  RELAY       - messages between santas and giftees
+  BULK        - sending letters/gifts, and draining the outbox
+  MAINTENANCE - background jobs, like updating usernames
+
+At most API_CONCURRENCY requests are in flight, and waiting requests are
+started highest priority first. API_RESERVED_SLOTS of those are kept for
+INTERACTION and RELAY requests, so a large batch can't hold up commands.
+Each route (e.g. 'POST /channels/{channel_id}/messages') also has a budget of
+requests per second, API_ROUTE_RATE unless it's set in API_ROUTE_RATES, so
+batches are paced to stay under discord's limits instead of running into 429s.
+If discord.py gives up on a request after a 429, the route is held back for
+the response's Retry-After
+
+Responses to interactions use the interaction's webhook, not bot.http, so they
+never wait here
+
+The queue depth and wait times for each priority are shown in the 'info' command
+"""
+
+from __future__ import annotations
+import time
+import heapq
+import enum
+import asyncio
+import contextvars
+import functools
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any, Iterator
+
+import discord
+from logzero import logger  # type: ignore[import]
+
+from .settings import settings
+from . import metrics
+
+
+class Priority(enum.IntEnum):
+    INTERACTION = 0
+    RELAY = 1
+    BULK = 2
+    MAINTENANCE = 3
+
+
+_priority: contextvars.ContextVar[Priority] = contextvars.ContextVar(
+    "api_priority", default=Priority.INTERACTION
+)
+
+
+@contextmanager
+def api_priority(priority: Priority) -> Iterator[None]:
+    """
+    Requests made inside this block (and tasks started from it) have this priority
+    """
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class _Bucket:
+    """
+    A token bucket, allowing 'rate' requests per second, with bursts of up to 'rate'
+    """
+
+    def __init__(self, rate: float) -> None:
+        self.rate = rate
+        self.capacity = max(rate, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """
+        Seconds until a request can be made, 0 if one can be made now
+        """
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+    def pause(self, seconds: float, now: float) -> None:
+        """
+        Don't allow another request for 'seconds'
+        """
+        self._refill(now)
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+
+def _retry_after(e: discord.HTTPException) -> float:
+    try:
+        return float(e.response.headers["Retry-After"])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return 1.0
+
+
+@dataclass
+class PriorityStats:
+    requests: int = 0
+    waiting: int = 0
+    max_waiting: int = 0
+    total_wait: float = 0.0
+    max_wait: float = 0.0
+
+    def __str__(self) -> str:
+        avg = self.total_wait / self.requests if self.requests else 0.0
+        return f"{self.requests} requests, {self.waiting} waiting (max {self.max_waiting}), wait avg {avg:.2f}s max {self.max_wait:.2f}s"
+
+
+class Governor:
+    def __init__(
+        self,
+        concurrency: int | None = None,
+        reserved: int | None = None,
+        route_rate: float | None = None,
+        route_rates: dict[str, float] | None = None,
+    ) -> None:
+        self.concurrency = concurrency or settings.API_CONCURRENCY
+        reserved = settings.API_RESERVED_SLOTS if reserved is None else reserved
+        # how many requests of each priority can be in flight at once
+        self._limits = {
+            priority: (
+                self.concurrency
+                if priority <= Priority.RELAY
+                else max(self.concurrency - reserved, 1)
+            )
+            for priority in Priority
+        }
+        self.route_rate = route_rate or settings.API_ROUTE_RATE
+        self.route_rates = (
+            settings.API_ROUTE_RATES if route_rates is None else route_rates
+        )
+        self._buckets: dict[str, _Bucket] = {}
+        # (priority, order added, route key, future)
+        self._waiting: list[tuple[int, int, str, asyncio.Future[None]]] = []
+        self._counter = 0
+        self._active = 0
+        self._timer: asyncio.TimerHandle | None = None
+        self.stats = {priority: PriorityStats() for priority in Priority}
+
+    def _bucket(self, key: str) -> _Bucket:
+        if key not in self._buckets:
+            self._buckets[key] = _Bucket(self.route_rates.get(key, self.route_rate))
+        return self._buckets[key]
+
+    def _dispatch(self) -> None:
+        """
+        Start as many waiting requests as there are free slots and route budget for
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        now = time.monotonic()
+        blocked: list[tuple[int, int, str, asyncio.Future[None]]] = []
+        retry_in: float | None = None
+        while self._waiting:
+            item = heapq.heappop(self._waiting)
+            priority, _, key, future = item
+            if future.done():
+                # cancelled while waiting
+                continue
+            if self._active >= self._limits[Priority(priority)]:
+                # lower priorities have the same or a lower limit, so nothing else can start
+                blocked.append(item)
+                break
+            wait = self._bucket(key).wait_time(now)
+            if wait > 0:
+                # this route is out of budget, others may not be
+                blocked.append(item)
+                retry_in = wait if retry_in is None else min(retry_in, wait)
+                continue
+            self._bucket(key).take()
+            self._active += 1
+            future.set_result(None)
+        for item in blocked:
+            heapq.heappush(self._waiting, item)
+        if retry_in is not None:
+            self._timer = asyncio.get_running_loop().call_later(
+                retry_in, self._dispatch
+            )
+
+    async def acquire(self, key: str) -> None:
+        priority = _priority.get()
+        stats = self.stats[priority]
+        loop = asyncio.get_running_loop()
+        future: asyncio.Future[None] = loop.create_future()
+        self._counter += 1
+        heapq.heappush(self._waiting, (priority, self._counter, key, future))
+        stats.waiting += 1
+        stats.max_waiting = max(stats.max_waiting, stats.waiting)
+        metrics.api_waiting.inc(priority=priority.name.lower())
+        start = time.monotonic()
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # was given a slot just before being cancelled
+                self.release()
+            raise
+        finally:
+            stats.waiting -= 1
+            metrics.api_waiting.dec(priority=priority.name.lower())
+        waited = time.monotonic() - start
+        metrics.api_wait_seconds.observe(waited, priority=priority.name.lower())
+        stats.requests += 1
+        stats.total_wait += waited
+        stats.max_wait = max(stats.max_wait, waited)
+        if waited > 5:
+            logger.info(f"{priority.name} request to {key} waited {waited:.1f}s")
+
+    def release(self) -> None:
+        self._active -= 1
+        self._dispatch()
+
+    def rate_limited(self, key: str, retry_after: float) -> None:
+        """
+        Hold back requests to this route, discord said to wait 'retry_after' seconds
+        """
+        logger.warning(f"Rate limited on {key}, waiting {retry_after:.1f}s")
+        self._bucket(key).pause(retry_after, time.monotonic())
+
+    def install(self, bot: discord.Client) -> None:
+        """
+        Send all of the bots REST requests through this governor
+        """
+        request = bot.http.request
+
+        @functools.wraps(request)
+        async def governed_request(route: Any, **kwargs: Any) -> Any:
+            await self.acquire(route.key)
+            start = time.perf_counter()
+            status = "ok"
+            try:
+                return await request(route, **kwargs)
+            except discord.HTTPException as e:
+                status = str(e.status)
+                if e.status == 429:
+                    self.rate_limited(route.key, _retry_after(e))
+                raise
+            except Exception:
+                status = "error"
+                raise
+            finally:
+                self.release()
+                metrics.discord_requests.inc(
+                    route=route.key,
+                    priority=_priority.get().name.lower(),
+                    status=status,
+                )
+                metrics.discord_request_seconds.observe(
+                    time.perf_counter() - start, route=route.key
+                )
+
+        bot.http.request = governed_request  # type: ignore[method-assign]
+
+    def summary(self) -> str:
+        return "\n".join(
+            f"{priority.name.lower()}: {self.stats[priority]}" for priority in Priority
+        )
+
+
+_governor: Governor | None = None
+
+
+def install_governor(bot: discord.Client) -> Governor:
+    global _governor
+    _governor = Governor()
+    _governor.install(bot)
+    return _governor
+
+
+def get_governor() -> Governor | None:
+    return _governor
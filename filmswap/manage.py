@@ -5,71 +5,159 @@ import io
 import os
 import calendar
 import datetime
-import random
-from pathlib import Path
-from typing import Literal
-
-import networkx as nx  # type: ignore[import]
-import matplotlib.pyplot as plt  # type: ignore[import]
+import tempfile
+from typing import IO, Any, Literal, NamedTuple
 
 import discord
 from discord.ext import commands
 
 from logzero import logger  # type: ignore[import]
+from sqlalchemy import and_, bindparam, case, func, literal, union_all, update
 
 from gettext import gettext as _
 from .settings import settings
 from .db import (
-    snapshot_database,
+    Banned,
+    OutboxStatus,
     Session,
     SwapPeriod,
-    Swap,
-    Banned,
+    SwapUser,
+    current_round,
+    enqueue_dms,
+    get_engine,
+)
+from .async_db import (
+    run_sync,
+    snapshot_database,
+    get_swap,
+    create_swap,
+    set_swap_period,
+    set_swap_channel,
+    save_join_button_message_id,
+    match_users,
+    unmatch_users,
+    block_pair,
+    unblock_pair,
     get_santa,
     get_giftee,
-    read_giftee_letter,
-    receive_gift_embed,
     ban_user,
     unban_user,
     join_swap,
     restore_letter,
     set_gift_done,
-    engine,
-    SwapUser,
+    outbox_status,
+    period_outbox_status,
+    reset_outbox,
 )
+from .pairing_graph import PairingGraph
+from .reveal import plan_jobs, render_png
+from .dispatch import DispatchStats, ProgressMessage
+from .outbox import get_sender
+from .user_cache import get_user_cache
+from .governor import get_governor
+from .query_log import top_queries
+from .metrics import track_command
 from ._types import ClientT
 
 DISABLE_UNMATCH = True
 
 
 def list_users() -> list[SwapUser]:
-    with Session(engine) as session:  # type: ignore[attr-defined]
+    with Session(get_engine()) as session:  # type: ignore[attr-defined]
         return session.query(SwapUser).all()  # type: ignore[no-any-return]
 
 
-def havent_set_letter() -> list[SwapUser]:
-    with Session(engine) as session:  # type: ignore[attr-defined]
-        return session.query(SwapUser).filter_by(letter=None).all()  # type: ignore[no-any-return]
-
-
-def havent_submitted_gift() -> list[SwapUser]:
-    with Session(engine) as session:  # type: ignore[attr-defined]
-        return session.query(SwapUser).filter_by(gift=None).filter(SwapUser.letter.is_not(None)).all()  # type: ignore[no-any-return,attr-defined]
-
-
-def users_without_giftees() -> list[SwapUser]:
-    with Session(engine) as session:  # type: ignore[attr-defined]
-        return session.query(SwapUser).filter_by(giftee_id=None).filter(SwapUser.letter.is_not(None)).all()  # type: ignore[no-any-return,attr-defined]
-
-
-def users_without_santas() -> list[SwapUser]:
-    with Session(engine) as session:  # type: ignore[attr-defined]
-        return session.query(SwapUser).filter_by(santa_id=None).filter(SwapUser.letter.is_not(None)).all()  # type: ignore[no-any-return,attr-defined]
-
+class SwapCounts(NamedTuple):
+    users: int
+    without_letters: int
+    # the rest only count users who have letters
+    without_gifts: int
+    not_done_watching: int
+    without_giftees: int
+    without_santas: int
+    banned: int
+
+
+def swap_counts() -> SwapCounts:
+    """
+    Count each kind of user for /filmswap-manage info, in a single query
+    """
+
+    def count_if(*criteria: Any) -> Any:
+        return func.coalesce(func.sum(case((and_(*criteria), 1), else_=0)), 0)  # type: ignore[arg-type]
+
+    has_letter = SwapUser.letter.is_not(None)  # type: ignore[attr-defined]
+    with Session(get_engine()) as session:  # type: ignore[attr-defined]
+        row = session.query(
+            func.count(SwapUser.id),
+            count_if(SwapUser.letter.is_(None)),  # type: ignore[no-untyped-call]
+            count_if(has_letter, SwapUser.gift.is_(None)),  # type: ignore[no-untyped-call]
+            count_if(has_letter, SwapUser.done_watching.is_(False)),  # type: ignore[no-untyped-call]
+            count_if(has_letter, SwapUser.giftee_id.is_(None)),  # type: ignore[no-untyped-call]
+            count_if(has_letter, SwapUser.santa_id.is_(None)),  # type: ignore[no-untyped-call]
+            session.query(func.count(Banned.user_id)).scalar_subquery(),  # type: ignore[attr-defined]
+        ).one()
+    return SwapCounts(*row)
+
+
+def write_info_report(f: IO[bytes], counts: SwapCounts) -> None:
+    """
+    Write the /filmswap-manage info report to f
+
+    Each category is one branch of a UNION ALL, so the report is written as the
+    rows are read, in category order, instead of loading every list first
+    """
+    headers = [
+        f"**{counts.users}** users are in the swap",
+        f"**{counts.without_letters}** users have not submitted letters",
+        f"**{counts.without_gifts}** users [who have letters] have not submitted gifts",
+        f"**{counts.not_done_watching}** users [who have letters] have not set /done-watching",
+        f"**{counts.without_giftees}** users [who have letters] do not have giftees",
+        f"**{counts.without_santas}** users [who have letters] do not have santas",
+        f"**{counts.banned}** users are banned",
+    ]
+    has_letter = SwapUser.letter.is_not(None)  # type: ignore[attr-defined]
+    with Session(get_engine()) as session:  # type: ignore[attr-defined]
+
+        def users(category: int, *criteria: Any) -> Any:
+            return (
+                session.query(
+                    literal(category).label("category"),
+                    SwapUser.user_id,
+                    SwapUser.name,
+                )
+                .filter(*criteria)
+                .statement
+            )
 
-def users_not_done_watching() -> list[SwapUser]:
-    with Session(engine) as session:  # type: ignore[attr-defined]
-        return session.query(SwapUser).filter_by(done_watching=False).filter(SwapUser.letter.is_not(None)).all()  # type: ignore[no-any-return,attr-defined]
+        report = union_all(  # type: ignore[no-untyped-call]
+            users(0),
+            users(1, SwapUser.letter.is_(None)),  # type: ignore[no-untyped-call]
+            users(2, has_letter, SwapUser.gift.is_(None)),  # type: ignore[no-untyped-call]
+            users(3, has_letter, SwapUser.done_watching.is_(False)),  # type: ignore[no-untyped-call]
+            users(4, has_letter, SwapUser.giftee_id.is_(None)),  # type: ignore[no-untyped-call]
+            users(5, has_letter, SwapUser.santa_id.is_(None)),  # type: ignore[no-untyped-call]
+            session.query(literal(6), Banned.user_id, literal(None)).statement,
+        ).order_by("category", "user_id")
+
+        def write_header(category: int) -> None:
+            if category > 0:
+                f.write(os.linesep.encode("utf-8"))
+            f.write(f"{headers[category]}{os.linesep}{os.linesep}".encode("utf-8"))
+
+        # write the header for each category as we reach it, including ones with no users
+        written = 0
+        for category, user_id, name in session.execute(
+            report, execution_options={"yield_per": 500}
+        ):
+            while written <= category:
+                write_header(written)
+                written += 1
+            line = f"{user_id}" if name is None else f"{user_id} {name}"
+            f.write(f"{line}{os.linesep}".encode("utf-8"))
+        while written < len(headers):
+            write_header(written)
+            written += 1
 
 
 def filter_emoji(s: str) -> str:
@@ -104,12 +192,17 @@ class JoinSwapButton(discord.ui.View):
     async def join_swap(
         self, interaction: discord.Interaction[ClientT], button: discord.ui.Button  # type: ignore[type-arg]
     ) -> None:
+        # button callbacks don't go through the command tree, so aren't timed by it
+        with track_command("join button"):
+            await self._join_swap(interaction)
+
+    async def _join_swap(self, interaction: discord.Interaction[ClientT]) -> None:
         logger.info(
             f"User {interaction.user.id} {interaction.user.display_name} clicked button to join swap"
         )
 
         try:
-            join_swap(interaction.user.id, interaction.user.display_name)
+            await join_swap(interaction.user.id, interaction.user.display_name)
         except Exception as e:
             logger.exception(e, exc_info=True)
             await interaction.response.send_message(str(e), ephemeral=True)
@@ -124,7 +217,7 @@ class JoinSwapButton(discord.ui.View):
             )
         )
 
-        if restore_letter(interaction.user.id):
+        if await restore_letter(interaction.user.id):
             await interaction.user.send(
                 "Your old letter has been restored, you can use `/review-letter` to read it, or >letter to update it"
             )
@@ -173,37 +266,107 @@ async def error_if_not_admin(interaction: discord.Interaction[ClientT]) -> bool:
     return False
 
 
-async def update_usernames(guild: discord.Guild) -> None:
-    logger.info("Starting to update usernames...")
-    with Session(engine) as session:  # type: ignore[attr-defined]
-        users = session.query(SwapUser).all()
-        logger.info(f"Checking usernames for {len(users)} users...")
-        for user in users:
+def _list_usernames() -> list[tuple[int, str]]:
+    with Session(get_engine()) as session:  # type: ignore[attr-defined]
+        return session.query(SwapUser.user_id, SwapUser.name).all()  # type: ignore[no-any-return]
+
+
+def save_usernames(names: dict[int, str], left: list[int]) -> None:
+    """
+    Rename users, and remove the letters of users who left the server, in one transaction
+    """
+    if not names and not left:
+        return
+    with Session(get_engine()) as session:  # type: ignore[attr-defined]
+        table = SwapUser.__table__
+        if names:
+            session.execute(
+                update(table)
+                .where(table.c.user_id == bindparam("b_user_id"))
+                .values(name=bindparam("b_name")),
+                [{"b_user_id": uid, "b_name": name} for uid, name in names.items()],
+            )
+        if left:
+            session.execute(
+                update(table)
+                .where(table.c.user_id == bindparam("b_user_id"))
+                .values(letter=None),
+                [{"b_user_id": uid} for uid in left],
+            )
+        session.commit()
+
+
+async def _guild_members(
+    guild: discord.Guild, user_ids: list[int]
+) -> tuple[dict[int, discord.Member], set[int]]:
+    """
+    Look up members from the gateway member cache, asking the gateway for any
+    which aren't cached, 100 at a time
+
+    Also returns the user IDs which couldn't be looked up because a query
+    failed, so those aren't mistaken for users who left
+    """
+    if not guild.chunked:
+        try:
+            await guild.chunk()
+        except Exception as e:
+            logger.warning(f"Could not request guild members, querying instead: {e}")
+    members: dict[int, discord.Member] = {}
+    missing: list[int] = []
+    for user_id in user_ids:
+        member = guild.get_member(user_id)
+        if member is not None:
+            members[user_id] = member
+        else:
+            missing.append(user_id)
+    failed: set[int] = set()
+    if missing and not guild.chunked:
+        for i in range(0, len(missing), 100):
+            batch = missing[i : i + 100]
             try:
-                member = await guild.fetch_member(user.user_id)
-            except discord.NotFound:
-                logger.info(
-                    f"Could not find member {user.user_id} {user.name}, setting letter to None and skipping"
-                )
-                user.letter = None
-                session.add(user)
+                found = await guild.query_members(user_ids=batch, cache=True)
+            except Exception as e:
+                logger.warning(f"Could not query {len(batch)} members, skipping: {e}")
+                failed.update(batch)
                 continue
+            for member in found:
+                members[member.id] = member
+    return members, failed
 
-            if member.display_name != user.name:
-                logger.info(
-                    f"Updating {user.user_id} {user.name} to {member.display_name}"
-                )
-            user.name = member.display_name
-            session.add(user)
 
-            await asyncio.sleep(0.5)
+async def update_usernames(guild: discord.Guild) -> None:
+    """
+    Make sure the names in the database match the server. Names are kept up to
+    date by the member events in bot.py, so this normally doesn't change anything
+    """
+    logger.info("Starting to update usernames...")
+    users = await run_sync(_list_usernames)
+    logger.info(f"Checking usernames for {len(users)} users...")
+    members, failed = await _guild_members(guild, [user_id for user_id, _ in users])
+    names: dict[int, str] = {}
+    left: list[int] = []
+    for user_id, name in users:
+        if user_id in failed:
+            # don't know if they're still in the server, check again next time
+            continue
+        member = members.get(user_id)
+        if member is None:
+            logger.info(
+                f"Could not find member {user_id} {name}, setting letter to None"
+            )
+            left.append(user_id)
+        elif member.display_name != name:
+            logger.info(f"Updating {user_id} {name} to {member.display_name}")
+            names[user_id] = member.display_name
 
-        session.commit()
+    await run_sync(save_usernames, names, left)
 
-    logger.info("Done updating usernames")
+    logger.info(
+        f"Done updating usernames, {len(names)} renamed, {len(left)} left, {len(failed)} not checked"
+    )
 
 
-async def _fix_connections_after_ban_or_leave(user_id: int, bot: commands.Bot) -> None:
+async def _fix_connections_after_ban_or_leave(user_id: int) -> None:
     # if the user is banned, we need to remove them from the swap
     # but this also means that if they had a santa/giftee, we need to fix the
     # dangling connections
@@ -219,8 +382,8 @@ async def _fix_connections_after_ban_or_leave(user_id: int, bot: commands.Bot) -
     # similarly, we should send a message to C saying that their santa was banned, and they
     # should receive their gift shortly (it might be after the watch period starts, but hopefully soon)
 
-    santa = get_santa(user_id)
-    giftee = get_giftee(user_id)
+    santa = await get_santa(user_id)
+    giftee = await get_giftee(user_id)
 
     if santa is None or giftee is None:
         raise RuntimeError(
@@ -233,13 +396,36 @@ async def _fix_connections_after_ban_or_leave(user_id: int, bot: commands.Bot) -
     assert isinstance(santa.user_id, int)
     assert isinstance(giftee.user_id, int)
 
-    with Session(engine) as session:  # type: ignore[attr-defined]
+    await run_sync(_reroute_pair, user_id, santa.user_id, giftee.user_id)
+
+    # we should confirm that the banned user ID appears *nowhere* in the swap
+    # if it does, then we have a bug
+    users = await run_sync(list_users)
+    for user in users:
+        assert user.user_id != user_id, f"User {user_id} still appears in the swap"
+        assert user.santa_id != user_id, f"User {user_id} still appears as a santa"
+        assert user.giftee_id != user_id, f"User {user_id} still appears as a giftee"
+
+    # and that everyone who is matched is still part of a cycle
+    decomposition = PairingGraph.from_users(
+        user for user in users if user.giftee_id is not None
+    ).decompose()
+    assert decomposition.is_valid, "\n".join(decomposition.problems())
+
+    # the messages to the santa and giftee were queued with the reroute
+    get_sender().wake()
+
+
+def _reroute_pair(
+    removed_user_id: int, santa_user_id: int, giftee_user_id: int
+) -> None:
+    with Session(get_engine()) as session:  # type: ignore[attr-defined]
         banned_user_santa = (
-            session.query(SwapUser).filter(SwapUser.user_id == santa.user_id).one()
+            session.query(SwapUser).filter(SwapUser.user_id == santa_user_id).one()
         )
 
         banned_user_giftee = (
-            session.query(SwapUser).filter(SwapUser.user_id == giftee.user_id).one()
+            session.query(SwapUser).filter(SwapUser.user_id == giftee_user_id).one()
         )
 
         # update the santas giftee to be the banned users user id
@@ -265,30 +451,32 @@ async def _fix_connections_after_ban_or_leave(user_id: int, bot: commands.Bot) -
         session.add(banned_user_santa)
         session.add(banned_user_giftee)
 
-        session.commit()
-
-    # we should confirm that the banned user ID appears *nowhere* in the swap
-    # if it does, then we have a bug
-    for user in list_users():
-        assert user.user_id != user_id, f"User {user_id} still appears in the swap"
-        assert user.santa_id != user_id, f"User {user_id} still appears as a santa"
-        assert user.giftee_id != user_id, f"User {user_id} still appears as a giftee"
-
-    # send message to new santa saying that their giftee was banned
-    # and they should run /read again to gift to their new giftee
-
-    santa_discord_user = await bot.fetch_user(santa.user_id)
-    await asyncio.sleep(1)
-    giftee_discord_user = await bot.fetch_user(giftee.user_id)
-    await asyncio.sleep(1)
+        # send message to new santa saying that their giftee was banned
+        # and they should run /read again to gift to their new giftee
+        round = current_round(session)
+        enqueue_dms(
+            session,
+            [
+                {
+                    "idempotency_key": f"giftee-removed:{round}:{removed_user_id}:{santa_user_id}",
+                    "user_id": santa_user_id,
+                    "kind": "reroute",
+                    "payload": {
+                        "content": "Your giftee was banned from the swap. You have been assigned a new giftee. Please run /read again to read their letter, and send them a gift.\nIf you're not able to set a gift, you can use >write-giftee to send a message to them instead"
+                    },
+                },
+                {
+                    "idempotency_key": f"santa-removed:{round}:{removed_user_id}:{giftee_user_id}",
+                    "user_id": giftee_user_id,
+                    "kind": "reroute",
+                    "payload": {
+                        "content": "Your santa was banned from the swap. You will receive your gift shortly, but it might be after the watch period starts. If you don't have it soon, feel free to mention it in the channel"
+                    },
+                },
+            ],
+        )
 
-    await santa_discord_user.send(
-        "Your giftee was banned from the swap. You have been assigned a new giftee. Please run /read again to read their letter, and send them a gift.\nIf you're not able to set a gift, you can use >write-giftee to send a message to them instead"
-    )
-    await asyncio.sleep(1)
-    await giftee_discord_user.send(
-        "Your santa was banned from the swap. You will receive your gift shortly, but it might be after the watch period starts. If you don't have it soon, feel free to mention it in the channel"
-    )
+        session.commit()
 
 
 # create group to manage swaps
@@ -306,7 +494,7 @@ class Manage(discord.app_commands.Group):
             return
 
         try:
-            Swap.create_swap()
+            await create_swap()
             await interaction.response.send_message(
                 "Created swap. Remember to run the 'set-channel' command to set the channel where the swap will take place",
                 ephemeral=True,
@@ -328,53 +516,29 @@ class Manage(discord.app_commands.Group):
         """
 
         if successfully_set_to == SwapPeriod.SWAP:
-            with Session(engine) as session:  # type: ignore[attr-defined]
-                users = session.query(SwapUser).all()
-                for user in users:
-                    logger.info(f"Sending {user.user_id} their giftees letter")
-                    if user.giftee_id is None:
-                        logger.info(
-                            f"Cannot send letter to {user.user_id} {user.name} as they have no giftee id"
-                        )
-                        continue
-                    try:
-                        letter_embed = read_giftee_letter(user.user_id)
-
-                        user_dm = await self.get_bot().fetch_user(user.user_id)
-                        await user_dm.send(embed=letter_embed)
-                        await asyncio.sleep(1)
-                    except Exception as e:
-                        logger.exception(
-                            f"Error sending letter to user {user.user_id}: {e}",
-                            exc_info=True,
-                        )
+            description = "letter"
         elif successfully_set_to == SwapPeriod.WATCH:
-            with Session(engine) as session:  # type: ignore[attr-defined]
-                users = session.query(SwapUser).all()
-                for user in users:
-                    logger.info(f"Sending {user.user_id} their santas gift")
-                    if user.giftee_id is None:
-                        logger.info(
-                            f"Cannot send gift to {user.user_id} {user.name} as they have no giftee id"
-                        )
-                        continue
-                    try:
-                        try:
-                            gift_embed = receive_gift_embed(
-                                user.user_id, raise_if_missing=True
-                            )
-                        except RuntimeError as e:
-                            logger.info(f"Error receiving gift for {user.user_id}: {e}")
-                            continue
-
-                        user_dm = await self.get_bot().fetch_user(user.user_id)
-                        await user_dm.send(embed=gift_embed)
-                        await asyncio.sleep(1)
-                    except Exception as e:
-                        logger.exception(
-                            f"Error sending gift to user {user.user_id}: {e}",
-                            exc_info=True,
-                        )
+            description = "gift"
+        else:
+            return
+
+        # the letters/gifts were added to the outbox when the period was set
+        progress = ProgressMessage(interaction.user, f"Sending {description}s")
+        stats = await get_sender().drain(progress)
+        # the background sender may have claimed some (or all) of them before this
+        # drain did, drain waits for it to finish, so report on all of this periods
+        # messages instead of just the ones this drain sent
+        counts, failed = await period_outbox_status(description)
+        await progress.finish(
+            DispatchStats(
+                total=sum(counts.values()),
+                sent=counts.get(OutboxStatus.SENT, 0),
+                skipped=counts.get(OutboxStatus.SKIPPED, 0),
+                retries=stats.retries,
+                failed=failed,
+                started_at=stats.started_at,
+            )
+        )
 
     @discord.app_commands.command(  # type: ignore[arg-type]
         name="set-period",
@@ -400,7 +564,7 @@ class Manage(discord.app_commands.Group):
             return
 
         try:
-            additional_message = Swap.set_swap_period(new_period)
+            additional_message = await set_swap_period(new_period)
         except Exception as e:
             logger.exception(e, exc_info=True)
             return await interaction.response.send_message(
@@ -460,14 +624,14 @@ class Manage(discord.app_commands.Group):
         logger.info(f"Admin {interaction.user.id} matching users")
 
         try:
-            Swap.match_users()
+            msg = await match_users()
         except Exception as e:
             logger.exception(e, exc_info=True)
             return await interaction.response.send_message(
                 f"Error: {e}", ephemeral=True
             )
 
-        await interaction.response.send_message("Matched all users", ephemeral=True)
+        await interaction.response.send_message(msg, ephemeral=True)
 
     @discord.app_commands.command(  # type: ignore[arg-type]
         name="unmatch-users",
@@ -488,7 +652,7 @@ class Manage(discord.app_commands.Group):
         logger.info(f"Admin {interaction.user.id} unmatching users")
 
         try:
-            Swap.unmatch_users()
+            await unmatch_users()
         except Exception as e:
             logger.exception(e, exc_info=True)
             return await interaction.response.send_message(
@@ -509,7 +673,7 @@ class Manage(discord.app_commands.Group):
         logger.info(f"Setting channel for swap to {channel}")
 
         try:
-            Swap.set_swap_channel(channel.id)
+            await set_swap_channel(channel.id)
         except Exception as e:
             logger.exception(e, exc_info=True)
             await interaction.response.send_message(f"Error: {e}", ephemeral=True)
@@ -532,7 +696,7 @@ class Manage(discord.app_commands.Group):
             return
 
         try:
-            swap_info = Swap.get_swap()
+            swap_info = await get_swap()
             if swap_info.swap_channel_discord_id is None:
                 logger.info("No channel set for swap")
                 await interaction.response.send_message(
@@ -551,7 +715,7 @@ class Manage(discord.app_commands.Group):
             )
 
             # save this so that it can become a persistent view
-            Swap.save_join_button_message_id(msg.id)
+            await save_join_button_message_id(msg.id)
 
             await interaction.response.send_message(
                 f"Sent message to channel {channel}", ephemeral=True
@@ -584,7 +748,7 @@ class Manage(discord.app_commands.Group):
         assert interaction.guild is not None
 
         try:
-            ban_user(user_id)
+            await ban_user(user_id)
         except Exception as e:
             logger.exception(e, exc_info=True)
             await interaction.response.send_message(f"Error: {e}", ephemeral=True)
@@ -595,12 +759,13 @@ class Manage(discord.app_commands.Group):
         )
 
         try:
-            await _fix_connections_after_ban_or_leave(user_id, self.get_bot())
+            await _fix_connections_after_ban_or_leave(user_id)
         except (RuntimeError, AssertionError) as e:
             logger.exception(e, exc_info=True)
             # send message to person who ran the command
-            user = await self.get_bot().fetch_user(interaction.user.id)
-            await user.send(f"Error: {e}")
+            users = get_user_cache(self.get_bot())
+            channel = await users.dm_channel(interaction.user.id)
+            await channel.send(f"Error: {e}")
             return
 
     @discord.app_commands.command(  # type: ignore[arg-type]
@@ -625,7 +790,7 @@ class Manage(discord.app_commands.Group):
         assert interaction.guild is not None
 
         try:
-            unban_user(user_id)
+            await unban_user(user_id)
         except Exception as e:
             logger.exception(e, exc_info=True)
             await interaction.response.send_message(f"Error: {e}", ephemeral=True)
@@ -635,6 +800,64 @@ class Manage(discord.app_commands.Group):
             f"Unbanned {user_id} from the swap", ephemeral=True
         )
 
+    @discord.app_commands.command(  # type: ignore[arg-type]
+        name="block-pair",
+        description="Never match these two users with each other",
+    )
+    async def block_pair(
+        self,
+        interaction: discord.Interaction[ClientT],
+        member: discord.Member,
+        other_member: discord.Member,
+    ) -> None:
+        if await error_if_not_admin(interaction):
+            return
+
+        logger.info(
+            f"Admin {interaction.user.id} blocking {member.id} and {other_member.id} from being matched"
+        )
+
+        try:
+            await block_pair(member.id, other_member.id)
+        except Exception as e:
+            logger.exception(e, exc_info=True)
+            await interaction.response.send_message(f"Error: {e}", ephemeral=True)
+            return
+
+        await interaction.response.send_message(
+            f"{member.display_name} and {other_member.display_name} won't be matched with each other",
+            ephemeral=True,
+        )
+
+    @discord.app_commands.command(  # type: ignore[arg-type]
+        name="unblock-pair",
+        description="Allow two users who were blocked from being matched to be matched again",
+    )
+    async def unblock_pair(
+        self,
+        interaction: discord.Interaction[ClientT],
+        member: discord.Member,
+        other_member: discord.Member,
+    ) -> None:
+        if await error_if_not_admin(interaction):
+            return
+
+        logger.info(
+            f"Admin {interaction.user.id} unblocking {member.id} and {other_member.id} from being matched"
+        )
+
+        try:
+            await unblock_pair(member.id, other_member.id)
+        except Exception as e:
+            logger.exception(e, exc_info=True)
+            await interaction.response.send_message(f"Error: {e}", ephemeral=True)
+            return
+
+        await interaction.response.send_message(
+            f"{member.display_name} and {other_member.display_name} can be matched with each other again",
+            ephemeral=True,
+        )
+
     _set_done_cmd_name = _("set-user-done-watching")
     _set_done_desc = _("Set /done-watching for a user")
 
@@ -652,7 +875,7 @@ class Manage(discord.app_commands.Group):
             return
 
         try:
-            set_gift_done(member.id)
+            await set_gift_done(member.id)
         except Exception as e:
             logger.exception(e, exc_info=True)
             await interaction.response.send_message(f"Error: {e}", ephemeral=True)
@@ -670,7 +893,7 @@ class Manage(discord.app_commands.Group):
             return
 
         try:
-            swap = Swap.get_swap()
+            swap = await get_swap()
         except Exception as e:
             logger.exception(e, exc_info=True)
             await interaction.response.send_message(f"Error: {e}", ephemeral=True)
@@ -687,65 +910,74 @@ class Manage(discord.app_commands.Group):
         assert isinstance(channel, discord.TextChannel) or channel is None
         embed.add_field(name="Channel", value=channel.mention if channel else "None")
 
-        all_users = list_users()
-        no_letters = havent_set_letter()
-        havent_submitted = havent_submitted_gift()
-        dont_have_parters = users_without_giftees()
-        dont_have_santas = users_without_santas()
-        not_done_watching = users_not_done_watching()
-        banned = Banned.list_banned()
+        counts = await run_sync(swap_counts)
 
-        embed.add_field(name="Users in Swap", value=f"{len(all_users)}")
-        embed.add_field(name="Users without letters", value=f"{len(no_letters)}")
+        embed.add_field(name="Users in Swap", value=f"{counts.users}")
+        embed.add_field(name="Users without letters", value=f"{counts.without_letters}")
         embed.add_field(
             name="Active users (have letters)",
-            value=f"{len(all_users) - len(no_letters)}",
+            value=f"{counts.users - counts.without_letters}",
         )
         embed.add_field(
             name="Active users without gifts",
-            value=f"{len(havent_submitted)}",
+            value=f"{counts.without_gifts}",
         )
         embed.add_field(
             name="Active users not done watching",
-            value=f"{len(not_done_watching)}",
+            value=f"{counts.not_done_watching}",
         )
-        embed.add_field(name="Banned users", value=f"{len(banned)}")
+        embed.add_field(name="Banned users", value=f"{counts.banned}")
+        embed.add_field(name="User cache", value=str(get_user_cache(bot).stats))
+        if (governor := get_governor()) is not None:
+            embed.add_field(name="API requests", value=governor.summary(), inline=False)
+        if slowest := top_queries(3):
+            # field values are limited to 1024 characters
+            value = "\n".join(f"`{sql[:150]}`: {stats}" for sql, stats in slowest)
+            embed.add_field(
+                name="Slowest queries (total time)", value=value[:1024], inline=False
+            )
 
         await interaction.response.send_message(embed=embed, ephemeral=True)
 
-        report = f"""**{len(all_users)}** users are in the swap
-
-{os.linesep.join(f'{user.user_id} {user.name}' for user in all_users)}
-
-**{len(no_letters)}** users have not submitted letters
-
-{os.linesep.join(f'{user.user_id} {user.name}' for user in no_letters)}
-
-**{len(havent_submitted)}** users [who have letters] have not submitted gifts
-
-{os.linesep.join(f'{user.user_id} {user.name}' for user in havent_submitted)}
-
-**{len(not_done_watching)}** users [who have letters] have not set /done-watching
-
-{os.linesep.join(f'{user.user_id} {user.name}' for user in not_done_watching)}
-
-**{len(dont_have_parters)}** users [who have letters] do not have giftees
-
-{os.linesep.join(f'{user.user_id} {user.name}' for user in dont_have_parters)}
-
-**{len(dont_have_santas)}** users [who have letters] do not have santas
-
-{os.linesep.join(f'{user.user_id} {user.name}' for user in dont_have_santas)}
+        # kept in memory unless the report is large
+        with tempfile.SpooledTemporaryFile(max_size=1024 * 1024) as f:
+            await run_sync(write_info_report, f, counts)
+            f.seek(0)
+            await interaction.user.send(file=discord.File(f, "report.txt"))  # type: ignore[arg-type]
 
-**{len(banned)}** users are banned
+    @discord.app_commands.command(  # type: ignore[arg-type]
+        name="outbox",
+        description="Show the status of DMs sent by the bot, or retry ones that failed",
+    )
+    async def outbox(
+        self, interaction: discord.Interaction[ClientT], retry_failed: bool = False
+    ) -> None:
+        if await error_if_not_admin(interaction):
+            return
 
-{os.linesep.join(f'{user.user_id}' for user in banned)}
-"""
+        try:
+            retried = await reset_outbox(OutboxStatus.FAILED) if retry_failed else 0
+            counts, failed = await outbox_status()
+        except Exception as e:
+            logger.exception(e, exc_info=True)
+            await interaction.response.send_message(f"Error: {e}", ephemeral=True)
+            return
 
-        with io.BytesIO() as f:
-            f.write(report.encode("utf-8"))
-            f.seek(0)
-            await interaction.user.send(file=discord.File(f, "report.txt"))
+        embed = discord.Embed(title="Outbox")
+        for status in OutboxStatus:
+            embed.add_field(
+                name=status.value.capitalize(), value=f"{counts.get(status, 0)}"
+            )
+        if retried:
+            embed.description = f"Retrying {retried} failed messages"
+            get_sender().wake()
+        elif failed:
+            embed.description = "Most recent failures:\n" + "\n".join(
+                f"{message.kind} to {message.user_id} after {message.attempts} attempts: {message.error}"
+                for message in failed
+            )
+            embed.description = embed.description[:4000]
+        await interaction.response.send_message(embed=embed, ephemeral=True)
 
     @discord.app_commands.command(  # type: ignore[arg-type]
         name="reveal", description="Reveal the connections between giftee/santas"
@@ -755,13 +987,14 @@ class Manage(discord.app_commands.Group):
         interaction: discord.Interaction[ClientT],
         format: Literal["text", "pretty", "graph"],
         graph_layout: Literal[
+            "cycles",
             "circle",
             "random",
             "kamada_kawai",
             "spring",
             "spectral",
             "randomize",  # as in, pick a random layout, don't use the "random" layout
-        ] = "spectral",
+        ] = "cycles",
         count: int = 1,
     ) -> None:
         logger.info(f"User {interaction.user.id} revealing connections -- {format}")
@@ -769,7 +1002,7 @@ class Manage(discord.app_commands.Group):
         if await error_if_not_admin(interaction):
             return
 
-        all_users = list_users()
+        all_users = await run_sync(list_users)
         users_with_both = [
             user for user in all_users if user.giftee_id and user.santa_id
         ]
@@ -789,7 +1022,7 @@ class Manage(discord.app_commands.Group):
         }
 
         bot = self.get_bot()
-        user_obj = await bot.fetch_user(interaction.user.id)
+        user_dm = await get_user_cache(bot).dm_channel(interaction.user.id)
 
         if format == "text":
             report = os.linesep.join(
@@ -802,38 +1035,20 @@ class Manage(discord.app_commands.Group):
                 await interaction.user.send(file=discord.File(f, "report.txt"))
 
         elif format == "pretty":
-            graph = nx.DiGraph()
-            for user in users_with_both:
-                assert user.giftee_id is not None
-                graph.add_edge(
-                    user.user_id,
-                    user.giftee_id,
-                )
-
-            # in case we had people who joined late, we need to check for multiple
-            # unconnected graphs
-            # iterate through the graph neighbours and create lists of each cycle
-            cycles = list(nx.simple_cycles(graph))
-            assert len(cycles) > 0, "No cycles found in graph"
+            # in case we had people who joined late, there may be multiple cycles
+            decomposition = PairingGraph.from_users(users_with_both).decompose()
+            assert len(decomposition.cycles) > 0, "No cycles found in graph"
 
             results = []
-            for cycle in cycles:
-                names = []
-                assert len(cycle) > 0, "Empty cycle found in graph"
-                # add the first user
-                names.append(id_to_names.get(cycle[0]))
-                for from_user in cycle:
-                    # get the user this was sent to
-                    to_user_list = list(graph.neighbors(from_user))
-                    assert (
-                        len(to_user_list) == 1
-                    ), "More than one neighbour found when generating links"
-                    to_user = id_to_names.get(to_user_list[0])
-                    assert (
-                        to_user is not None
-                    ), f"No user found for ID {to_user_list[0]}"
-                    names.append(to_user)
+            for cycle in decomposition.cycles:
+                # end with the first user, since the last user gifts to them
+                names = [id_to_names[user_id] for user_id in cycle + cycle[:1]]
                 results.append("➜".join([f"`{name}`" for name in names]))
+            if not decomposition.is_valid:
+                results.append(
+                    "WARNING: some users aren't in a cycle:\n"
+                    + "\n".join(decomposition.problems())
+                )
 
             report = (os.linesep * 2).join(results)
 
@@ -844,55 +1059,22 @@ class Manage(discord.app_commands.Group):
                 await interaction.user.send(file=discord.File(f, "pretty.txt"))
 
         else:
-            for _g in range(count):
-                graph = nx.DiGraph()
-                plt.clf()
-                for user in users_with_both:
-                    assert user.giftee_id is not None
-                    graph.add_edge(
-                        filter_emoji(user.name),
-                        filter_emoji(id_to_names[user.giftee_id]),
-                        color="red",
-                    )
-
-                options = {
-                    "node_color": "blue",
-                    "node_size": 1,
-                    "edge_color": "#a9a9a9",
-                    "width": 3,
-                    "arrowstyle": "-|>",
-                    "arrowsize": 13,
-                    "font_size": 8,
-                    "font_color": "black",
-                }
-
-                func = {
-                    "circle": nx.circular_layout,
-                    "random": nx.random_layout,
-                    "kamada_kawai": nx.kamada_kawai_layout,
-                    "spring": nx.spring_layout,
-                    "spectral": nx.spectral_layout,
-                }
-                if graph_layout in func:
-                    layout_name = graph_layout
-                    pos = func[graph_layout](graph)
-                elif graph_layout == "randomize":
-                    chosen_func = random.choice(list(func.values()))
-                    layout_name = chosen_func.__name__
-                    pos = chosen_func(graph)
-                else:
-                    return await interaction.response.send_message(
-                        f"Error: Unknown graph layout {graph_layout}", ephemeral=True
-                    )
-                nx.draw_networkx(graph, pos, arrows=True, **options)
-                plt.box(False)
-                with io.BytesIO() as f:
-                    plt.savefig(
-                        f, pad_inches=0.1, transparent=False, bbox_inches="tight"
-                    )
-                    f.seek(0)
-                    await user_obj.send(
-                        f"Reveal with {layout_name}",
+            decomposition = PairingGraph.from_users(users_with_both).decompose()
+            cycles = [
+                [filter_emoji(id_to_names[user_id]) for user_id in cycle]
+                for cycle in decomposition.cycles
+            ]
+            # users who aren't in a cycle are drawn as open chains
+            chains = [
+                [filter_emoji(id_to_names[user_id]) for user_id in chain]
+                for chain in decomposition.chains
+            ]
+            jobs = plan_jobs(cycles, chains, graph_layout, count)
+            images = await asyncio.gather(*(render_png(job) for job in jobs))
+            for job, png in zip(jobs, images):
+                with io.BytesIO(png) as f:
+                    await user_dm.send(
+                        f"Reveal with {job.layout} {job.title}".strip(),
                         file=discord.File(f, "reveal.png"),
                     )
 
@@ -905,18 +1087,18 @@ class Manage(discord.app_commands.Group):
         if await error_if_not_admin(interaction):
             return
 
-        snapshot_database()
-
-        files = Path(settings.BACKUP_DIR).glob("*.json")
-        latest = max(files, key=os.path.getmtime)
-
+        # the snapshot may take a while, so respond first
         await interaction.response.send_message(
-            "Saved database backup and JSON snapshot", ephemeral=True
+            "Saving database backup and JSON snapshot...", ephemeral=True
         )
 
+        snapshot = await snapshot_database()
+
         # send the JSON export
-        with open(latest, "rb") as f:
-            await interaction.user.send(file=discord.File(f, latest.name))
+        with open(snapshot.export, "rb") as f:
+            await interaction.user.send(
+                file=discord.File(f, os.path.basename(snapshot.export))
+            )
 
     @discord.app_commands.command(  # type: ignore[arg-type]
         name="create-final-thoughts-thread",
@@ -931,7 +1113,7 @@ class Manage(discord.app_commands.Group):
             return
 
         bot = self.get_bot()
-        swap_info = Swap.get_swap()
+        swap_info = await get_swap()
         if swap_info.swap_channel_discord_id is None:
             logger.info("No channel set for swap")
             await interaction.response.send_message(
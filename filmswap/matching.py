@@ -0,0 +1,160 @@
+"""
+Matching users with their santa/giftee
+
+A match is a cycle of user IDs, where each user gifts to the next user in the
+cycle (and the last user gifts to the first). Engines take a set of forbidden
+(santa, giftee) pairs -- e.g. pairs from the last few swaps, or pairs a mod
+has blocked -- and try to produce a cycle which doesn't use any of them
+"""
+
+from __future__ import annotations
+import random
+from typing import Callable, Sequence
+
+from logzero import logger  # type: ignore[import]
+
+Pair = tuple[int, int]
+MatchEngine = Callable[[Sequence[int], "set[Pair]", random.Random], list[int]]
+
+
+class MatchingError(RuntimeError):
+    pass
+
+
+def random_cycle(
+    user_ids: Sequence[int], forbidden: set[Pair], rng: random.Random
+) -> list[int]:
+    """
+    Shuffle the users into a single cycle, ignoring any constraints
+    """
+    order = list(user_ids)
+    rng.shuffle(order)
+    return order
+
+
+def constrained_cycle(
+    user_ids: Sequence[int],
+    forbidden: set[Pair],
+    rng: random.Random,
+    max_moves: int | None = None,
+    restarts: int = 10,
+) -> list[int]:
+    """
+    Shuffle the users into a single cycle, then repair any forbidden edges in place
+
+    For each forbidden edge order[i] -> order[i + 1], order[i + 1] is swapped with
+    a random other position, if that doesn't create a new forbidden edge. Since the
+    forbidden pairs are sparse compared to all possible pairs, almost every swap
+    succeeds, so this is linear in the number of users instead of retrying the
+    whole shuffle until it happens to be valid
+
+    If the repairs get stuck (which can happen in small, heavily constrained
+    swaps) this starts over from a new shuffle, up to 'restarts' times
+    """
+    n = len(user_ids)
+    if max_moves is None:
+        max_moves = 20 * n + 1000
+    for attempt in range(1, restarts + 1):
+        try:
+            return _repair_cycle(user_ids, forbidden, rng, max_moves)
+        except MatchingError:
+            if attempt >= restarts:
+                raise
+    raise MatchingError("restarts must be at least 1")
+
+
+def _repair_cycle(
+    user_ids: Sequence[int],
+    forbidden: set[Pair],
+    rng: random.Random,
+    max_moves: int,
+) -> list[int]:
+    order = list(user_ids)
+    n = len(order)
+    rng.shuffle(order)
+    if n < 2 or not forbidden:
+        return order
+
+    def bad(i: int) -> bool:
+        return (order[i % n], order[(i + 1) % n]) in forbidden
+
+    # positions i where the edge order[i] -> order[i + 1] is forbidden
+    todo = [i for i in range(n) if bad(i)]
+    moves = 0
+    while todo:
+        i = todo.pop()
+        if not bad(i):
+            # fixed as a side effect of an earlier swap
+            continue
+        if moves >= max_moves:
+            raise MatchingError(
+                f"Could not find a valid match for {n} users after {moves} moves"
+            )
+        moves += 1
+        p = (i + 1) % n
+        # try a few random swaps which fix this edge without breaking any others
+        for _ in range(8):
+            q = rng.randrange(n)
+            if q == p:
+                continue
+            order[p], order[q] = order[q], order[p]
+            if not any(bad(k) for k in (p - 1, p, q - 1, q)):
+                break
+            order[p], order[q] = order[q], order[p]
+        else:
+            # stuck, make a random move anyway, and recheck what it touched
+            q = rng.randrange(n)
+            order[p], order[q] = order[q], order[p]
+            todo.extend(k % n for k in (p - 1, p, q - 1, q) if bad(k))
+
+    return order
+
+
+ENGINES: dict[str, MatchEngine] = {
+    "random": random_cycle,
+    "constrained": constrained_cycle,
+}
+
+
+def match(
+    user_ids: Sequence[int],
+    forbidden: list[set[Pair]],
+    engine: str = "constrained",
+    rng: random.Random | None = None,
+) -> list[int]:
+    """
+    Match users into a cycle. forbidden is a list of constraint sets, most important first
+
+    If no match satisfies every set, the least important sets are dropped one at a
+    time, e.g. a tiny swap may have to repeat a pair from a previous month. The
+    first set (the pairs mods have blocked) is never dropped, if there's no match
+    without those this raises MatchingError. Use validate_cycle to find which of
+    the dropped pairs were used
+    """
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown matching engine {engine}, options: {list(ENGINES)}")
+    func = ENGINES[engine]
+    rng = rng or random.Random()
+    lowest = 1 if forbidden else 0
+    for keep in range(len(forbidden), lowest - 1, -1):
+        constraints: set[Pair] = set().union(*forbidden[:keep])
+        try:
+            return func(user_ids, constraints, rng)
+        except MatchingError as e:
+            if keep > lowest:
+                logger.warning(f"{e}, retrying with fewer constraints")
+    raise MatchingError(
+        f"Could not match {len(user_ids)} users without using a blocked pair"
+    )
+
+
+def validate_cycle(order: Sequence[int], forbidden: set[Pair]) -> list[Pair]:
+    """
+    Returns the forbidden pairs used by this cycle
+    """
+    n = len(order)
+    return [
+        (order[i], order[(i + 1) % n])
+        for i in range(n)
+        if (order[i], order[(i + 1) % n]) in forbidden
+    ]
@@ -0,0 +1,383 @@
+"""
+Metrics for commands, database queries, discord API calls and DMs
+
+Metrics are kept in memory, and written in the prometheus text format, either
+served on http://127.0.0.1:METRICS_PORT/metrics, or written to METRICS_FILE
+every METRICS_FLUSH_INTERVAL seconds (or both, or neither if those are unset)
+
+Each slash command and > DM command is timed, and SQL queries are counted
+against the command that made them. The current command is kept in a
+contextvar, which is copied to the database thread by async_db.run_sync
+"""
+
+from __future__ import annotations
+import os
+import time
+import asyncio
+import threading
+import contextvars
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any, Iterator
+
+import aiohttp
+import discord
+from aiohttp import web
+from sqlalchemy import event
+from logzero import logger  # type: ignore[import]
+
+from .settings import settings
+from . import query_log
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 500)
+
+# metrics are updated from the event loop and the database thread
+_lock = threading.Lock()
+
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values: dict[tuple[str, ...], Any] = {}
+        REGISTRY.append(self)
+
+    def _key(self, labels: dict[str, Any]) -> tuple[str, ...]:
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def _label_str(self, key: tuple[str, ...], extra: str = "") -> str:
+        parts = [
+            f'{label}="{_escape(value)}"' for label, value in zip(self.labels, key)
+        ]
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def samples(self) -> Iterator[str]:
+        for key, value in sorted(self._values.items()):
+            yield f"{self.name}{self._label_str(key)} {value}"
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        with _lock:
+            lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels: Any) -> None:
+        key = self._key(labels)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def set(self, value: float, **labels: Any) -> None:
+        with _lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels: Any) -> None:
+        key = self._key(labels)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels: Any) -> None:
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = SECONDS_BUCKETS,
+    ) -> None:
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = self._key(labels)
+        with _lock:
+            # counts for each bucket (not cumulative), then the sum and count
+            data = self._values.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data[0][i] += 1
+                    break
+            data[1] += value
+            data[2] += 1
+
+    def samples(self) -> Iterator[str]:
+        for key, (counts, total, count) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = self._label_str(key, f'le="{bound}"')
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = self._label_str(key, 'le="+Inf"')
+            yield f"{self.name}_bucket{labels} {count}"
+            yield f"{self.name}_sum{self._label_str(key)} {total}"
+            yield f"{self.name}_count{self._label_str(key)} {count}"
+
+
+REGISTRY: list[_Metric] = []
+
+commands_total = Counter(
+    "filmswap_commands_total", "Commands run, by status", ("command", "status")
+)
+command_seconds = Histogram(
+    "filmswap_command_seconds", "Time to handle each command", ("command",)
+)
+command_queries = Histogram(
+    "filmswap_command_queries",
+    "SQL queries made by each command",
+    ("command",),
+    buckets=COUNT_BUCKETS,
+)
+sql_queries = Counter(
+    "filmswap_sql_queries_total", "SQL statements executed", ("command",)
+)
+sql_query_seconds = Histogram(
+    "filmswap_sql_query_seconds", "Time to execute each SQL statement", ("command",)
+)
+sql_commit_seconds = Histogram(
+    "filmswap_sql_commit_seconds",
+    "Time to flush and commit each session",
+    ("command",),
+)
+discord_requests = Counter(
+    "filmswap_discord_requests_total",
+    "Requests to the discord API, by route and result",
+    ("route", "priority", "status"),
+)
+discord_request_seconds = Histogram(
+    "filmswap_discord_request_seconds",
+    "Time for each discord API request, including retries",
+    ("route",),
+)
+discord_responses = Counter(
+    "filmswap_discord_responses_total",
+    "HTTP responses from discord, including ones discord.py retried",
+    ("status",),
+)
+discord_ratelimited = Counter(
+    "filmswap_discord_ratelimited_total", "429 responses from discord"
+)
+api_waiting = Gauge(
+    "filmswap_api_waiting", "Requests waiting in the API governor", ("priority",)
+)
+api_wait_seconds = Histogram(
+    "filmswap_api_wait_seconds",
+    "Time requests waited in the API governor",
+    ("priority",),
+)
+dms = Counter("filmswap_dms_total", "DMs sent by the dispatcher", ("kind", "status"))
+dm_retries = Counter("filmswap_dm_retries_total", "DM sends which were retried")
+dms_pending = Gauge(
+    "filmswap_dms_pending",
+    "DMs the dispatcher hasn't finished yet, e.g. during the period post hook",
+)
+outbox_messages = Gauge(
+    "filmswap_outbox_messages", "Messages in the outbox, by status", ("status",)
+)
+
+
+@dataclass
+class CommandContext:
+    name: str
+    started: float
+    queries: int = 0
+
+
+_current: contextvars.ContextVar[CommandContext | None] = contextvars.ContextVar(
+    "current_command", default=None
+)
+
+
+def current_command() -> str:
+    ctx = _current.get()
+    return ctx.name if ctx is not None else "none"
+
+
+def start_command(name: str) -> CommandContext:
+    """
+    Start timing a command, queries made after this (in this task) are counted against it
+    """
+    ctx = CommandContext(name=name, started=time.perf_counter())
+    _current.set(ctx)
+    return ctx
+
+
+def finish_command(ctx: CommandContext, status: str) -> None:
+    commands_total.inc(command=ctx.name, status=status)
+    command_seconds.observe(time.perf_counter() - ctx.started, command=ctx.name)
+    command_queries.observe(ctx.queries, command=ctx.name)
+
+
+@contextmanager
+def track_command(name: str) -> Iterator[CommandContext]:
+    ctx = CommandContext(name=name, started=time.perf_counter())
+    token = _current.set(ctx)
+    status = "ok"
+    try:
+        yield ctx
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        finish_command(ctx, status)
+        _current.reset(token)
+
+
+class MetricsCommandTree(discord.app_commands.CommandTree):  # type: ignore[type-arg]
+    """
+    Times every slash command
+    """
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:  # type: ignore[type-arg]
+        if interaction.command is not None:
+            name = f"/{interaction.command.qualified_name}"
+            interaction.extras["metrics"] = start_command(name)
+        return True
+
+    async def on_error(self, interaction: discord.Interaction, error: discord.app_commands.AppCommandError) -> None:  # type: ignore[type-arg]
+        if (ctx := interaction.extras.pop("metrics", None)) is not None:
+            finish_command(ctx, "error")
+        await super().on_error(interaction, error)
+
+
+def on_command_completion(interaction: discord.Interaction) -> None:  # type: ignore[type-arg]
+    if (ctx := interaction.extras.pop("metrics", None)) is not None:
+        finish_command(ctx, "ok")
+
+
+def instrument_engine(engine: Any, session_cls: Any) -> None:
+    """
+    Count and time every statement, and time commits, for the current command
+
+    Statements are also passed to query_log, for the slow query log and query budgets
+    """
+
+    def before_cursor_execute(conn: Any, *args: Any) -> None:
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    def after_cursor_execute(
+        conn: Any, cursor: Any, statement: str, *args: Any
+    ) -> None:
+        elapsed = time.perf_counter() - conn.info["query_start"].pop()
+        ctx = _current.get()
+        command = ctx.name if ctx is not None else "none"
+        if ctx is not None:
+            ctx.queries += 1
+        sql_queries.inc(command=command)
+        sql_query_seconds.observe(elapsed, command=command)
+        query_log.record(statement, elapsed, command)
+
+    def before_commit(session: Any) -> None:
+        session.info["commit_start"] = time.perf_counter()
+
+    def after_commit(session: Any) -> None:
+        if (start := session.info.pop("commit_start", None)) is not None:
+            sql_commit_seconds.observe(
+                time.perf_counter() - start, command=current_command()
+            )
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)  # type: ignore[no-untyped-call]
+    event.listen(engine, "after_cursor_execute", after_cursor_execute)  # type: ignore[no-untyped-call]
+    # only set up once, since it applies to every session
+    if not event.contains(session_cls, "before_commit", before_commit):  # type: ignore[no-untyped-call]
+        event.listen(session_cls, "before_commit", before_commit)  # type: ignore[no-untyped-call]
+        event.listen(session_cls, "after_commit", after_commit)  # type: ignore[no-untyped-call]
+
+
+def discord_trace() -> aiohttp.TraceConfig:
+    """
+    Counts every HTTP response from discord, discord.py retries 429s itself, so
+    they'd otherwise never be seen
+    """
+
+    async def on_request_end(
+        session: aiohttp.ClientSession,
+        ctx: Any,
+        params: aiohttp.TraceRequestEndParams,
+    ) -> None:
+        status = params.response.status
+        discord_responses.inc(status=status)
+        if status == 429:
+            discord_ratelimited.inc()
+
+    trace = aiohttp.TraceConfig()
+    trace.on_request_end.append(on_request_end)
+    return trace
+
+
+def render() -> str:
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+
+def write_file(path: str) -> None:
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        f.write(render())
+    os.replace(tmp, path)
+
+
+async def _flush_forever(path: str, interval: float) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            write_file(path)
+        except OSError as e:
+            logger.warning(f"Could not write metrics to {path}: {e}")
+
+
+async def _serve(port: int) -> web.AppRunner:
+    async def handler(request: web.Request) -> web.Response:
+        return web.Response(text=render(), content_type="text/plain")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    # only on localhost, this isn't meant to be public
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    logger.info(f"Serving metrics on http://127.0.0.1:{port}/metrics")
+    return runner
+
+
+_started = False
+# references to the exporters, so they aren't garbage collected
+_exporters: list[Any] = []
+
+
+async def start_exporters() -> None:
+    """
+    Start serving/writing metrics, depending on METRICS_PORT and METRICS_FILE
+    """
+    global _started
+    if _started:
+        return
+    _started = True
+    if settings.METRICS_PORT:
+        _exporters.append(await _serve(settings.METRICS_PORT))
+    if settings.METRICS_FILE:
+        _exporters.append(
+            asyncio.create_task(
+                _flush_forever(settings.METRICS_FILE, settings.METRICS_FLUSH_INTERVAL)
+            )
+        )
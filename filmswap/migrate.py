@@ -0,0 +1,270 @@
+"""
+Applies schema migrations, and records which have been applied
+
+Each migration has a 'needed' check, which looks at the current schema. That
+way, a database created after a migration was written (where create_all made
+the tables with the current schema already) just records it as applied,
+instead of running it
+
+Migrations are applied in order, from the bot at startup (if AUTO_MIGRATE is
+set), or with 'python -m filmswap migrate'
+"""
+
+from __future__ import annotations
+import os
+import time
+from dataclasses import dataclass
+from typing import Callable
+
+from sqlalchemy import Table, insert, text
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.orm import Session
+from sqlalchemy.schema import CreateTable, MetaData
+from logzero import logger  # type: ignore[import]
+
+from .db import SchemaMigration, SwapUser
+
+MIGRATIONS_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "migrations"
+)
+
+
+@dataclass(frozen=True)
+class Migration:
+    # the timestamp prefix of the file in ./migrations, e.g. 2023_07_15_00_58
+    version: str
+    description: str
+    # returns True if the schema doesn't have this change yet
+    needed: Callable[[Connection], bool]
+    apply: Callable[[Engine, int], None]
+
+
+@dataclass(frozen=True)
+class MigrationResult:
+    version: str
+    description: str
+    # False if the schema already had the change, so it was only recorded
+    applied: bool
+    seconds: float
+
+
+class MigrationError(RuntimeError):
+    """
+    The data in the database has to be fixed before a migration can be applied
+    """
+
+
+def _columns(conn: Connection, table: str) -> dict[str, str]:
+    """
+    column name -> declared type
+    """
+    rows = conn.execute(text(f"PRAGMA table_info({table})"))  # type: ignore[no-untyped-call]
+    return {row[1]: row[2].upper() for row in rows}
+
+
+def _indexes(conn: Connection, table: str) -> set[str]:
+    rows = conn.execute(text(f"PRAGMA index_list({table})"))  # type: ignore[no-untyped-call]
+    return {row[1] for row in rows}
+
+
+def _check_unique(conn: Connection, table: str, column: str) -> None:
+    """
+    Raise a MigrationError if a unique index can't be created on table.column
+    """
+    query = text(
+        f"SELECT {column}, COUNT(*) FROM {table} WHERE {column} IS NOT NULL "
+        f"GROUP BY {column} HAVING COUNT(*) > 1 ORDER BY {column}"
+    )
+    rows = conn.execute(query).fetchall()  # type: ignore[no-untyped-call]
+    if rows:
+        duplicates = ", ".join(f"{value} ({count} rows)" for value, count in rows[:10])
+        raise MigrationError(
+            f"Can't add a unique index on {table}.{column}, these values are used more than once: {duplicates}. "
+            "Fix the pairings first (/set-period JOIN clears them), or set AUTO_MIGRATE=false to start the bot without this migration"
+        )
+
+
+def _add_pairing_indexes(engine: Engine, batch_size: int) -> None:
+    # check first, so this fails with the users to fix instead of an IntegrityError
+    with engine.connect() as conn:
+        for column in ("santa_id", "giftee_id"):
+            _check_unique(conn, "swap_users", column)
+    _run_sql_file("2026_10_16_12_00_add_pairing_indexes.sql")(engine, batch_size)
+
+
+def _run_sql_file(filename: str) -> Callable[[Engine, int], None]:
+    def apply(engine: Engine, batch_size: int) -> None:
+        with open(os.path.join(MIGRATIONS_DIR, filename)) as f:
+            script = f.read()
+        raw = engine.raw_connection()
+        try:
+            raw.executescript(script)  # type: ignore[attr-defined]
+        finally:
+            raw.close()
+
+    return apply
+
+
+def rebuild_table(
+    engine: Engine,
+    table: Table,
+    batch_size: int = 1000,
+    pause: float = 0.01,
+) -> None:
+    """
+    Rebuild a table to match its current definition, without locking it for the whole copy
+
+    SQLite can't change the type of a column, so this creates a new table, copies
+    the rows over in batches (each in its own short transaction, so the bot can keep
+    using the database in between), then swaps the new table in. Triggers on the old
+    table mirror any writes made during the copy to rows that were already copied
+    """
+    name = table.name
+    new_name = f"{name}_rebuild"
+    new_table = table.to_metadata(MetaData(), name=new_name)  # type: ignore[attr-defined]
+
+    with engine.begin() as conn:
+        old_columns = _columns(conn, name)
+        columns = [c.name for c in table.columns if c.name in old_columns]
+        cols = ", ".join(columns)
+        new_cols = ", ".join(f"NEW.{c}" for c in columns)
+
+        # left over from a rebuild that was interrupted
+        conn.execute(text(f"DROP TABLE IF EXISTS {new_name}"))
+        conn.execute(CreateTable(new_table))
+        for event in ("INSERT", "UPDATE"):
+            conn.execute(
+                text(
+                    f"CREATE TRIGGER {new_name}_{event.lower()} AFTER {event} ON {name} BEGIN "
+                    f"INSERT OR REPLACE INTO {new_name} ({cols}) VALUES ({new_cols}); END"
+                )
+            )
+        conn.execute(
+            text(
+                f"CREATE TRIGGER {new_name}_delete AFTER DELETE ON {name} BEGIN "
+                f"DELETE FROM {new_name} WHERE id = OLD.id; END"
+            )
+        )
+        total = conn.execute(text(f"SELECT COUNT(*) FROM {name}")).scalar()
+
+    # rows the triggers already copied have newer data, so those are ignored
+    last_id = -1
+    copied = 0
+    start = time.perf_counter()
+    while True:
+        with engine.begin() as conn:
+            batch_last_id = conn.execute(
+                text(
+                    f"SELECT MAX(id) FROM (SELECT id FROM {name} WHERE id > :last_id ORDER BY id LIMIT :batch_size)"
+                ),
+                {"last_id": last_id, "batch_size": batch_size},
+            ).scalar()
+            if batch_last_id is None:
+                break
+            result = conn.execute(
+                text(
+                    f"INSERT OR IGNORE INTO {new_name} ({cols}) "
+                    f"SELECT {cols} FROM {name} WHERE id > :last_id AND id <= :batch_last_id"
+                ),
+                {"last_id": last_id, "batch_last_id": batch_last_id},
+            )
+            copied += result.rowcount
+        last_id = batch_last_id
+        logger.info(
+            f"Copied {copied}/{total} rows from {name} ({time.perf_counter() - start:.2f}s)"
+        )
+        time.sleep(pause)
+
+    with engine.begin() as conn:
+        indexes = [
+            sql
+            for (sql,) in conn.execute(
+                text(
+                    "SELECT sql FROM sqlite_master WHERE type = 'index' AND tbl_name = :name AND sql IS NOT NULL"
+                ),
+                {"name": name},
+            )
+        ]
+        for event in ("insert", "update", "delete"):
+            conn.execute(text(f"DROP TRIGGER {new_name}_{event}"))
+        conn.execute(text(f"DROP TABLE {name}"))
+        conn.execute(text(f"ALTER TABLE {new_name} RENAME TO {name}"))
+        # indexes are dropped with the old table, so re-create them on the new one
+        for sql in indexes:
+            conn.execute(text(sql))
+
+
+MIGRATIONS: list[Migration] = [
+    Migration(
+        version="2023_07_15_00_58",
+        description="add letterboxd_username to swap_users",
+        needed=lambda conn: "letterboxd_username" not in _columns(conn, "swap_users"),
+        apply=_run_sql_file("2023_07_15_00_58_add_letterboxd_to_user.sql"),
+    ),
+    Migration(
+        version="2024_05_01_13_05",
+        description="increase the length of the letter and gift columns",
+        needed=lambda conn: _columns(conn, "swap_users")["letter"] != "VARCHAR(4000)",
+        # replaces the .sql file, which copies the table in one long transaction
+        apply=lambda engine, batch_size: rebuild_table(
+            engine, SwapUser.__table__, batch_size=batch_size
+        ),
+    ),
+    Migration(
+        version="2026_10_16_12_00",
+        description="add indexes for the santa/giftee pairing columns",
+        needed=lambda conn: not {
+            "ix_swap_users_user_id",
+            "ix_swap_users_santa_id",
+            "ix_swap_users_giftee_id",
+        }.issubset(_indexes(conn, "swap_users")),
+        apply=_add_pairing_indexes,
+    ),
+]
+
+
+def applied_versions(engine: Engine) -> set[str]:
+    with Session(engine) as session:  # type: ignore[attr-defined]
+        return {version for (version,) in session.query(SchemaMigration.version)}
+
+
+def pending_migrations(engine: Engine) -> list[Migration]:
+    applied = applied_versions(engine)
+    return [m for m in MIGRATIONS if m.version not in applied]
+
+
+def run_migrations(engine: Engine, batch_size: int = 1000) -> list[MigrationResult]:
+    """
+    Apply any pending migrations in order, and record them as applied
+    """
+    results: list[MigrationResult] = []
+    for migration in pending_migrations(engine):
+        start = time.perf_counter()
+        with engine.connect() as conn:
+            needed = migration.needed(conn)
+        if needed:
+            logger.info(
+                f"Applying migration {migration.version}: {migration.description}"
+            )
+            migration.apply(engine, batch_size)
+        seconds = time.perf_counter() - start
+        with engine.begin() as conn:
+            conn.execute(
+                insert(SchemaMigration.__table__).values(
+                    version=migration.version,
+                    description=migration.description,
+                    duration_ms=int(seconds * 1000),
+                )
+            )
+        logger.info(
+            f"Migration {migration.version} {'applied' if needed else 'already in schema, recorded'} in {seconds:.2f}s"
+        )
+        results.append(
+            MigrationResult(
+                version=migration.version,
+                description=migration.description,
+                applied=needed,
+                seconds=seconds,
+            )
+        )
+    return results
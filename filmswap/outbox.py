@@ -0,0 +1,152 @@
+"""
+Sends the DMs queued in the outbox table
+
+Anything which DMs users because of a change to the swap (the letters when the
+swap starts, gifts when watching starts, notifications when someone is rerouted
+after a ban, messages to santas/giftees) adds a row to the outbox in the same
+transaction as that change, instead of sending it directly. The sender drains
+the outbox in the background (using the DM dispatcher), and records whether
+each message was sent, so if the bot restarts part way through, it picks up
+with the messages which haven't been sent yet
+
+A message which was being sent when the bot stopped is sent again on restart,
+since there's no way to tell if discord received it
+"""
+
+from __future__ import annotations
+import asyncio
+from typing import Any
+
+import discord
+from logzero import logger  # type: ignore[import]
+
+from .settings import settings
+from .db import (
+    OutboxMessage,
+    OutboxStatus,
+    claim_outbox,
+    finish_outbox,
+    outbox_status,
+    reset_outbox,
+)
+from .async_db import run_sync
+from . import metrics
+from .governor import Priority, api_priority
+from .dispatch import DM, DMDispatcher, DMResult, DispatchStats, Progress
+
+_STATUSES = {
+    "sent": OutboxStatus.SENT,
+    "skipped": OutboxStatus.SKIPPED,
+    "failed": OutboxStatus.FAILED,
+}
+
+
+def embed_payload(embed: discord.Embed) -> dict[str, Any]:
+    """
+    Payload for a message with just an embed, which can be saved to the outbox
+    """
+    return {"embed": embed.to_dict()}
+
+
+def _send_kwargs(message: OutboxMessage) -> dict[str, Any]:
+    """
+    The kwargs for Messageable.send
+    """
+    kwargs = dict(message.payload)
+    if "embed" in kwargs:
+        kwargs["embed"] = discord.Embed.from_dict(kwargs["embed"])
+    return kwargs
+
+
+class OutboxSender:
+    def __init__(self, bot: discord.Client) -> None:
+        self.dispatcher = DMDispatcher(bot)
+        # only one drain at a time, so progress covers everything that was pending
+        self._lock = asyncio.Lock()
+        self._wake = asyncio.Event()
+        self._task: asyncio.Task[None] | None = None
+
+    def _dm(self, message: OutboxMessage, results: list[DMResult] | None = None) -> DM:
+        async def payload() -> dict[str, Any] | None:
+            return _send_kwargs(message)
+
+        async def on_result(result: DMResult) -> None:
+            await run_sync(
+                finish_outbox, message.id, _STATUSES[result.status], result.error
+            )
+            if results is not None:
+                results.append(result)
+
+        return DM(message.user_id, payload, message.kind, on_result)
+
+    async def drain(self, progress: Progress | None = None) -> DispatchStats:
+        """
+        Send every pending message
+        """
+        async with self._lock:
+            messages = await run_sync(claim_outbox)
+            if messages:
+                logger.info(f"Sending {len(messages)} messages from the outbox")
+            with api_priority(Priority.BULK):
+                stats = await self.dispatcher.run(
+                    [self._dm(message) for message in messages], progress
+                )
+            counts, _ = await run_sync(outbox_status, 0)
+            for status in OutboxStatus:
+                metrics.outbox_messages.set(counts.get(status, 0), status=status.value)
+            return stats
+
+    async def send_now(self, message_id: int) -> DMResult | None:
+        """
+        Send one message right away, returns None if it was already claimed by a drain
+        """
+        messages = await run_sync(claim_outbox, [message_id])
+        if not messages:
+            return None
+        results: list[DMResult] = []
+        with api_priority(Priority.RELAY):
+            await self.dispatcher.run([self._dm(messages[0], results)])
+        return results[0]
+
+    def wake(self) -> None:
+        """
+        Send pending messages now, instead of waiting for OUTBOX_POLL_INTERVAL
+        """
+        self._wake.set()
+
+    async def run(self) -> None:
+        # these were being sent when the bot stopped
+        await run_sync(reset_outbox, OutboxStatus.SENDING)
+        while True:
+            try:
+                await self.drain()
+            except Exception as e:
+                logger.exception(f"Error draining outbox: {e}", exc_info=True)
+            try:
+                await asyncio.wait_for(
+                    self._wake.wait(), timeout=settings.OUTBOX_POLL_INTERVAL
+                )
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+
+_sender: OutboxSender | None = None
+
+
+def start_sender(bot: discord.Client) -> OutboxSender:
+    global _sender
+    if _sender is None:
+        _sender = OutboxSender(bot)
+    _sender.start()
+    return _sender
+
+
+def get_sender() -> OutboxSender:
+    if _sender is None:
+        raise RuntimeError("Outbox sender hasn't been started")
+    return _sender
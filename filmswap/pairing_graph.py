@@ -0,0 +1,120 @@
+"""
+The santa -> giftee graph for a swap
+
+Each user gifts to at most one other user, so every node has at most one
+outgoing edge (a functional graph). In a healthy swap every user is on a cycle,
+so the graph can be split into cycles in one pass over an array of successors,
+instead of using a general cycle finding algorithm like networkx's simple_cycles
+
+Anything that isn't a cycle is reported too:
+  - self loops, a user gifting to themselves
+  - chains, users who aren't on a cycle, e.g. someone whose giftee left, or
+    someone who has two santas
+  - dangling edges, a user whose giftee isn't in the swap anymore
+"""
+
+from __future__ import annotations
+from dataclasses import dataclass, field
+from typing import Iterable
+
+from .db import SwapUser
+
+# visit states for decompose
+_UNVISITED = 0
+_ON_PATH = 1
+_DONE = 2
+
+
+@dataclass
+class Decomposition:
+    # user IDs, in gifting order. the last user gifts to the first
+    cycles: list[list[int]] = field(default_factory=list)
+    # user IDs, in gifting order. the last user gifts to someone on a cycle or
+    # another chain, or to no one
+    chains: list[list[int]] = field(default_factory=list)
+    self_loops: list[int] = field(default_factory=list)
+    # (user ID, giftee ID) where the giftee isn't in the graph
+    dangling: list[tuple[int, int]] = field(default_factory=list)
+
+    @property
+    def is_valid(self) -> bool:
+        return not (self.chains or self.self_loops or self.dangling)
+
+    def problems(self) -> list[str]:
+        problems = [
+            f"User {user_id} is gifting to themselves" for user_id in self.self_loops
+        ]
+        problems.extend(
+            f"User {user_id} is gifting to {giftee_id}, who isn't in the swap"
+            for user_id, giftee_id in self.dangling
+        )
+        problems.extend(
+            f"Not part of a cycle: {' -> '.join(map(str, chain))}"
+            for chain in self.chains
+        )
+        return problems
+
+
+class PairingGraph:
+    def __init__(self, pairs: Iterable[tuple[int, int | None]]) -> None:
+        """
+        pairs are (user ID, giftee ID), giftee ID is None if the user has no giftee
+        """
+        self.user_ids: list[int] = []
+        giftee_ids: list[int | None] = []
+        for user_id, giftee_id in pairs:
+            self.user_ids.append(user_id)
+            giftee_ids.append(giftee_id)
+        self.index = {user_id: i for i, user_id in enumerate(self.user_ids)}
+        # index of each user's giftee, -1 if they have no giftee (or it isn't in the graph)
+        self.successor = [
+            self.index.get(giftee_id, -1) if giftee_id is not None else -1
+            for giftee_id in giftee_ids
+        ]
+        self.dangling = [
+            (user_id, giftee_id)
+            for user_id, giftee_id in zip(self.user_ids, giftee_ids)
+            if giftee_id is not None and giftee_id not in self.index
+        ]
+
+    @classmethod
+    def from_users(cls, users: Iterable[SwapUser]) -> PairingGraph:
+        return cls((user.user_id, user.giftee_id) for user in users)
+
+    def __len__(self) -> int:
+        return len(self.user_ids)
+
+    def decompose(self) -> Decomposition:
+        """
+        Split the graph into cycles and chains, visiting each user once
+        """
+        result = Decomposition(dangling=list(self.dangling))
+        state = [_UNVISITED] * len(self.user_ids)
+        # position of each user on the current path
+        position = [0] * len(self.user_ids)
+        for start in range(len(self.user_ids)):
+            if state[start] != _UNVISITED:
+                continue
+            # follow giftees until reaching a user we've seen, or someone without a giftee
+            path: list[int] = []
+            node = start
+            while node != -1 and state[node] == _UNVISITED:
+                state[node] = _ON_PATH
+                position[node] = len(path)
+                path.append(node)
+                node = self.successor[node]
+
+            cycle_start = len(path)
+            if node != -1 and state[node] == _ON_PATH:
+                # came back around to a user on this path, so the rest of the path is a cycle
+                cycle_start = position[node]
+                cycle = [self.user_ids[i] for i in path[cycle_start:]]
+                if len(cycle) == 1:
+                    result.self_loops.append(cycle[0])
+                else:
+                    result.cycles.append(cycle)
+            if cycle_start > 0:
+                result.chains.append([self.user_ids[i] for i in path[:cycle_start]])
+            for i in path:
+                state[i] = _DONE
+        return result
@@ -0,0 +1,132 @@
+"""
+A log of slow SQL statements, and query budgets
+
+Every statement is timed (by the cursor hooks in metrics.instrument_engine),
+and aggregated by its fingerprint -- the statement with literals replaced by ?,
+whitespace collapsed, and IN lists collapsed to (?), so the same query with
+different values counts once. Any statement slower than SLOW_QUERY_MS is
+logged along with the command which made it, instead of echoing every
+statement with SQL_ECHO
+
+query_budget checks how many statements a block of code makes, so a handler
+which starts making a query per user (or per row) fails its test in
+tests/test_query_budgets.py
+"""
+
+from __future__ import annotations
+import re
+import threading
+import contextvars
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Iterator
+
+from logzero import logger  # type: ignore[import]
+
+from .settings import settings
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_IN_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def fingerprint(statement: str) -> str:
+    """
+    The statement without its values, e.g. "SELECT * FROM t WHERE id IN (1, 2)"
+    and "SELECT * FROM t WHERE id IN (3)" both become "SELECT * FROM t WHERE id IN (?)"
+    """
+    statement = _STRING.sub("?", statement)
+    statement = _NUMBER.sub("?", statement)
+    statement = _WHITESPACE.sub(" ", statement).strip()
+    return _IN_LIST.sub("(?)", statement)
+
+
+@dataclass
+class QueryStats:
+    count: int = 0
+    total: float = 0.0
+    max: float = 0.0
+    slow: int = 0
+
+    def __str__(self) -> str:
+        avg = self.total / self.count if self.count else 0.0
+        return f"{self.count}x avg {avg * 1000:.1f}ms max {self.max * 1000:.1f}ms, {self.slow} slow"
+
+
+# fingerprint -> stats, updated from the database thread and the snapshot thread
+_stats: dict[str, QueryStats] = {}
+_lock = threading.Lock()
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+@dataclass
+class QueryBudget:
+    name: str
+    max_queries: int
+    statements: list[str] = field(default_factory=list)
+
+    @property
+    def queries(self) -> int:
+        return len(self.statements)
+
+
+_budget: contextvars.ContextVar[QueryBudget | None] = contextvars.ContextVar(
+    "query_budget", default=None
+)
+
+
+@contextmanager
+def query_budget(name: str, max_queries: int) -> Iterator[QueryBudget]:
+    """
+    Raises QueryBudgetExceeded when the block finishes, if it made more than max_queries
+    """
+    budget = QueryBudget(name=name, max_queries=max_queries)
+    token = _budget.set(budget)
+    try:
+        yield budget
+    finally:
+        _budget.reset(token)
+    if budget.queries > max_queries:
+        statements = "\n".join(f"    {s[:200]}" for s in budget.statements)
+        raise QueryBudgetExceeded(
+            f"{name} made {budget.queries} queries, budget is {max_queries}:\n{statements}"
+        )
+
+
+def record(statement: str, elapsed: float, command: str) -> None:
+    """
+    Called after every statement, with how long it took in seconds
+    """
+    key = fingerprint(statement)
+    slow = elapsed * 1000 >= settings.SLOW_QUERY_MS
+    with _lock:
+        stats = _stats.setdefault(key, QueryStats())
+        stats.count += 1
+        stats.total += elapsed
+        stats.max = max(stats.max, elapsed)
+        if slow:
+            stats.slow += 1
+    if (budget := _budget.get()) is not None:
+        budget.statements.append(key)
+    if slow:
+        logger.warning(
+            f"Slow query ({elapsed * 1000:.0f}ms) from {command}: {key[:500]}"
+        )
+
+
+def top_queries(n: int = 5) -> list[tuple[str, QueryStats]]:
+    """
+    The statements which have taken the most time in total
+    """
+    with _lock:
+        items = list(_stats.items())
+    return sorted(items, key=lambda kv: kv[1].total, reverse=True)[:n]
+
+
+def reset() -> None:
+    with _lock:
+        _stats.clear()
@@ -0,0 +1,260 @@
+"""
+Renders the /reveal graph images
+
+Layouts like kamada_kawai or spring can take seconds for a few hundred users,
+so each image is rendered in a worker process (several at once, if more than
+one image was asked for), instead of on the event loop. Each render uses its
+own matplotlib Figure, instead of the global pyplot state
+
+The 'cycles' layout uses the fact that the pairings are a set of disjoint
+cycles (see pairing_graph.py), and puts each cycle on its own ring, with the
+rings packed into rows. That is linear in the number of users, unlike the
+general graph layouts. Past REVEAL_TILE_SIZE users, the graph is split into
+several images, so each image stays readable and takes about the same time to render
+
+Finished PNGs are cached in memory, keyed by the pairing graph, layout and seed
+"""
+
+from __future__ import annotations
+import io
+import json
+import math
+import random
+import asyncio
+import hashlib
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable
+
+from logzero import logger  # type: ignore[import]
+
+from .settings import settings
+
+LAYOUTS = ("cycles", "circle", "random", "kamada_kawai", "spring", "spectral")
+
+# how many rendered images to keep
+CACHE_SIZE = 32
+
+
+@dataclass(frozen=True)
+class Piece:
+    """
+    Users in gifting order. If closed, the last user gifts to the first
+
+    Chains are open. A cycle or chain which is split across images is drawn
+    as open pieces, each ending with the first user of the next piece
+    """
+
+    names: tuple[str, ...]
+    closed: bool
+
+    def edges(self) -> list[tuple[str, str]]:
+        edges = list(zip(self.names, self.names[1:]))
+        if self.closed and len(self.names) > 1:
+            edges.append((self.names[-1], self.names[0]))
+        return edges
+
+
+def tile_pieces(
+    cycles: list[list[str]], chains: list[list[str]], tile_size: int
+) -> list[list[Piece]]:
+    """
+    Split cycles and chains into tiles of at most tile_size users
+
+    Whole cycles/chains are kept together when they fit, ones larger than a
+    tile are cut into open pieces. Chains are always open, the last user of a
+    chain doesn't gift to the first
+    """
+    tiles: list[list[Piece]] = []
+    tile: list[Piece] = []
+    used = 0
+    groups = [(cycle, True) for cycle in cycles] + [(chain, False) for chain in chains]
+    for names, closed in groups:
+        if len(names) > tile_size:
+            # finish the current tile first, so the pieces stay in order
+            if tile:
+                tiles.append(tile)
+                tile, used = [], 0
+            # cut into arcs, each also includes the next user, to show who the last one gifts to
+            for start in range(0, len(names), tile_size):
+                arc = names[start : start + tile_size]
+                end = start + tile_size
+                if end < len(names):
+                    arc.append(names[end])
+                elif closed:
+                    # the end of a cycle gifts to its first user
+                    arc.append(names[0])
+                tiles.append([Piece(names=tuple(arc), closed=False)])
+            continue
+        if used + len(names) > tile_size and tile:
+            tiles.append(tile)
+            tile, used = [], 0
+        tile.append(Piece(names=tuple(names), closed=closed))
+        used += len(names)
+    if tile:
+        tiles.append(tile)
+    return tiles
+
+
+def cycles_layout(
+    pieces: tuple[Piece, ...], spacing: float = 1.0
+) -> dict[str, tuple[float, float]]:
+    """
+    Put each piece on its own ring, sized so users are 'spacing' apart, and pack the rings into rows
+
+    This is a single pass over the users
+    """
+    diameters = [
+        max(len(piece.names) * spacing / math.pi, spacing) + spacing for piece in pieces
+    ]
+    # aim for a roughly square image
+    row_width = max(max(diameters), math.sqrt(sum(d * d for d in diameters)))
+    pos: dict[str, tuple[float, float]] = {}
+    x, y, row_height = 0.0, 0.0, 0.0
+    for piece, diameter in zip(pieces, diameters):
+        if x > 0 and x + diameter > row_width:
+            x, y, row_height = 0.0, y - row_height, 0.0
+        cx, cy = x + diameter / 2, y - diameter / 2
+        radius = (diameter - spacing) / 2
+        # an open piece is drawn as an arc, with a gap between its ends
+        steps = len(piece.names) if piece.closed else len(piece.names) + 1
+        for i, name in enumerate(piece.names):
+            angle = math.pi / 2 - 2 * math.pi * i / steps
+            pos[name] = (cx + radius * math.cos(angle), cy + radius * math.sin(angle))
+        x += diameter
+        row_height = max(row_height, diameter)
+    return pos
+
+
+@dataclass(frozen=True)
+class RenderJob:
+    pieces: tuple[Piece, ...]
+    layout: str
+    seed: int
+    # e.g. 'part 2/5', if the graph was split into multiple images
+    title: str = ""
+
+    @classmethod
+    def create(
+        cls, pieces: list[Piece], graph_layout: str, seed: int, title: str = ""
+    ) -> RenderJob:
+        if graph_layout not in LAYOUTS:
+            raise ValueError(f"Unknown graph layout {graph_layout}")
+        return cls(pieces=tuple(pieces), layout=graph_layout, seed=seed, title=title)
+
+    @property
+    def cache_key(self) -> str:
+        pieces = [[piece.names, piece.closed] for piece in self.pieces]
+        data = json.dumps([pieces, self.layout, self.seed])
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def plan_jobs(
+    cycles: list[list[str]], chains: list[list[str]], graph_layout: str, count: int
+) -> list[RenderJob]:
+    """
+    The images to render for a reveal. cycles and chains are names, in gifting order
+
+    Each of the 'count' reveals uses a different seed. The seeds are the same each
+    time, so asking for the same reveal again is cached
+
+    graph_layout can be 'randomize', which picks one of the layouts at random,
+    used for every image so the parts of a split graph look the same
+    """
+    if graph_layout == "randomize":
+        graph_layout = random.choice(LAYOUTS)
+    if graph_layout == "cycles":
+        # doesn't use the seed, so every reveal would be the same
+        count = 1
+    tiles = tile_pieces(cycles, chains, settings.REVEAL_TILE_SIZE)
+    jobs: list[RenderJob] = []
+    for seed in range(count):
+        for i, tile in enumerate(tiles, 1):
+            title = f"part {i}/{len(tiles)}" if len(tiles) > 1 else ""
+            jobs.append(RenderJob.create(tile, graph_layout, seed, title))
+    return jobs
+
+
+def render(job: RenderJob) -> bytes:
+    """
+    Draw the graph to a PNG. This runs in a worker process
+    """
+    import networkx as nx  # type: ignore[import]
+    from matplotlib.figure import Figure  # type: ignore[import]
+
+    layouts: dict[str, Callable[[Any], Any]] = {
+        "cycles": lambda g: cycles_layout(job.pieces),
+        "circle": nx.circular_layout,
+        "random": lambda g: nx.random_layout(g, seed=job.seed),
+        "kamada_kawai": nx.kamada_kawai_layout,
+        "spring": lambda g: nx.spring_layout(g, seed=job.seed),
+        "spectral": nx.spectral_layout,
+    }
+
+    graph = nx.DiGraph()
+    for piece in job.pieces:
+        graph.add_nodes_from(piece.names)
+        graph.add_edges_from(piece.edges(), color="red")
+    pos = layouts[job.layout](graph)
+
+    # larger graphs get a larger image, so the names don't overlap
+    size = min(max(6.4, math.sqrt(len(graph)) * 1.2), 20)
+    fig = Figure(figsize=(size, size))
+    ax = fig.add_subplot()
+    nx.draw_networkx(
+        graph,
+        pos,
+        ax=ax,
+        arrows=True,
+        node_color="blue",
+        node_size=1,
+        edge_color="#a9a9a9",
+        width=3,
+        arrowstyle="-|>",
+        arrowsize=13,
+        font_size=8,
+        font_color="black",
+    )
+    ax.set_frame_on(False)
+    if job.layout == "cycles":
+        ax.set_aspect("equal")
+    with io.BytesIO() as f:
+        fig.savefig(
+            f, format="png", pad_inches=0.1, transparent=False, bbox_inches="tight"
+        )
+        return f.getvalue()
+
+
+_executor: ProcessPoolExecutor | None = None
+_cache: OrderedDict[str, bytes] = OrderedDict()
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        # spawn instead of fork, forking a process with the bot's threads running isn't safe
+        _executor = ProcessPoolExecutor(
+            max_workers=settings.REVEAL_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _executor
+
+
+async def render_png(job: RenderJob) -> bytes:
+    key = job.cache_key
+    if key in _cache:
+        _cache.move_to_end(key)
+        logger.info(f"Using cached {job.layout} reveal, seed {job.seed}")
+        return _cache[key]
+
+    users = sum(len(piece.names) for piece in job.pieces)
+    logger.info(f"Rendering {job.layout} reveal for {users} users, seed {job.seed}")
+    loop = asyncio.get_running_loop()
+    png = await loop.run_in_executor(_get_executor(), render, job)
+
+    _cache[key] = png
+    while len(_cache) > CACHE_SIZE:
+        _cache.popitem(last=False)
+    return png
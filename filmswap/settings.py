@@ -19,11 +19,82 @@ class Settings(BaseSettings):
     APP_LOCALE: str = "film"
     PERIOD_POST_HOOK: bool = True
     FILMSWAP_TOKEN: str
+    # apply any pending schema migrations when the bot starts
+    AUTO_MIGRATE: bool = True
     BACKUPS_DIR: str = "backups"
+    # compress JSON exports in the backup dir, "", "gzip", or "zstd" (requires zstandard)
+    BACKUP_COMPRESSION: str = ""
+    # how many database backups to keep, the newest BACKUP_KEEP_LAST, and
+    # the newest backup from each of the last N days/weeks/months
+    BACKUP_KEEP_LAST: int = 10
+    BACKUP_KEEP_DAILY: int = 7
+    BACKUP_KEEP_WEEKLY: int = 8
+    BACKUP_KEEP_MONTHLY: int = 24
+    # worker processes used to render /reveal graphs
+    REVEAL_WORKERS: int = 2
+    # /reveal graphs with more users than this are split into multiple images
+    REVEAL_TILE_SIZE: int = 150
+    # how many DMs to send at once when sending out letters/gifts, and how many
+    # times to retry one that fails with a rate limit or server error
+    DM_CONCURRENCY: int = 8
+    DM_MAX_RETRIES: int = 5
+    # how many requests to the discord API can be in flight at once, and how many
+    # of those are kept for commands and relays (see governor.py)
+    API_CONCURRENCY: int = 10
+    API_RESERVED_SLOTS: int = 2
+    # requests per second to each API route, and overrides for specific routes,
+    # e.g. {"POST /users/@me/channels": 5}
+    API_ROUTE_RATE: float = 20.0
+    API_ROUTE_RATES: dict[str, float] = {}
+    # how many DM channels to cache, and for how many seconds
+    USER_CACHE_SIZE: int = 5000
+    USER_CACHE_TTL: int = 60 * 60
+    # seconds between checks for unsent messages in the outbox
+    OUTBOX_POLL_INTERVAL: int = 60
+    # how often users can use each > command in DMs, as (burst, seconds): a user
+    # can send 'burst' at once, then one every 'seconds'. commands which aren't
+    # listed use 'default', remove 'default' to not limit them (see throttle.py)
+    THROTTLE_LIMITS: dict[str, tuple[int, float]] = {
+        "default": (5, 10.0),
+        "letter": (3, 30.0),
+        "submit": (3, 30.0),
+        "write-santa": (5, 30.0),
+        "write-giftee": (5, 30.0),
+    }
+    # how many user/command buckets to keep in memory
+    THROTTLE_MAX_ENTRIES: int = 10000
+    # serve prometheus style metrics on http://127.0.0.1:METRICS_PORT/metrics (0 to
+    # disable), and/or write them to METRICS_FILE every METRICS_FLUSH_INTERVAL seconds
+    METRICS_PORT: int = 0
+    METRICS_FILE: str = ""
+    METRICS_FLUSH_INTERVAL: int = 60
+    # log SQL statements which take longer than this, with the command that made them
+    SLOW_QUERY_MS: float = 100
     # can set these to empty strings to disable
     PRESENCE_TYPE: str = "watching"
     PRESENCE_STATUS: str = "kino, using /help"
 
+    # sqlite connection profile, these are set with PRAGMAs on each connection
+    # when it's opened. set any of the string values to "" to use the sqlite default
+    #
+    # WAL lets the background tasks read while a command is writing, and with WAL,
+    # synchronous=normal only fsyncs at checkpoints, not on every commit
+    SQLITE_JOURNAL_MODE: str = "wal"
+    SQLITE_SYNCHRONOUS: str = "normal"
+    # negative values are in KiB, so this is 16MB
+    SQLITE_CACHE_SIZE: int = -16000
+    SQLITE_MMAP_SIZE: int = 64 * 1024 * 1024
+    # milliseconds to wait for a lock, instead of raising 'database is locked'
+    SQLITE_BUSY_TIMEOUT: int = 5000
+    SQLITE_TEMP_STORE: str = "memory"
+    SQLITE_POOL_SIZE: int = 5
+
+    # how users are matched, 'constrained' or 'random'
+    MATCH_ENGINE: str = "constrained"
+    # avoid giving anyone the same santa/giftee (in either direction) as they had
+    # in this many of the previous swaps, if possible
+    MATCH_AVOID_PREVIOUS_SWAPS: int = 3
+
     class Config:
         case_sensitive = False
         env_file = ".env"
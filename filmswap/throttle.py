@@ -0,0 +1,77 @@
+"""
+Rate limits for the > commands users send the bot in DMs
+
+Each user gets a token bucket per command, configured in THROTTLE_LIMITS as
+(burst, seconds per command): they can send 'burst' commands at once, and
+then one more each 'seconds'. This is checked before anything touches the
+database, so spamming a command costs a dict lookup
+
+Buckets are kept in an LRU dict of at most THROTTLE_MAX_ENTRIES, a bucket
+which is evicted would have refilled anyway unless the bot is very busy
+"""
+
+from __future__ import annotations
+import time
+from collections import OrderedDict
+from typing import NamedTuple
+
+from .settings import settings
+
+
+class _Bucket(NamedTuple):
+    tokens: float
+    updated: float
+    # if the user was already told to slow down, so they're only told once
+    warned: bool
+
+
+class ThrottleResult(NamedTuple):
+    allowed: bool
+    # seconds until the command can be used again
+    retry_after: float
+    # True the first time the user is throttled, after that they're ignored until the bucket refills
+    warn: bool
+
+
+class Throttle:
+    def __init__(
+        self,
+        limits: dict[str, tuple[int, float]] | None = None,
+        max_entries: int | None = None,
+    ) -> None:
+        self.limits = settings.THROTTLE_LIMITS if limits is None else limits
+        self.max_entries = max_entries or settings.THROTTLE_MAX_ENTRIES
+        self._buckets: OrderedDict[tuple[int, str], _Bucket] = OrderedDict()
+
+    def _limit(self, command: str) -> tuple[int, float] | None:
+        return self.limits.get(command, self.limits.get("default"))
+
+    def check(self, user_id: int, command: str) -> ThrottleResult:
+        """
+        Use one of the users tokens for this command, if they have one
+        """
+        limit = self._limit(command)
+        if limit is None:
+            return ThrottleResult(True, 0.0, False)
+        burst, per = limit
+        now = time.monotonic()
+        key = (user_id, command)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            tokens, warned = float(burst), False
+        else:
+            tokens = min(float(burst), bucket.tokens + (now - bucket.updated) / per)
+            warned = bucket.warned
+
+        if tokens >= 1:
+            result = ThrottleResult(True, 0.0, False)
+            bucket = _Bucket(tokens - 1, now, False)
+        else:
+            result = ThrottleResult(False, (1 - tokens) * per, not warned)
+            bucket = _Bucket(tokens, now, True)
+
+        self._buckets[key] = bucket
+        self._buckets.move_to_end(key)
+        while len(self._buckets) > self.max_entries:
+            self._buckets.popitem(last=False)
+        return result
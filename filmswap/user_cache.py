@@ -0,0 +1,119 @@
+"""
+A cache of DM channels
+
+Sending a DM to a user ID needs a DM channel, and asking discord for one is a
+REST call. The gateway cache (users in the server, and DM channels discord.py
+has seen recently) is checked first, then this cache, and only if neither has
+it is the REST API used. Entries expire after USER_CACHE_TTL seconds, and the
+least recently used are dropped past USER_CACHE_SIZE
+
+The hit/miss counts are shown in the 'info' command
+"""
+
+from __future__ import annotations
+import time
+from collections import OrderedDict
+from typing import Generic, NamedTuple, TypeVar
+
+import discord
+
+from .settings import settings
+
+T = TypeVar("T")
+
+
+class CacheStats(NamedTuple):
+    # found in discord.py's gateway cache
+    gateway: int
+    # found in this cache
+    hits: int
+    # had to use the REST API
+    misses: int
+
+    def __str__(self) -> str:
+        return f"{self.gateway} gateway, {self.hits} cached, {self.misses} fetched"
+
+
+class _LRU(Generic[T]):
+    def __init__(self, max_size: int, ttl: float) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items: OrderedDict[int, tuple[float, T]] = OrderedDict()
+
+    def get(self, key: int) -> T | None:
+        item = self._items.get(key)
+        if item is None:
+            return None
+        expires, value = item
+        if expires < time.monotonic():
+            del self._items[key]
+            return None
+        self._items.move_to_end(key)
+        return value
+
+    def put(self, key: int, value: T) -> None:
+        self._items[key] = (time.monotonic() + self.ttl, value)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def pop(self, key: int) -> None:
+        self._items.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+
+class UserCache:
+    def __init__(
+        self,
+        bot: discord.Client,
+        max_size: int | None = None,
+        ttl: float | None = None,
+    ) -> None:
+        self.bot = bot
+        max_size = max_size or settings.USER_CACHE_SIZE
+        ttl = ttl or settings.USER_CACHE_TTL
+        self._channels: _LRU[discord.DMChannel] = _LRU(max_size, ttl)
+        self.gateway = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def stats(self) -> CacheStats:
+        return CacheStats(gateway=self.gateway, hits=self.hits, misses=self.misses)
+
+    async def dm_channel(self, user_id: int) -> discord.DMChannel:
+        """
+        The DM channel for a user, this doesn't need to fetch the user itself
+        """
+        user = self.bot.get_user(user_id)
+        if user is not None and user.dm_channel is not None:
+            self.gateway += 1
+            return user.dm_channel
+        if (channel := self._channels.get(user_id)) is not None:
+            self.hits += 1
+            return channel
+        self.misses += 1
+        channel = await self.bot.create_dm(user or discord.Object(id=user_id))
+        self._channels.put(user_id, channel)
+        return channel
+
+    def invalidate(self, user_id: int) -> None:
+        """
+        Forget a users DM channel, e.g. if sending to them failed
+        """
+        self._channels.pop(user_id)
+
+
+_cache: UserCache | None = None
+
+
+def get_user_cache(bot: discord.Client) -> UserCache:
+    """
+    The cache shared by everything using this bot
+    """
+    global _cache
+    if _cache is None or _cache.bot is not bot:
+        _cache = UserCache(bot)
+    return _cache
@@ -0,0 +1,13 @@
+-- SQLite migration file
+-- Add (unique) indexes for the santa/giftee pairing columns, so looking up
+-- someones santa or giftee doesn't scan the whole swap_users table
+--
+-- the 2024_05_01 migration rebuilt swap_users without its user_id index,
+-- so that is re-created here as well
+--
+-- if creating a unique index fails, two users share the same santa/giftee,
+-- which means the pairings are broken and should be fixed first
+
+CREATE INDEX IF NOT EXISTS ix_swap_users_user_id ON swap_users (user_id);
+CREATE UNIQUE INDEX IF NOT EXISTS ix_swap_users_santa_id ON swap_users (santa_id);
+CREATE UNIQUE INDEX IF NOT EXISTS ix_swap_users_giftee_id ON swap_users (giftee_id);
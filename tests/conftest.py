@@ -0,0 +1,72 @@
+"""
+Fixtures for tests which use the database
+
+Each test gets an empty sqlite database in its own temporary directory
+"""
+
+import os
+import tempfile
+from typing import Any, Iterator
+
+# the settings are read when filmswap is imported, these are replaced for each test
+os.environ.setdefault("FILMSWAP_TOKEN", "unused")
+os.environ.setdefault(
+    "SQLITEDB_PATH",
+    os.path.join(tempfile.mkdtemp(prefix="filmswap-tests-"), "filmswap.db"),
+)
+
+import pytest
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from filmswap import db
+from filmswap.settings import settings
+
+# (statement, parameters)
+Statements = list[tuple[str, Any]]
+
+
+@pytest.fixture
+def database(tmp_path: Any, monkeypatch: pytest.MonkeyPatch) -> Iterator[Engine]:
+    monkeypatch.setattr(settings, "SQLITEDB_PATH", str(tmp_path / "filmswap.db"))
+    monkeypatch.setattr(settings, "BACKUP_DIR", str(tmp_path / "backups"))
+    os.makedirs(settings.BACKUP_DIR)
+    db._engine = None
+    db.invalidate_swap_cache()
+    engine = db.init_db()
+    yield engine
+    engine.dispose()
+    db._engine = None
+    db.invalidate_swap_cache()
+
+
+@pytest.fixture
+def swap(database: Engine) -> list[int]:
+    """
+    A swap in the SWAP period, returns the user IDs, everyone has a santa and giftee
+    """
+    db.Swap.create_swap()
+    db.Swap.set_swap_channel(1)
+    user_ids = list(range(1, 51))
+    for user_id in user_ids:
+        db.join_swap(user_id, f"user{user_id}")
+        db.set_letter(user_id, f"letter for {user_id}")
+    db.Swap.set_swap_period(db.SwapPeriod.SWAP)
+    return user_ids
+
+
+@pytest.fixture
+def statements(database: Engine) -> Iterator[Statements]:
+    """
+    Every statement run on the database while the test runs
+    """
+    recorded: Statements = []
+
+    def record(
+        conn: Any, cursor: Any, statement: str, parameters: Any, *args: Any
+    ) -> None:
+        recorded.append((statement, parameters))
+
+    event.listen(database, "before_cursor_execute", record)
+    yield recorded
+    event.remove(database, "before_cursor_execute", record)
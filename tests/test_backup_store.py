@@ -0,0 +1,172 @@
+import os
+import json
+import zlib
+import random
+import datetime
+from typing import Any
+
+import pytest
+
+from filmswap.backup_store import CHUNK_SIZE, BackupStore
+
+
+def write_database(path: Any, data: bytes) -> str:
+    path.write_bytes(data)
+    return str(path)
+
+
+def objects(store: BackupStore) -> set[str]:
+    return {
+        digest
+        for prefix in os.listdir(store.objects_dir)
+        for digest in os.listdir(os.path.join(store.objects_dir, prefix))
+    }
+
+
+def used_chunks(store: BackupStore) -> set[str]:
+    used: set[str] = set()
+    for snapshot_id in store.snapshots():
+        with open(store._manifest_path(snapshot_id)) as f:
+            used.update(json.load(f)["chunks"])
+    return used
+
+
+def timestamp(*args: int) -> int:
+    return int(datetime.datetime(*args).timestamp())  # type: ignore[misc]
+
+
+@pytest.fixture
+def data() -> bytes:
+    return random.Random(0).randbytes(5 * CHUNK_SIZE + 123)
+
+
+def test_restore_round_trip(tmp_path: Any, data: bytes) -> None:
+    store = BackupStore(str(tmp_path / "backups"))
+    snapshot_id = store.add(write_database(tmp_path / "db.sqlite", data))
+    assert store.latest() == snapshot_id
+    assert store.snapshots()[snapshot_id]["size"] == len(data)
+
+    store.restore("latest", str(tmp_path / "restored.sqlite"))
+    assert (tmp_path / "restored.sqlite").read_bytes() == data
+
+    with pytest.raises(RuntimeError, match="already exists"):
+        store.restore(snapshot_id, str(tmp_path / "restored.sqlite"))
+    with pytest.raises(RuntimeError, match="No backup"):
+        store.restore("1", str(tmp_path / "other.sqlite"))
+
+
+def test_unchanged_chunks_are_stored_once(tmp_path: Any, data: bytes) -> None:
+    store = BackupStore(str(tmp_path / "backups"))
+    first = store.add(write_database(tmp_path / "db.sqlite", data))
+    assert len(objects(store)) == 6
+
+    # change one byte in the third chunk
+    changed = bytearray(data)
+    changed[2 * CHUNK_SIZE + 10] ^= 0xFF
+    second = store.add(write_database(tmp_path / "db.sqlite", bytes(changed)))
+    assert second != first
+    assert len(objects(store)) == 7
+
+    store.restore(first, str(tmp_path / "first.sqlite"))
+    store.restore(second, str(tmp_path / "second.sqlite"))
+    assert (tmp_path / "first.sqlite").read_bytes() == data
+    assert (tmp_path / "second.sqlite").read_bytes() == bytes(changed)
+
+
+def test_corrupted_chunk(tmp_path: Any, data: bytes) -> None:
+    store = BackupStore(str(tmp_path / "backups"))
+    store.add(write_database(tmp_path / "db.sqlite", data))
+    digest = sorted(objects(store))[0]
+    path = store._object_path(digest)
+    with open(path, "rb") as f:
+        compressed = f.read()
+    with open(path, "wb") as f:
+        f.write(zlib.compress(zlib.decompress(compressed) + b"x"))
+    with pytest.raises(RuntimeError, match="corrupted"):
+        store.restore("latest", str(tmp_path / "restored.sqlite"))
+    assert not (tmp_path / "restored.sqlite").exists()
+
+
+def test_prune(tmp_path: Any) -> None:
+    store = BackupStore(str(tmp_path / "backups"))
+    created = {
+        "jan10": timestamp(2026, 1, 10, 12),
+        "jan20": timestamp(2026, 1, 20, 12),
+        "feb5": timestamp(2026, 2, 5, 12),
+        "feb25": timestamp(2026, 2, 25, 12),
+        # monday
+        "mar2": timestamp(2026, 3, 2, 12),
+        # the next monday, the rest are in the same week
+        "mar9": timestamp(2026, 3, 9, 12),
+        "mar10": timestamp(2026, 3, 10, 12),
+        "mar11-9": timestamp(2026, 3, 11, 9),
+        "mar11-12": timestamp(2026, 3, 11, 12),
+        "mar11-15": timestamp(2026, 3, 11, 15),
+    }
+    rng = random.Random(1)
+    shared = rng.randbytes(CHUNK_SIZE)
+    ids: dict[str, str] = {}
+    for name, created_at in created.items():
+        # every backup shares its first chunk, and has one of its own
+        path = write_database(tmp_path / "db.sqlite", shared + rng.randbytes(100))
+        export = tmp_path / "backups" / f"{name}.json"
+        ids[name] = store.add(path, export=export.name, created_at=created_at)
+        export.write_text("{}")
+
+    deleted = store.prune(keep_last=2, keep_daily=2, keep_weekly=2, keep_monthly=3)
+
+    # newest 2, newest on each of the last 2 days, newest in each of the last
+    # 2 weeks, newest in each of the last 3 months
+    kept = {"mar11-15", "mar11-12", "mar10", "mar2", "feb25", "jan20"}
+    assert set(store.snapshots()) == {ids[name] for name in kept}
+    assert set(deleted) == {ids[name] for name in created if name not in kept}
+    assert store.latest() == ids["mar11-15"]
+    # the deleted backups' exports are gone too
+    assert sorted(os.listdir(tmp_path / "backups" / "snapshots")) == sorted(
+        f"{ids[name]}.json" for name in kept
+    )
+    for name in created:
+        assert (tmp_path / "backups" / f"{name}.json").exists() == (name in kept)
+
+    # no chunks which aren't used by a snapshot, and none missing
+    assert objects(store) == used_chunks(store)
+    for snapshot_id in store.snapshots():
+        store.restore(snapshot_id, str(tmp_path / f"{snapshot_id}.sqlite"))
+
+
+def test_prune_nothing_to_delete(tmp_path: Any, data: bytes) -> None:
+    store = BackupStore(str(tmp_path / "backups"))
+    store.add(write_database(tmp_path / "db.sqlite", data))
+    assert store.prune(keep_last=1, keep_daily=0, keep_weekly=0, keep_monthly=0) == []
+    assert len(store.snapshots()) == 1
+
+
+def test_import_legacy_backups(tmp_path: Any, data: bytes) -> None:
+    root = tmp_path / "backups"
+    root.mkdir()
+    old = timestamp(2025, 6, 1, 12)
+    (root / f"{old}.sqlite").write_bytes(data)
+    (root / f"{old}.json").write_text("{}")
+    (root / f"{old + 60}.sqlite").write_bytes(data[:100])
+
+    store = BackupStore(str(root))
+    newer = store.add(write_database(tmp_path / "db.sqlite", b"new"))
+    assert store.import_legacy() == [str(old), str(old + 60)]
+    assert store.import_legacy() == []
+    assert not (root / f"{old}.sqlite").exists()
+
+    snapshots = store.snapshots()
+    assert list(snapshots) == [str(old), str(old + 60), newer]
+    assert snapshots[str(old)]["export"] == f"{old}.json"
+    assert snapshots[str(old + 60)]["export"] is None
+    # importing old backups doesn't change which is the latest
+    assert store.latest() == newer
+
+    store.restore(str(old), str(tmp_path / "restored.sqlite"))
+    assert (tmp_path / "restored.sqlite").read_bytes() == data
+
+    # and they're pruned like any other backup
+    store.prune(keep_last=1, keep_daily=0, keep_weekly=0, keep_monthly=0)
+    assert list(store.snapshots()) == [newer]
+    assert not (root / f"{old}.json").exists()
+    assert objects(store) == used_chunks(store)
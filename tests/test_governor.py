@@ -0,0 +1,207 @@
+import time
+import asyncio
+from types import SimpleNamespace
+from typing import Any
+
+import discord
+import pytest
+
+from filmswap.governor import Governor, Priority, _Bucket, api_priority
+
+
+def test_bucket_refill() -> None:
+    bucket = _Bucket(rate=2)
+    now = bucket.updated
+    assert bucket.wait_time(now) == 0
+    bucket.take()
+    bucket.take()
+    assert bucket.wait_time(now) == pytest.approx(0.5)
+    assert bucket.wait_time(now + 0.25) == pytest.approx(0.25)
+    assert bucket.wait_time(now + 0.5) == 0
+    # doesn't save up more than a seconds worth
+    assert bucket.wait_time(now + 60) == 0
+    assert bucket.tokens == 2
+
+
+def test_slow_bucket() -> None:
+    # less than one request per second still allows one at a time
+    bucket = _Bucket(rate=0.5)
+    now = bucket.updated
+    assert bucket.capacity == 1
+    bucket.take()
+    assert bucket.wait_time(now) == pytest.approx(2)
+
+
+def test_bucket_pause() -> None:
+    bucket = _Bucket(rate=10)
+    now = bucket.updated
+    bucket.pause(2, now)
+    assert bucket.wait_time(now) == pytest.approx(2)
+    assert bucket.wait_time(now + 2) == 0
+    # a shorter pause doesn't shorten a longer one
+    bucket.pause(5, now)
+    bucket.pause(1, now)
+    assert bucket.wait_time(now) == pytest.approx(5)
+
+
+async def hold(governor: Governor, key: str, priority: Priority) -> None:
+    with api_priority(priority):
+        await governor.acquire(key)
+
+
+def test_priority_order() -> None:
+    async def main() -> list[Priority]:
+        governor = Governor(concurrency=1, reserved=0, route_rate=1000)
+        await governor.acquire("route")
+        started: list[Priority] = []
+
+        async def request(priority: Priority) -> None:
+            await hold(governor, "route", priority)
+            started.append(priority)
+            governor.release()
+
+        order = [
+            Priority.MAINTENANCE,
+            Priority.BULK,
+            Priority.RELAY,
+            Priority.INTERACTION,
+            Priority.BULK,
+        ]
+        tasks = [asyncio.create_task(request(priority)) for priority in order]
+        await asyncio.sleep(0.01)
+        assert started == []
+        assert governor.stats[Priority.BULK].waiting == 2
+        governor.release()
+        await asyncio.gather(*tasks)
+        assert governor._active == 0
+        assert all(stats.waiting == 0 for stats in governor.stats.values())
+        return started
+
+    assert asyncio.run(main()) == [
+        Priority.INTERACTION,
+        Priority.RELAY,
+        Priority.BULK,
+        Priority.BULK,
+        Priority.MAINTENANCE,
+    ]
+
+
+def test_reserved_slots() -> None:
+    async def main() -> None:
+        governor = Governor(concurrency=3, reserved=1, route_rate=1000)
+        bulk = [
+            asyncio.create_task(hold(governor, f"dm {i}", Priority.BULK))
+            for i in range(10)
+        ]
+        await asyncio.sleep(0.01)
+        # the bulk requests never use the reserved slot
+        assert sum(task.done() for task in bulk) == 2
+        assert governor._active == 2
+
+        # so a command gets it straight away
+        await asyncio.wait_for(hold(governor, "reply", Priority.INTERACTION), 0.1)
+        relay = asyncio.create_task(hold(governor, "relay", Priority.RELAY))
+        await asyncio.sleep(0.01)
+        assert not relay.done()
+        # the relay is started before the waiting bulk requests
+        governor.release()
+        await asyncio.wait_for(relay, 0.1)
+        assert sum(task.done() for task in bulk) == 2
+
+        # a finished bulk request lets the next one start
+        governor.release()
+        await asyncio.sleep(0.01)
+        assert sum(task.done() for task in bulk) == 2
+        governor.release()
+        await asyncio.sleep(0.01)
+        assert sum(task.done() for task in bulk) == 3
+
+        for task in bulk:
+            task.cancel()
+        await asyncio.gather(*bulk, return_exceptions=True)
+
+    asyncio.run(main())
+
+
+def test_route_budget() -> None:
+    async def main() -> None:
+        governor = Governor(
+            concurrency=100, reserved=0, route_rate=1000, route_rates={"slow": 10}
+        )
+        start = time.monotonic()
+        # 10 straight away, then 10 a second
+        slow = [
+            asyncio.create_task(hold(governor, "slow", Priority.BULK))
+            for _ in range(12)
+        ]
+        await asyncio.sleep(0.01)
+        assert sum(task.done() for task in slow) == 10
+        # other routes aren't held up
+        await asyncio.wait_for(hold(governor, "fast", Priority.BULK), 0.05)
+        # the rest start when the route has budget again, without anything else
+        # being released
+        await asyncio.wait_for(asyncio.gather(*slow), 1)
+        assert time.monotonic() - start >= 0.18
+        assert governor._timer is None
+
+    asyncio.run(main())
+
+
+def test_cancelled_requests_free_their_slots() -> None:
+    async def main() -> None:
+        governor = Governor(concurrency=2, reserved=0, route_rate=1000)
+        tasks = [
+            asyncio.create_task(hold(governor, "route", Priority.BULK))
+            for _ in range(5)
+        ]
+        await asyncio.sleep(0.01)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # the 2 which started hold their slots until released
+        assert governor._active == 2
+        governor.release()
+        governor.release()
+        assert governor._active == 0
+        await asyncio.wait_for(hold(governor, "route", Priority.BULK), 0.1)
+        assert governor.stats[Priority.BULK].waiting == 0
+
+    asyncio.run(main())
+
+
+class FakeHTTP:
+    """
+    Responds to the first request with a 429, like discord.py does once it
+    has run out of retries
+    """
+
+    def __init__(self) -> None:
+        self.calls: list[float] = []
+
+    async def request(self, route: Any, **kwargs: Any) -> str:
+        self.calls.append(time.monotonic())
+        if len(self.calls) == 1:
+            response = SimpleNamespace(
+                status=429, reason="Too Many Requests", headers={"Retry-After": "0.2"}
+            )
+            raise discord.HTTPException(response, "rate limited")  # type: ignore[arg-type]
+        return str(route.key)
+
+
+def test_retry_after() -> None:
+    async def main() -> None:
+        governor = Governor(concurrency=5, reserved=0, route_rate=1000)
+        bot = SimpleNamespace(http=FakeHTTP())
+        governor.install(bot)  # type: ignore[arg-type]
+        route = SimpleNamespace(key="POST /channels/{channel_id}/messages")
+        with pytest.raises(discord.HTTPException):
+            await bot.http.request(route)
+        assert governor._active == 0
+        # the next request to that route waits for the Retry-After
+        assert await asyncio.wait_for(bot.http.request(route), 1) == route.key
+        assert bot.http.calls[1] - bot.http.calls[0] >= 0.18
+        # other routes don't
+        other = SimpleNamespace(key="GET /users/{user_id}")
+        await asyncio.wait_for(bot.http.request(other), 0.05)
+
+    asyncio.run(main())
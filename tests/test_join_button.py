@@ -0,0 +1,50 @@
+import asyncio
+from types import SimpleNamespace
+from typing import Any
+
+from sqlalchemy.engine import Engine
+
+from filmswap import db, metrics
+from filmswap.manage import JoinSwapButton
+
+
+class FakeResponse:
+    def __init__(self) -> None:
+        self.messages: list[str] = []
+
+    async def send_message(self, content: str, ephemeral: bool = False) -> None:
+        self.messages.append(content)
+
+
+def fake_interaction(user_id: int) -> Any:
+    dms: list[str] = []
+
+    async def send(content: str) -> None:
+        dms.append(content)
+
+    user = SimpleNamespace(id=user_id, display_name=f"user{user_id}", send=send)
+    return SimpleNamespace(user=user, response=FakeResponse(), dms=dms)
+
+
+def command_samples(name: str) -> list[str]:
+    return [
+        line
+        for line in metrics.render().splitlines()
+        if f'command="{name}"' in line and line.startswith("filmswap_commands_total")
+    ]
+
+
+def test_join_button_is_tracked(database: Engine) -> None:
+    db.Swap.create_swap()
+    interaction = fake_interaction(1)
+
+    async def click() -> None:
+        view = JoinSwapButton()
+        await view.join_swap.callback(interaction)  # type: ignore[attr-defined]
+
+    asyncio.run(click())
+    assert interaction.response.messages == [
+        "Joined swap. Check your DMs to set your letter"
+    ]
+    assert db.load_user_context(1).swap_user is not None
+    assert command_samples("join button")
@@ -0,0 +1,125 @@
+import random
+from itertools import permutations
+
+import pytest
+
+from filmswap import db
+from filmswap.matching import (
+    MatchingError,
+    Pair,
+    _repair_cycle,
+    constrained_cycle,
+    match,
+    random_cycle,
+    validate_cycle,
+)
+
+
+def both_ways(*pairs: Pair) -> set[Pair]:
+    return {p for a, b in pairs for p in ((a, b), (b, a))}
+
+
+def all_pairs(user_ids: list[int]) -> set[Pair]:
+    return set(permutations(user_ids, 2))
+
+
+def test_validate_cycle() -> None:
+    # 1 -> 2 -> 3 -> 1
+    assert validate_cycle([1, 2, 3], set()) == []
+    assert validate_cycle([1, 2, 3], {(2, 3), (3, 1), (2, 1)}) == [(2, 3), (3, 1)]
+
+
+@pytest.mark.parametrize("n", range(2, 9))
+def test_constrained_cycle_small(n: int) -> None:
+    user_ids = list(range(1, n + 1))
+    # each user can't gift to the next one
+    forbidden = {(i, i + 1) for i in range(1, n)}
+    if n == 2:
+        forbidden = set()
+    for seed in range(20):
+        order = constrained_cycle(user_ids, forbidden, random.Random(seed))
+        assert sorted(order) == user_ids
+        assert validate_cycle(order, forbidden) == []
+
+
+def test_constrained_cycle_large() -> None:
+    rng = random.Random(1)
+    user_ids = list(range(1000))
+    forbidden = {(rng.randrange(1000), rng.randrange(1000)) for _ in range(5000)}
+    order = constrained_cycle(user_ids, forbidden, random.Random(2))
+    assert sorted(order) == user_ids
+    assert validate_cycle(order, forbidden) == []
+
+
+def test_repair_cycle_no_constraints() -> None:
+    order = _repair_cycle([1, 2, 3, 4], set(), random.Random(0), max_moves=0)
+    assert sorted(order) == [1, 2, 3, 4]
+
+
+def test_repair_cycle_gives_up() -> None:
+    # two users always gift to each other
+    with pytest.raises(MatchingError):
+        _repair_cycle([1, 2], {(1, 2)}, random.Random(0), max_moves=10)
+
+
+def test_constrained_cycle_infeasible() -> None:
+    with pytest.raises(MatchingError):
+        constrained_cycle([1, 2, 3], both_ways((1, 2)), random.Random(0), restarts=3)
+
+
+def test_match_never_drops_blocked_pairs() -> None:
+    # every cycle of 3 users has 1 and 2 next to each other
+    with pytest.raises(MatchingError, match="blocked"):
+        match([1, 2, 3], [both_ways((1, 2))], rng=random.Random(0))
+
+
+def test_match_falls_back_on_history() -> None:
+    user_ids = [1, 2, 3, 4]
+    blocked = both_ways((1, 2))
+    # last swap used every pair, so it has to be ignored
+    history = all_pairs(user_ids)
+    for seed in range(5):
+        order = match(user_ids, [blocked, history], rng=random.Random(seed))
+        assert sorted(order) == user_ids
+        assert validate_cycle(order, blocked) == []
+
+
+def test_match_drops_oldest_history_first() -> None:
+    user_ids = list(range(1, 7))
+    recent = both_ways((1, 2), (3, 4))
+    # with the recent pairs, the older swap can't be avoided too
+    old = all_pairs(user_ids) - recent
+    for seed in range(5):
+        order = match(user_ids, [set(), recent, old], rng=random.Random(seed))
+        assert validate_cycle(order, recent) == []
+
+
+def test_random_engine_ignores_constraints() -> None:
+    order = random_cycle([1, 2, 3], all_pairs([1, 2, 3]), random.Random(0))
+    assert sorted(order) == [1, 2, 3]
+
+
+def test_set_period_reports_blocked_match(database: object) -> None:
+    db.Swap.create_swap()
+    db.Swap.set_swap_channel(1)
+    for user_id in (1, 2, 3):
+        db.join_swap(user_id, f"user{user_id}")
+        db.set_letter(user_id, "a letter")
+    db.block_pair(1, 2)
+    msg = db.Swap.set_swap_period(db.SwapPeriod.SWAP)
+    assert msg is not None and msg.startswith("Warning: couldn't match users")
+    assert db.get_giftee(1) is None
+
+
+def test_set_period_reports_repeated_pairs(database: object) -> None:
+    db.Swap.create_swap()
+    db.Swap.set_swap_channel(1)
+    for user_id in (1, 2):
+        db.join_swap(user_id, f"user{user_id}")
+        db.set_letter(user_id, "a letter")
+    db.Swap.set_swap_period(db.SwapPeriod.SWAP)
+    # back to JOIN saves the pairs, two users can only be matched the same way again
+    db.Swap.set_swap_period(db.SwapPeriod.JOIN)
+    msg = db.Swap.set_swap_period(db.SwapPeriod.SWAP)
+    assert msg is not None and "2 pairs are repeated" in msg
+    assert db.get_giftee(1) is not None
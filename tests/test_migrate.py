@@ -0,0 +1,160 @@
+import sqlite3
+from typing import Any, Iterator
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+
+from filmswap import db
+from filmswap.migrate import (
+    MIGRATIONS,
+    MigrationError,
+    _columns,
+    _indexes,
+    applied_versions,
+    run_migrations,
+)
+
+# swap_users as it was created before any of the migrations
+OLD_SCHEMA = """
+CREATE TABLE swap_users (
+    id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    name VARCHAR(32) NOT NULL,
+    letter VARCHAR(500),
+    gift VARCHAR(500),
+    done_watching BOOLEAN NOT NULL,
+    santa_id INTEGER,
+    giftee_id INTEGER,
+    PRIMARY KEY (id)
+);
+CREATE INDEX ix_swap_users_user_id ON swap_users (user_id);
+"""
+
+# swap_users as create_all made it before the pairing indexes were added
+BASELINE_SCHEMA = """
+CREATE TABLE swap_users (
+    id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    name VARCHAR(32) NOT NULL,
+    letter VARCHAR(4000),
+    gift VARCHAR(4000),
+    done_watching BOOLEAN NOT NULL,
+    santa_id INTEGER,
+    giftee_id INTEGER,
+    letterboxd_username VARCHAR(64),
+    PRIMARY KEY (id)
+);
+CREATE INDEX ix_swap_users_user_id ON swap_users (user_id);
+"""
+
+PAIRING_INDEXES = {
+    "ix_swap_users_user_id",
+    "ix_swap_users_santa_id",
+    "ix_swap_users_giftee_id",
+}
+
+
+def create_database(path: str, schema: str) -> Engine:
+    """
+    A database with an older swap_users schema, and 3 matched users
+    """
+    conn = sqlite3.connect(path)
+    conn.executescript(schema)
+    conn.executemany(
+        "INSERT INTO swap_users (id, user_id, name, letter, done_watching, santa_id, giftee_id) "
+        "VALUES (?, ?, ?, ?, 0, ?, ?)",
+        [
+            (1, 10, "a", "letter a", 30, 20),
+            (2, 20, "b", "letter b", 10, 30),
+            (3, 30, "c", None, 20, 10),
+        ],
+    )
+    conn.commit()
+    conn.close()
+    engine = db.create_sqlite_engine(path, db.sqlite_pragmas())
+    # what init_db does, which doesn't change the existing swap_users table
+    db.metadata.create_all(engine)
+    return engine
+
+
+@pytest.fixture
+def old_database(tmp_path: Any) -> Iterator[Engine]:
+    engine = create_database(str(tmp_path / "old.db"), OLD_SCHEMA)
+    yield engine
+    engine.dispose()
+
+
+def swap_users(engine: Engine) -> list[tuple[Any, ...]]:
+    with engine.connect() as conn:
+        return list(
+            conn.execute(
+                text(
+                    "SELECT id, user_id, name, letter, santa_id, giftee_id FROM swap_users ORDER BY id"
+                )
+            )
+        )
+
+
+def test_fresh_database_records_migrations(database: Engine) -> None:
+    results = run_migrations(database)
+    assert [r.version for r in results] == [m.version for m in MIGRATIONS]
+    # create_all made the tables with the current schema already
+    assert not any(r.applied for r in results)
+    assert applied_versions(database) == {m.version for m in MIGRATIONS}
+    assert run_migrations(database) == []
+
+
+def test_old_database_is_migrated(old_database: Engine) -> None:
+    before = swap_users(old_database)
+    results = run_migrations(old_database, batch_size=2)
+    assert all(r.applied for r in results)
+    assert applied_versions(old_database) == {m.version for m in MIGRATIONS}
+
+    with old_database.connect() as conn:
+        columns = _columns(conn, "swap_users")
+        assert columns["letter"] == columns["gift"] == "VARCHAR(4000)"
+        assert columns["letterboxd_username"] == "VARCHAR(64)"
+        assert PAIRING_INDEXES.issubset(_indexes(conn, "swap_users"))
+        # nothing left over from the rebuild
+        assert not list(
+            conn.execute(
+                text("SELECT name FROM sqlite_master WHERE name LIKE '%_rebuild%'")
+            )
+        )
+    assert swap_users(old_database) == before
+
+    # a second run has nothing to do, and doesn't change anything
+    assert run_migrations(old_database) == []
+    assert swap_users(old_database) == before
+
+
+def test_baseline_database_is_migrated(tmp_path: Any) -> None:
+    engine = create_database(str(tmp_path / "baseline.db"), BASELINE_SCHEMA)
+    before = swap_users(engine)
+    results = run_migrations(engine)
+    # only the pairing indexes are missing
+    assert [r.applied for r in results] == [False, False, True]
+    with engine.connect() as conn:
+        assert PAIRING_INDEXES.issubset(_indexes(conn, "swap_users"))
+    assert swap_users(engine) == before
+    assert run_migrations(engine) == []
+    engine.dispose()
+
+
+def test_duplicate_pairings_stop_the_migration(old_database: Engine) -> None:
+    with old_database.begin() as conn:
+        # 10 and 20 both gift to 30
+        conn.execute(text("UPDATE swap_users SET giftee_id = 30 WHERE user_id = 10"))
+    with pytest.raises(MigrationError, match=r"swap_users\.giftee_id.*30 \(2 rows\)"):
+        run_migrations(old_database)
+
+    # the earlier migrations were still applied and recorded
+    assert applied_versions(old_database) == {m.version for m in MIGRATIONS[:-1]}
+    with old_database.connect() as conn:
+        assert "ix_swap_users_giftee_id" not in _indexes(conn, "swap_users")
+
+    # once the pairings are fixed, it can be applied
+    with old_database.begin() as conn:
+        conn.execute(text("UPDATE swap_users SET giftee_id = 20 WHERE user_id = 10"))
+    assert [r.version for r in run_migrations(old_database)] == [MIGRATIONS[-1].version]
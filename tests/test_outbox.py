@@ -0,0 +1,128 @@
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from filmswap import db
+from filmswap.db import OutboxMessage, OutboxStatus
+
+
+def message(key: str, user_id: int = 1) -> dict[str, object]:
+    return {
+        "idempotency_key": key,
+        "user_id": user_id,
+        "kind": "relay",
+        "payload": {"content": key},
+    }
+
+
+def outbox(engine: Engine) -> list[OutboxMessage]:
+    with Session(engine) as session:
+        return session.query(OutboxMessage).order_by(OutboxMessage.id).all()
+
+
+def test_enqueue_ignores_duplicate_keys(database: Engine) -> None:
+    with Session(database) as session:
+        assert db.enqueue_dms(session, [message("a"), message("b")]) == 2
+        assert db.enqueue_dms(session, [message("b"), message("c")]) == 1
+        assert db.enqueue_dms(session, []) == 0
+        session.commit()
+    assert [m.idempotency_key for m in outbox(database)] == ["a", "b", "c"]
+    assert all(m.status == OutboxStatus.PENDING for m in outbox(database))
+    # enqueue_dm returns the ID of the existing message
+    assert db.enqueue_dm("b", 1, "relay", {"content": "b"}) == outbox(database)[1].id
+
+
+def test_enqueue_is_part_of_the_transaction(database: Engine) -> None:
+    with Session(database) as session:
+        db.enqueue_dms(session, [message("a")])
+        session.rollback()
+    assert outbox(database) == []
+
+
+def test_claim_and_finish(database: Engine) -> None:
+    ids = [db.enqueue_dm(key, 1, "relay", {"content": key}) for key in "abc"]
+
+    claimed = db.claim_outbox([ids[1]])
+    assert [m.id for m in claimed] == [ids[1]]
+    # already claimed, so not claimed again
+    assert [m.id for m in db.claim_outbox()] == [ids[0], ids[2]]
+    assert db.claim_outbox() == []
+    assert all(m.status == OutboxStatus.SENDING for m in outbox(database))
+
+    db.finish_outbox(ids[0], OutboxStatus.SENT, None)
+    db.finish_outbox(ids[1], OutboxStatus.FAILED, "x" * 1000)
+    db.finish_outbox(ids[2], OutboxStatus.SKIPPED, "no gift")
+    sent, failed, skipped = outbox(database)
+    assert sent.status == OutboxStatus.SENT and sent.sent_at is not None
+    assert failed.status == OutboxStatus.FAILED and failed.sent_at is None
+    assert failed.error == "x" * 512
+    assert skipped.error == "no gift"
+    assert [m.attempts for m in outbox(database)] == [1, 1, 1]
+
+    counts, recent_failures = db.outbox_status()
+    assert counts == {
+        OutboxStatus.SENT: 1,
+        OutboxStatus.FAILED: 1,
+        OutboxStatus.SKIPPED: 1,
+    }
+    assert [m.id for m in recent_failures] == [ids[1]]
+
+
+def test_reset_outbox(database: Engine) -> None:
+    ids = [db.enqueue_dm(key, 1, "relay", {"content": key}) for key in "ab"]
+    db.claim_outbox()
+    db.finish_outbox(ids[0], OutboxStatus.FAILED, "error")
+    # the bot stopped while sending b
+    assert db.reset_outbox(OutboxStatus.SENDING) == 1
+    assert [m.status for m in outbox(database)] == [
+        OutboxStatus.FAILED,
+        OutboxStatus.PENDING,
+    ]
+    assert [m.id for m in db.claim_outbox()] == [ids[1]]
+    assert outbox(database)[1].attempts == 2
+    assert db.reset_outbox(OutboxStatus.PENDING) == 0
+
+
+def test_setting_the_period_again_only_sends_changes(swap: list[int]) -> None:
+    letters = outbox(db.get_engine())
+    assert len(letters) == len(swap)
+    assert {m.user_id for m in letters} == set(swap)
+    assert all(m.kind == "letter" for m in letters)
+
+    # nothing changed, so nothing new to send
+    db.Swap.set_swap_period(db.SwapPeriod.SWAP)
+    assert len(outbox(db.get_engine())) == len(swap)
+
+    # users who joined late are matched with each other, only they get a letter
+    for user_id in (1000, 1001, 1002):
+        db.join_swap(user_id, f"user{user_id}")
+        db.set_letter(user_id, "a late letter")
+    db.Swap.match_users()
+    db.Swap.set_swap_period(db.SwapPeriod.SWAP)
+    new = outbox(db.get_engine())[len(swap) :]
+    assert sorted(m.user_id for m in new) == [1000, 1001, 1002]
+
+    # a santa whose giftee changed their letter gets the new one
+    giftee = db.get_giftee(swap[0])
+    assert giftee is not None
+    db.set_letter(giftee.user_id, "a changed letter")
+    db.Swap.set_swap_period(db.SwapPeriod.SWAP)
+    assert [m.user_id for m in outbox(db.get_engine())[len(swap) + 3 :]] == [swap[0]]
+
+
+def test_period_outbox_status_counts_latest_messages(swap: list[int]) -> None:
+    for m in db.claim_outbox():
+        status = OutboxStatus.FAILED if m.user_id == swap[0] else OutboxStatus.SENT
+        db.finish_outbox(m.id, status, None)
+    counts, failed = db.period_outbox_status("letter")
+    assert counts == {OutboxStatus.SENT: len(swap) - 1, OutboxStatus.FAILED: 1}
+    assert failed == [swap[0]]
+
+    # their giftee changes the letter, and the period is set again
+    giftee = db.get_giftee(swap[0])
+    assert giftee is not None
+    db.set_letter(giftee.user_id, "a changed letter")
+    db.Swap.set_swap_period(db.SwapPeriod.SWAP)
+    counts, failed = db.period_outbox_status("letter")
+    assert counts == {OutboxStatus.SENT: len(swap) - 1, OutboxStatus.PENDING: 1}
+    assert failed == []
+    assert db.period_outbox_status("gift") == ({}, [])
@@ -0,0 +1,67 @@
+from filmswap.pairing_graph import PairingGraph
+
+
+def test_cycles() -> None:
+    # 1 -> 2 -> 3 -> 1, 4 -> 5 -> 4
+    graph = PairingGraph([(1, 2), (2, 3), (3, 1), (4, 5), (5, 4)])
+    result = graph.decompose()
+    assert result.cycles == [[1, 2, 3], [4, 5]]
+    assert result.is_valid
+    assert result.problems() == []
+
+
+def test_cycle_found_from_the_middle() -> None:
+    # starts at 3, which is on the cycle 2 -> 3 -> 4 -> 2
+    result = PairingGraph([(3, 4), (4, 2), (2, 3)]).decompose()
+    assert result.cycles == [[3, 4, 2]]
+
+
+def test_chains() -> None:
+    # 1 -> 2 -> 3 -> 4 -> 2, and 5 -> 6 where 6 has no giftee
+    graph = PairingGraph([(1, 2), (2, 3), (3, 4), (4, 2), (5, 6), (6, None)])
+    result = graph.decompose()
+    assert result.cycles == [[2, 3, 4]]
+    assert result.chains == [[1], [5, 6]]
+    assert not result.is_valid
+    assert result.problems() == [
+        "Not part of a cycle: 1",
+        "Not part of a cycle: 5 -> 6",
+    ]
+
+
+def test_chain_into_a_visited_chain() -> None:
+    # 3 -> 1 -> 2, 2 has no giftee. 1 and 2 are visited first
+    result = PairingGraph([(1, 2), (2, None), (3, 1)]).decompose()
+    assert result.cycles == []
+    assert result.chains == [[1, 2], [3]]
+
+
+def test_self_loop() -> None:
+    # 2 -> 1 -> 1
+    result = PairingGraph([(1, 1), (2, 1)]).decompose()
+    assert result.self_loops == [1]
+    assert result.chains == [[2]]
+    assert result.cycles == []
+    assert "User 1 is gifting to themselves" in result.problems()
+
+
+def test_dangling() -> None:
+    # 3 left the swap
+    graph = PairingGraph([(1, 2), (2, 3)])
+    result = graph.decompose()
+    assert result.dangling == [(2, 3)]
+    assert result.chains == [[1, 2]]
+    assert result.problems() == [
+        "User 2 is gifting to 3, who isn't in the swap",
+        "Not part of a cycle: 1 -> 2",
+    ]
+
+
+def test_every_user_visited_once() -> None:
+    # one large cycle, and a chain into it
+    n = 10_000
+    pairs: list[tuple[int, int | None]] = [(i, (i + 1) % n) for i in range(n)]
+    pairs.append((n, 0))
+    result = PairingGraph(pairs).decompose()
+    assert [len(cycle) for cycle in result.cycles] == [n]
+    assert result.chains == [[n]]
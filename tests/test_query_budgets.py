@@ -0,0 +1,97 @@
+"""
+How many SQL statements each command makes
+
+The budgets are what the commands make now, so a command which starts making
+a query per user (or per row) fails. If a change needs more, raise the budget
+here along with it
+"""
+
+import pytest
+
+from filmswap import db
+from filmswap.query_log import QueryBudgetExceeded, fingerprint, query_budget
+
+
+def test_read_query_budget(swap: list[int]) -> None:
+    with query_budget("/read", 1):
+        db.load_user_context(swap[0]).read_giftee_letter()
+
+
+def test_review_letter_query_budget(swap: list[int]) -> None:
+    with query_budget("/review-letter", 1):
+        db.load_user_context(swap[0]).review_my_letter_embed()
+
+
+def test_letter_query_budget(swap: list[int]) -> None:
+    with query_budget(">letter", 4):
+        db.load_user_context(swap[0])
+        db.set_letter(swap[0], "a new letter")
+
+
+def test_submit_query_budget(swap: list[int]) -> None:
+    with query_budget(">submit", 3):
+        db.load_user_context(swap[0])
+        db.set_gift(swap[0], "a gift")
+
+
+def test_write_santa_query_budget(swap: list[int]) -> None:
+    santa = db.get_santa(swap[0])
+    assert santa is not None
+    # what >write-santa does, see bot.py and OutboxSender.send_now
+    with query_budget(">write-santa", 6):
+        db.load_user_context(swap[0])
+        outbox_id = db.enqueue_dm("relay:1", santa.user_id, "relay", {"content": "hi"})
+        for message in db.claim_outbox([outbox_id]):
+            db.finish_outbox(message.id, db.OutboxStatus.SENT, None)
+
+
+def test_join_query_budget(swap: list[int]) -> None:
+    with query_budget("join button", 3):
+        db.join_swap(1000, "late joiner")
+
+
+def test_leave_query_budget(swap: list[int]) -> None:
+    db.join_swap(1000, "late joiner")
+    with query_budget("/leave", 3):
+        db.load_user_context(1000)
+        db.leave_swap(1000)
+
+
+def test_set_period_query_budget(swap: list[int]) -> None:
+    for user_id in swap:
+        db.set_gift(user_id, f"gift from {user_id}")
+    # the same for any number of users, see period_dm_payloads
+    with query_budget("set-period WATCH", 5):
+        db.Swap.set_swap_period(db.SwapPeriod.WATCH)
+
+
+def test_watch_query_budgets(swap: list[int]) -> None:
+    db.set_gift(db.get_santa(swap[0]).user_id, "a gift")  # type: ignore[union-attr]
+    db.Swap.set_swap_period(db.SwapPeriod.WATCH)
+    with query_budget("/receive", 1):
+        db.load_user_context(swap[0]).receive_gift_embed(raise_if_missing=True)
+    with query_budget("/done-watching", 3):
+        db.load_user_context(swap[0])
+        db.set_gift_done(swap[0])
+    with query_budget("/letterboxd", 3):
+        db.load_user_context(swap[0])
+        db.set_letterboxd(swap[0], "someone")
+
+
+def test_query_budget_exceeded(swap: list[int]) -> None:
+    with pytest.raises(QueryBudgetExceeded, match="made 2 queries, budget is 1"):
+        with query_budget("two queries", 1) as budget:
+            db.load_user_context(swap[0])
+            db.load_user_context(swap[1])
+    # both are the same statement, with different values
+    assert budget.statements[0] == budget.statements[1]
+
+
+def test_fingerprint() -> None:
+    assert fingerprint("SELECT *\n  FROM t WHERE id IN (?, ?, ?)") == fingerprint(
+        "SELECT * FROM t WHERE id IN (?)"
+    )
+    assert (
+        fingerprint("SELECT * FROM t_1 WHERE name = 'it''s' AND x > 10")
+        == "SELECT * FROM t_1 WHERE name = ? AND x > ?"
+    )
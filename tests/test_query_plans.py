@@ -0,0 +1,77 @@
+from typing import Any, Callable
+
+from sqlalchemy.engine import Engine
+
+from filmswap import db
+from filmswap.manage import _reroute_pair
+
+# (statement, parameters), from the statements fixture
+Statements = list[tuple[str, Any]]
+
+
+def scans(engine: Engine, statement: str, parameters: Any) -> list[str]:
+    """
+    The tables 'EXPLAIN QUERY PLAN' scans for a statement, instead of using an index
+    """
+    with engine.connect() as conn:
+        plan = conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters)
+        details = [row[-1] for row in plan]
+    # scanning a constant row/single row subquery (anon_1) is fine,
+    # scanning a table or an alias of one (swap_users_1) is not
+    return [
+        d
+        for d in details
+        if d.startswith("SCAN ")
+        and d != "SCAN CONSTANT ROW"
+        and not d.split()[1].startswith("anon_")
+    ]
+
+
+def test_hot_queries_use_indexes(
+    database: Engine, swap: list[int], statements: Statements
+) -> None:
+    user_id = swap[len(swap) // 2]
+    santa, giftee = db.get_santa(user_id), db.get_giftee(user_id)
+    assert santa is not None and giftee is not None
+    statements.clear()
+
+    # the per-command/per-user queries -- bulk jobs like the JSON snapshot
+    # are expected to read every row, so aren't checked here
+    hot: list[Callable[[], Any]] = [
+        lambda: db.load_user_context(user_id),
+        lambda: db.get_santa(user_id),
+        lambda: db.get_giftee(user_id),
+        lambda: db.user_has_letter(user_id),
+        lambda: db.has_giftee(user_id),
+        lambda: db.has_set_gift(user_id),
+        lambda: db.set_letter(user_id, "new letter"),
+        lambda: db.set_gift(user_id, "a gift"),
+        lambda: db.set_letterboxd(user_id, "someone"),
+        lambda: db.set_gift_done(user_id),
+        lambda: db.join_swap(user_id, "renamed"),
+        lambda: db.restore_letter(user_id),
+        lambda: db.read_giftee_letter(user_id),
+        lambda: db.receive_gift_embed(user_id),
+        lambda: db.review_my_gift_embed(user_id),
+        # what /swap-ban does
+        lambda: db.ban_user(user_id),
+        lambda: _reroute_pair(user_id, santa.user_id, giftee.user_id),
+        lambda: db.unban_user(user_id),
+        lambda: db.leave_swap(santa.user_id),
+    ]
+    for func in hot:
+        try:
+            func()
+        except (RuntimeError, AssertionError):
+            # only care about which queries ran
+            pass
+
+    # the same statement with the first parameters it ran with
+    unique = dict(reversed(statements))
+    assert unique
+    failed = {
+        " ".join(statement.split()): found
+        for statement, parameters in unique.items()
+        if (found := scans(database, statement, parameters))
+    }
+    assert failed == {}
@@ -0,0 +1,113 @@
+from typing import Any
+
+import pytest
+
+from filmswap import reveal
+from filmswap.reveal import LAYOUTS, Piece, cycles_layout, plan_jobs, tile_pieces
+from filmswap.settings import settings
+
+
+def names(tiles: list[list[Piece]]) -> list[list[tuple[str, ...]]]:
+    return [[piece.names for piece in tile] for tile in tiles]
+
+
+def letters(s: str) -> list[str]:
+    return list(s)
+
+
+def test_small_pieces_share_tiles() -> None:
+    tiles = tile_pieces([letters("abc"), letters("de")], [letters("fg")], tile_size=5)
+    assert names(tiles) == [[("a", "b", "c"), ("d", "e")], [("f", "g")]]
+    assert [[piece.closed for piece in tile] for tile in tiles] == [
+        [True, True],
+        [False],
+    ]
+
+
+def test_large_cycle_is_cut_into_arcs() -> None:
+    tiles = tile_pieces([letters("abcdefg")], [], tile_size=3)
+    # each arc ends with the first user of the next, the last ends where the cycle started
+    assert names(tiles) == [
+        [("a", "b", "c", "d")],
+        [("d", "e", "f", "g")],
+        [("g", "a")],
+    ]
+    assert not any(piece.closed for tile in tiles for piece in tile)
+
+
+def test_large_chain_is_cut_into_arcs() -> None:
+    tiles = tile_pieces([], [letters("abcde")], tile_size=3)
+    # the end of a chain doesn't gift to the start
+    assert names(tiles) == [[("a", "b", "c", "d")], [("d", "e")]]
+
+
+def test_pieces_stay_in_order() -> None:
+    tiles = tile_pieces(
+        [letters("ab"), letters("cdefg"), letters("hi")], [letters("jk")], tile_size=4
+    )
+    assert names(tiles) == [
+        [("a", "b")],
+        [("c", "d", "e", "f", "g")],
+        [("g", "c")],
+        [("h", "i"), ("j", "k")],
+    ]
+
+
+def test_every_edge_is_drawn() -> None:
+    cycles = [[f"c{i}-{j}" for j in range(size)] for i, size in enumerate((2, 9, 4))]
+    chains = [[f"h{j}" for j in range(7)]]
+    tiles = tile_pieces(cycles, chains, tile_size=5)
+    edges = {edge for tile in tiles for piece in tile for edge in piece.edges()}
+    expected = {
+        (cycle[j], cycle[(j + 1) % len(cycle)])
+        for cycle in cycles
+        for j in range(len(cycle))
+    } | set(zip(chains[0], chains[0][1:]))
+    assert edges == expected
+
+
+def test_cycles_layout() -> None:
+    pieces = (
+        Piece(names=tuple(letters("abc")), closed=True),
+        Piece(names=tuple(letters("de")), closed=False),
+    )
+    pos = cycles_layout(pieces)
+    assert set(pos) == set("abcde")
+    assert len(set(pos.values())) == 5
+
+
+def test_plan_jobs_splits_into_parts(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(settings, "REVEAL_TILE_SIZE", 3)
+    jobs = plan_jobs([letters("abc"), letters("de")], [], "spring", count=2)
+    assert [(job.seed, job.title) for job in jobs] == [
+        (0, "part 1/2"),
+        (0, "part 2/2"),
+        (1, "part 1/2"),
+        (1, "part 2/2"),
+    ]
+    # the same reveal asked for again is the same image
+    assert (
+        jobs[0].cache_key == plan_jobs([letters("abc")], [], "spring", 1)[0].cache_key
+    )
+
+
+def test_plan_jobs_randomize_picks_one_layout(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(settings, "REVEAL_TILE_SIZE", 2)
+    choices: list[Any] = []
+
+    def choice(layouts: Any) -> str:
+        choices.append(layouts)
+        return ("circle", "spring")[len(choices) % 2]
+
+    monkeypatch.setattr(reveal.random, "choice", choice)
+    jobs = plan_jobs([letters("ab"), letters("cd"), letters("ef")], [], "randomize", 3)
+    assert len(jobs) == 9
+    assert choices == [LAYOUTS]
+    assert {job.layout for job in jobs} == {"spring"}
+
+
+def test_plan_jobs_unknown_layout() -> None:
+    with pytest.raises(ValueError, match="Unknown graph layout"):
+        plan_jobs([letters("ab")], [], "nope", 1)
@@ -0,0 +1,45 @@
+import os
+import json
+import asyncio
+from typing import Any
+
+from sqlalchemy.orm import Session
+
+from filmswap import async_db, db
+from filmswap.backup_store import BackupStore
+from filmswap.settings import settings
+
+
+def read_export(path: str) -> dict[str, Any]:
+    with open(path) as f:
+        return json.load(f)  # type: ignore[no-any-return]
+
+
+def test_export_keeps_users_with_missing_partner(swap: list[int]) -> None:
+    removed = swap[0]
+    santa = db.get_santa(removed)
+    assert santa is not None
+    # the santa's giftee row is gone, e.g. deleted by hand
+    with Session(db.get_engine()) as session:
+        session.query(db.SwapUser).filter_by(user_id=removed).delete()
+        session.commit()
+    # not matched yet, so not exported
+    db.join_swap(1000, "late joiner")
+    db.set_letter(1000, "a letter")
+
+    export = read_export(db.snapshot_database().export)
+    users = {user["user_id"]: user for user in export["swapusers"]}
+    assert set(users) == set(swap) - {removed}
+    assert users[santa.user_id]["giftee_id"] == removed
+    assert users[santa.user_id]["giftee_name"] is None
+
+
+def test_join_snapshots_before_clearing_pairs(swap: list[int]) -> None:
+    asyncio.run(async_db.set_swap_period(db.SwapPeriod.JOIN))
+    assert db.get_giftee(swap[0]) is None
+
+    snapshots = list(BackupStore(settings.BACKUP_DIR).snapshots().values())
+    assert len(snapshots) == 1
+    export = read_export(os.path.join(settings.BACKUP_DIR, snapshots[0]["export"]))
+    assert len(export["swapusers"]) == len(swap)
+    assert all(user["giftee_id"] is not None for user in export["swapusers"])
@@ -0,0 +1,68 @@
+import re
+from typing import Any
+
+import pytest
+
+from filmswap import db
+
+# (statement, parameters), from the statements fixture
+Statements = list[tuple[str, Any]]
+
+SWAPS_SELECT = re.compile(r"^\s*SELECT\b.*\bswaps\b", re.DOTALL)
+
+
+def swap_selects(statements: Statements) -> list[str]:
+    return [s for s, _ in statements if SWAPS_SELECT.search(s)]
+
+
+def test_hot_path_does_not_query_swap(swap: list[int], statements: Statements) -> None:
+    user_id = swap[0]
+    db.load_user_context(user_id)
+    db.read_giftee_letter(user_id)
+    db.receive_gift_embed(user_id)
+    db.join_swap(1000, "late joiner")
+    assert swap_selects(statements) == []
+
+
+def test_create_swap_updates_snapshot(database: object, statements: Statements) -> None:
+    created = db.Swap.create_swap()
+    statements.clear()
+    assert db.Swap.get_swap() == created
+    assert created.period == db.SwapPeriod.JOIN
+    assert swap_selects(statements) == []
+
+
+@pytest.mark.parametrize(
+    "write, field, expected",
+    [
+        (lambda: db.Swap.set_swap_channel(5), "swap_channel_discord_id", 5),
+        (
+            lambda: db.Swap.save_join_button_message_id(42),
+            "join_button_message_id",
+            42,
+        ),
+        (
+            lambda: db.Swap.set_swap_period(db.SwapPeriod.WATCH),
+            "period",
+            db.SwapPeriod.WATCH,
+        ),
+    ],
+    ids=["set_swap_channel", "save_join_button_message_id", "set_swap_period"],
+)
+def test_writers_update_snapshot(
+    swap: list[int],
+    statements: Statements,
+    write: object,
+    field: str,
+    expected: object,
+) -> None:
+    assert callable(write)
+    write()
+    statements.clear()
+    snapshot = db.Swap.get_swap()
+    assert getattr(snapshot, field) == expected
+    assert swap_selects(statements) == []
+
+    # and the snapshot matches the row
+    db.invalidate_swap_cache()
+    assert db.Swap.get_swap() == snapshot
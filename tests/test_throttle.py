@@ -0,0 +1,91 @@
+import pytest
+
+from filmswap import throttle
+from filmswap.bot import dm_command_name
+from filmswap.throttle import Throttle
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch: pytest.MonkeyPatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(throttle.time, "monotonic", clock)
+    return clock
+
+
+def test_burst_then_refill(clock: Clock) -> None:
+    t = Throttle(limits={"letter": (3, 30.0)})
+    assert all(t.check(1, "letter").allowed for _ in range(3))
+    result = t.check(1, "letter")
+    assert not result.allowed
+    assert result.retry_after == pytest.approx(30)
+
+    clock.now += 10
+    assert t.check(1, "letter").retry_after == pytest.approx(20)
+    clock.now += 20
+    assert t.check(1, "letter").allowed
+    assert not t.check(1, "letter").allowed
+
+    # refills up to the burst, no further
+    clock.now += 3600
+    assert all(t.check(1, "letter").allowed for _ in range(3))
+    assert not t.check(1, "letter").allowed
+
+
+def test_buckets_per_user_and_command(clock: Clock) -> None:
+    t = Throttle(limits={"letter": (1, 30.0), "default": (1, 10.0)})
+    assert t.check(1, "letter").allowed
+    assert not t.check(1, "letter").allowed
+    # another user, or another command, has its own bucket
+    assert t.check(2, "letter").allowed
+    assert t.check(1, "submit").allowed
+    assert not t.check(1, "submit").allowed
+    assert t.check(1, "write-santa").allowed
+    # commands without a limit use 'default'
+    assert t.check(1, "submit").retry_after == pytest.approx(10)
+
+
+def test_no_limit(clock: Clock) -> None:
+    t = Throttle(limits={"letter": (1, 30.0)})
+    assert all(t.check(1, "submit").allowed for _ in range(100))
+    assert len(t._buckets) == 0
+
+
+def test_warn_once(clock: Clock) -> None:
+    t = Throttle(limits={"letter": (1, 30.0)})
+    assert t.check(1, "letter").allowed
+    results = [t.check(1, "letter") for _ in range(3)]
+    assert [r.warn for r in results] == [True, False, False]
+    assert not any(r.allowed for r in results)
+
+    # once they can use it again, they're warned again the next time
+    clock.now += 30
+    assert t.check(1, "letter").allowed
+    assert t.check(1, "letter").warn
+
+
+def test_lru_eviction(clock: Clock) -> None:
+    t = Throttle(limits={"letter": (1, 30.0)}, max_entries=2)
+    assert t.check(1, "letter").allowed
+    assert t.check(2, "letter").allowed
+    # using 1 again makes 2 the least recently used
+    assert not t.check(1, "letter").allowed
+    assert t.check(3, "letter").allowed
+    assert list(t._buckets) == [(1, "letter"), (3, "letter")]
+    # 2 was evicted, so starts with a full bucket
+    assert t.check(2, "letter").allowed
+    assert len(t._buckets) == 2
+
+
+def test_dm_command_name() -> None:
+    assert dm_command_name(">letter I like films") == "letter"
+    assert dm_command_name(">letter2") == "letter"
+    assert dm_command_name(">write-santa hi") == "write-santa"
+    assert dm_command_name(">nope") == "unknown"
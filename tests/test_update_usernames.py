@@ -0,0 +1,58 @@
+import asyncio
+from types import SimpleNamespace
+from typing import Any
+
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from filmswap import db
+from filmswap.manage import update_usernames
+
+
+class FakeGuild:
+    """
+    A guild which isn't chunked, where the query for the first 100 users fails
+    """
+
+    chunked = False
+
+    def __init__(self, names: dict[int, str]) -> None:
+        self.names = names
+        self.queries: list[list[int]] = []
+
+    async def chunk(self) -> None:
+        raise RuntimeError("chunking is disabled")
+
+    def get_member(self, user_id: int) -> None:
+        return None
+
+    async def query_members(self, user_ids: list[int], cache: bool) -> list[Any]:
+        self.queries.append(user_ids)
+        if len(self.queries) == 1:
+            raise asyncio.TimeoutError()
+        return [
+            SimpleNamespace(id=user_id, display_name=self.names[user_id])
+            for user_id in user_ids
+            if user_id in self.names
+        ]
+
+
+def test_failed_query_doesnt_remove_users(database: Engine) -> None:
+    db.Swap.create_swap()
+    user_ids = list(range(1, 151))
+    for user_id in user_ids:
+        db.join_swap(user_id, f"user{user_id}")
+        db.set_letter(user_id, "a letter")
+    # 150 left, 101 changed their name. the names of the first batch aren't known
+    names = {user_id: f"user{user_id}" for user_id in user_ids[100:149]}
+    names[101] = "renamed"
+    guild = FakeGuild(names)
+
+    asyncio.run(update_usernames(guild))  # type: ignore[arg-type]
+
+    assert [len(batch) for batch in guild.queries] == [100, 50]
+    with Session(database) as session:
+        users = {user.user_id: user for user in session.query(db.SwapUser)}
+    assert all(users[user_id].letter == "a letter" for user_id in user_ids[:149])
+    assert users[150].letter is None
+    assert users[101].name == "renamed"